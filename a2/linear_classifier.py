@@ -239,7 +239,9 @@ def sample_batch(X, y, num_train, batch_size):
   # Hint: Use torch.randint to generate indices.                          #
   #########################################################################
   # Replace "pass" statement with your code
-  pass
+  idx = torch.randint(num_train, (batch_size,), device=y.device)
+  X_batch = X[idx]
+  y_batch = y[idx]
   #########################################################################
   #                       END OF YOUR CODE                                #
   #########################################################################
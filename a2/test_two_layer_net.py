@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from two_layer_net import (TwoLayerNet, find_best_net, find_best_net_parallel,
+                           nn_accuracy, nn_forward_backward,
+                           nn_predict_inference)
+
+
+def _blobs(num_per_class, seed):
+  """Three well separated Gaussian blobs in 5 dimensions."""
+  gen = torch.Generator().manual_seed(seed)
+  centers = 4 * torch.eye(3, 5, dtype=torch.float64)
+  X = torch.cat([c + torch.randn(num_per_class, 5, generator=gen,
+                                 dtype=torch.float64) for c in centers])
+  y = torch.arange(3).repeat_interleave(num_per_class)
+  perm = torch.randperm(X.shape[0], generator=gen)
+  return X[perm], y[perm]
+
+
+def _search_params():
+  return [1e0, 1e-4], [16], [1e-4], [0.95]
+
+
+def test_find_best_net_parallel_matches_serial_search():
+  X_train, y_train = _blobs(100, seed=0)
+  X_val, y_val = _blobs(30, seed=1)
+  data = {'X_train': X_train, 'y_train': y_train,
+          'X_val': X_val, 'y_val': y_val}
+
+  net, stat, val_acc = find_best_net_parallel(
+      data, _search_params, num_iters=100, batch_size=30, num_workers=2,
+      prune_after=1, prune_margin=0.2)
+
+  assert val_acc > 0.9
+  assert val_acc == nn_accuracy(net.params, nn_forward_backward,
+                                nn_predict_inference, X_val, y_val)
+  # The epoch-end evaluations are the only accuracy checks.
+  assert len(stat['loss_history']) == 100
+  assert stat['val_acc_history'][-1] == val_acc
+
+  _, _, serial_val_acc = find_best_net(data, _search_params,
+                                       num_iters=100, batch_size=30)
+  assert abs(val_acc - serial_val_acc) <= 0.1
+
+
+@pytest.mark.parametrize('amp_dtype', [None, torch.bfloat16])
+def test_train_follows_the_eval_schedule(amp_dtype):
+  X, y = _blobs(100, seed=0)
+  net = TwoLayerNet(5, 16, 3, dtype=torch.float32, device='cpu')
+  stat = net.train(X.float(), y, X.float(), y, num_iters=40, batch_size=30,
+                   eval_every=4, num_val_samples=50, eval_chunk_size=16,
+                   amp_dtype=amp_dtype)
+  assert len(stat['val_acc_history']) == 10
+
+  stat = net.train(X.float(), y, X.float(), y, num_iters=40, batch_size=30,
+                   eval_every=0, amp_dtype=amp_dtype)
+  assert stat['val_acc_history'] == []
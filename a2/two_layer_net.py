@@ -5,6 +5,9 @@ WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 import torch
 import random
 import statistics
+import itertools
+import time
+import torch.multiprocessing as mp
 from linear_classifier import sample_batch
 
 
@@ -54,14 +57,29 @@ class TwoLayerNet(object):
   def train(self, X, y, X_val, y_val,
             learning_rate=1e-3, learning_rate_decay=0.95,
             reg=5e-6, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False,
+            eval_every=None, num_val_samples=None, eval_chunk_size=None,
+            amp_dtype=None):
+    if amp_dtype is not None:
+      return nn_train_amp(
+              self.params,
+              X, y, X_val, y_val,
+              learning_rate, learning_rate_decay,
+              reg, num_iters, batch_size, verbose,
+              eval_every=eval_every,
+              num_val_samples=num_val_samples,
+              eval_chunk_size=eval_chunk_size,
+              amp_dtype=amp_dtype)
     return nn_train(
             self.params,
             nn_forward_backward,
-            nn_predict,
+            nn_predict_inference,
             X, y, X_val, y_val,
             learning_rate, learning_rate_decay,
-            reg, num_iters, batch_size, verbose)
+            reg, num_iters, batch_size, verbose,
+            eval_every=eval_every,
+            num_val_samples=num_val_samples,
+            eval_chunk_size=eval_chunk_size)
 
   def predict(self, X):
     return nn_predict(self.params, nn_forward_backward, X)
@@ -76,6 +94,197 @@ class TwoLayerNet(object):
     print("load checkpoint file: {}".format(path))
 
 
+class StackedTwoLayerNet(object):
+  """
+  K TwoLayerNets with different hidden sizes packed into one "super-network"
+  so that all of them are trained by a single batched forward/backward pass.
+
+  Each model gets H_max hidden units, where H_max is the largest hidden size;
+  the units beyond a model's own hidden size are masked out, so they stay at
+  zero and never receive gradient. The parameters are stored in self.params:
+
+  W1: First layer weights of all models; has shape (D, K * H_max)
+  b1: First layer biases of all models; has shape (K * H_max,)
+  W2: Second layer weights; has shape (K, H_max, C)
+  b2: Second layer biases; has shape (K, C)
+
+  Model k owns columns [k * H_max, (k + 1) * H_max) of W1 and b1, and
+  W2[k], b2[k]. Use unstack(k) to get it back as a regular TwoLayerNet.
+  """
+
+  def __init__(self, input_size, hidden_sizes, output_size,
+               dtype=torch.float32, device='cuda', std=1e-4):
+    """
+    Inputs:
+    - input_size: The dimension D of the input data.
+    - hidden_sizes: A list of K integers giving the hidden size of each model.
+    - output_size: The number of classes C.
+    - dtype: Optional, data type of each initial weight params
+    - device: Optional, whether the weight params is on GPU or CPU
+    - std: Optional, initial weight scaler.
+    """
+    random.seed(0)
+    torch.manual_seed(0)
+
+    self.hidden_sizes = list(hidden_sizes)
+    K = len(self.hidden_sizes)
+    H = max(self.hidden_sizes)
+    self.H_max = H
+
+    # mask[k, h] is 1 if unit h exists in model k
+    mask = torch.arange(H, device=device) < torch.tensor(self.hidden_sizes, device=device).view(K, 1)
+    self.mask = mask.to(dtype)
+
+    self.params = {}
+    self.params['W1'] = std * torch.randn(input_size, K * H, dtype=dtype, device=device) * self.mask.view(-1)
+    self.params['b1'] = torch.zeros(K * H, dtype=dtype, device=device)
+    self.params['W2'] = std * torch.randn(K, H, output_size, dtype=dtype, device=device) * self.mask.view(K, H, 1)
+    self.params['b2'] = torch.zeros(K, output_size, dtype=dtype, device=device)
+
+  def _forward(self, X):
+    """
+    Returns the scores of all models, of shape (K, N, C), and the masked
+    hidden activations, of shape (N, K * H_max).
+    """
+    K, H = len(self.hidden_sizes), self.H_max
+    hidden = torch.addmm(self.params['b1'], X, self.params['W1'])
+    hidden.clamp_(min=0)
+    hidden *= self.mask.view(-1)
+    scores = torch.bmm(hidden.view(-1, K, H).transpose(0, 1), self.params['W2'])
+    scores += self.params['b2'].view(K, 1, -1)
+    return scores, hidden
+
+  def loss(self, X, y=None, reg=0.0):
+    """
+    Compute the softmax loss and gradients of all models at once.
+
+    Inputs:
+    - X: Input data of shape (N, D).
+    - y: Optional, vector of training labels of shape (N,).
+    - reg: Regularization strength; a scalar or a tensor of shape (K,) giving
+      the strength of each model.
+
+    Returns:
+    If y is None, return the scores of every model, of shape (K, N, C).
+
+    If y is not None, return a tuple of:
+    - loss: Tensor of shape (K,) giving the loss of each model.
+    - grads: Dictionary with the same keys and shapes as self.params. Since
+      the models share no parameters, grads restricted to model k equal the
+      gradients of loss[k].
+    """
+    K, H = len(self.hidden_sizes), self.H_max
+    N = X.shape[0]
+    W1, W2 = self.params['W1'], self.params['W2']
+    reg = torch.as_tensor(reg, dtype=W1.dtype, device=W1.device).expand(K)
+
+    scores, hidden = self._forward(X)
+    if y is None:
+      return scores
+
+    # Softmax loss of every model, scaled by the batch size
+    scores -= scores.max(dim=2, keepdim=True).values
+    probs = scores.exp_()
+    probs /= probs.sum(dim=2, keepdim=True)
+    correct = probs[:, torch.arange(N, device=X.device), y]
+    loss = -correct.log().mean(dim=1)
+    loss += reg * (W1.view(-1, K, H).pow(2).sum(dim=(0, 2)) + W2.pow(2).sum(dim=(1, 2)))
+
+    dscores = probs
+    dscores[:, torch.arange(N, device=X.device), y] -= 1
+    dscores /= N
+
+    grads = {}
+    grads['W2'] = torch.bmm(hidden.view(N, K, H).transpose(0, 1).transpose(1, 2), dscores)
+    grads['W2'] += 2 * reg.view(K, 1, 1) * W2
+    grads['b2'] = dscores.sum(dim=1)
+
+    dhidden = torch.bmm(dscores, W2.transpose(1, 2)).transpose(0, 1).reshape(N, K * H)
+    dhidden *= hidden > 0
+    grads['W1'] = X.t().mm(dhidden)
+    grads['W1'] += 2 * reg.repeat_interleave(H) * W1
+    grads['b1'] = dhidden.sum(dim=0)
+
+    return loss, grads
+
+  def train(self, X, y, X_val, y_val,
+            learning_rates=1e-3, learning_rate_decays=0.95,
+            regs=5e-6, num_iters=100,
+            batch_size=200, verbose=False):
+    """
+    Train all models with SGD, each with its own learning rate, decay and
+    regularization strength. Scalars are shared by all models; tensors or
+    lists of length K give one value per model.
+
+    Returns: A dictionary like the one of nn_train, where every entry of
+    'loss_history', 'train_acc_history' and 'val_acc_history' is a list of K
+    values, one per model.
+    """
+    K, H = len(self.hidden_sizes), self.H_max
+    W1 = self.params['W1']
+    as_k = lambda v: torch.as_tensor(v, dtype=W1.dtype, device=W1.device).expand(K).clone()
+    lr, decay, reg = as_k(learning_rates), as_k(learning_rate_decays), as_k(regs)
+
+    num_train = X.shape[0]
+    iterations_per_epoch = max(num_train // batch_size, 1)
+    loss_history = []
+    train_acc_history = []
+    val_acc_history = []
+
+    for it in range(num_iters):
+      X_batch, y_batch = sample_batch(X, y, num_train, batch_size)
+      loss, grads = self.loss(X_batch, y=y_batch, reg=reg)
+      loss_history.append(loss.tolist())
+
+      self.params['W1'] -= lr.repeat_interleave(H) * grads['W1']
+      self.params['b1'] -= lr.repeat_interleave(H) * grads['b1']
+      self.params['W2'] -= lr.view(K, 1, 1) * grads['W2']
+      self.params['b2'] -= lr.view(K, 1) * grads['b2']
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: loss %s' % (it, num_iters, loss.tolist()))
+
+      # Every epoch, check train and val accuracy and decay learning rates.
+      if it % iterations_per_epoch == 0:
+        train_acc_history.append(self.accuracy(X_batch, y_batch))
+        val_acc_history.append(self.accuracy(X_val, y_val))
+        lr *= decay
+
+    return {
+      'loss_history': loss_history,
+      'train_acc_history': train_acc_history,
+      'val_acc_history': val_acc_history,
+    }
+
+  def predict(self, X):
+    """
+    Returns the predicted labels of all models, of shape (K, N).
+    """
+    with torch.no_grad():
+      scores, _ = self._forward(X)
+    return scores.argmax(dim=2)
+
+  def accuracy(self, X, y):
+    """
+    Returns a list with the accuracy of each model on (X, y).
+    """
+    return (self.predict(X) == y).to(torch.float32).mean(dim=1).tolist()
+
+  def unstack(self, k):
+    """
+    Return model k as a regular TwoLayerNet with its own hidden size.
+    """
+    H, h = self.H_max, self.hidden_sizes[k]
+    W1 = self.params['W1']
+    D, C = W1.shape[0], self.params['b2'].shape[1]
+    net = TwoLayerNet(D, h, C, dtype=W1.dtype, device=W1.device)
+    net.params['W1'] = W1[:, k * H:k * H + h].clone()
+    net.params['b1'] = self.params['b1'][k * H:k * H + h].clone()
+    net.params['W2'] = self.params['W2'][k, :h].clone()
+    net.params['b2'] = self.params['b2'][k].clone()
+    return net
+
+
 
 def nn_forward_pass(params, X):
     """
@@ -116,7 +325,8 @@ def nn_forward_pass(params, X):
     # shape (N, C).                                                            #
     ############################################################################
     # Replace "pass" statement with your code
-    pass
+    hidden = (X.mm(W1) + b1).clamp(min=0) # N * H
+    scores = hidden.mm(W2) + b2 # N * C
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -176,7 +386,10 @@ def nn_forward_backward(params, X, y=None, reg=0.0):
     # (Check Numeric Stability in http://cs231n.github.io/linear-classify/).   #
     ############################################################################
     # Replace "pass" statement with your code
-    pass
+    shifted = scores - scores.max(dim=1, keepdim=True).values
+    log_probs = shifted - shifted.exp().sum(dim=1, keepdim=True).log() # N * C
+    loss = -log_probs[torch.arange(N, device=X.device), y].mean()
+    loss += reg * (torch.sum(W1 * W1) + torch.sum(W2 * W2))
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -190,7 +403,15 @@ def nn_forward_backward(params, X, y=None, reg=0.0):
     # tensor of same size                                                     #
     ###########################################################################
     # Replace "pass" statement with your code
-    pass
+    dscores = log_probs.exp() # N * C
+    dscores[torch.arange(N, device=X.device), y] -= 1
+    dscores /= N
+    grads['W2'] = h1.t().mm(dscores) + 2 * reg * W2
+    grads['b2'] = dscores.sum(dim=0)
+    dh1 = dscores.mm(W2.t()) # N * H
+    dh1 *= h1 > 0
+    grads['W1'] = X.t().mm(dh1) + 2 * reg * W1
+    grads['b1'] = dh1.sum(dim=0)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -201,7 +422,8 @@ def nn_forward_backward(params, X, y=None, reg=0.0):
 def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
             learning_rate=1e-3, learning_rate_decay=0.95,
             reg=5e-6, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False,
+            eval_every=None, num_val_samples=None, eval_chunk_size=None):
   """
   Train this neural network using stochastic gradient descent.
 
@@ -235,11 +457,25 @@ def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
   - num_iters: Number of steps to take when optimizing.
   - batch_size: Number of training examples to use per step.
   - verbose: boolean; if true print progress during optimization.
+  - eval_every: Optional, number of iterations between accuracy checks.
+    Defaults to once per epoch; 0 disables them. The learning rate is still
+    decayed once per epoch regardless of this value.
+  - num_val_samples: Optional, if given, evaluate on a fixed random subset of
+    this many validation samples instead of the full X_val.
+  - eval_chunk_size: Optional, if given, stream the validation data through
+    pred_func in chunks of this many samples to bound peak memory.
 
   Returns: A dictionary giving statistics about the training process
   """
   num_train = X.shape[0]
   iterations_per_epoch = max(num_train // batch_size, 1)
+  if eval_every is None:
+    eval_every = iterations_per_epoch
+
+  # Pick the validation subset once so accuracies are comparable across epochs
+  if num_val_samples is not None and num_val_samples < X_val.shape[0]:
+    val_idx = torch.randperm(X_val.shape[0], device=X_val.device)[:num_val_samples]
+    X_val, y_val = X_val[val_idx], y_val[val_idx]
 
   # Use SGD to optimize the parameters in self.model
   loss_history = []
@@ -260,7 +496,8 @@ def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
     # stored in the grads dictionary defined above.                         #
     #########################################################################
     # Replace "pass" statement with your code
-    pass
+    for k in params:
+      params[k] -= learning_rate * grads[k]
     #########################################################################
     #                             END OF YOUR CODE                          #
     #########################################################################
@@ -268,26 +505,238 @@ def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
     if verbose and it % 100 == 0:
       print('iteration %d / %d: loss %f' % (it, num_iters, loss.item()))
 
-    # Every epoch, check train and val accuracy and decay learning rate.
+    # Check train and val accuracy on the evaluation schedule.
+    if eval_every and it % eval_every == 0:
+      train_acc = nn_accuracy(params, loss_func, pred_func, X_batch, y_batch)
+      val_acc = nn_accuracy(params, loss_func, pred_func, X_val, y_val,
+                            chunk_size=eval_chunk_size)
+      train_acc_history.append(train_acc)
+      val_acc_history.append(val_acc)
+
+    # Every epoch, decay learning rate.
     if it % iterations_per_epoch == 0:
-      # Check accuracy
-      y_train_pred = pred_func(params, loss_func, X_batch)
-      train_acc = (y_train_pred == y_batch).float().mean().item()
-      y_val_pred = pred_func(params, loss_func, X_val)
-      val_acc = (y_val_pred == y_val).float().mean().item()
+      learning_rate *= learning_rate_decay
+
+  return {
+    'loss_history': loss_history,
+    'train_acc_history': train_acc_history,
+    'val_acc_history': val_acc_history,
+  }
+
+
+def nn_forward_backward_amp(params, X, y=None, reg=0.0,
+                            amp_dtype=torch.bfloat16, loss_scale=1.0):
+  """
+  Mixed-precision version of nn_forward_backward. params hold the float32
+  master weights; the matrix multiplies and the activations kept for the
+  backward pass use amp_dtype, while the softmax, the loss and the returned
+  gradients are float32.
+
+  Inputs: Same as nn_forward_backward, plus
+  - amp_dtype: Low-precision dtype, torch.bfloat16 or torch.float16.
+  - loss_scale: Factor applied to the upstream gradient before it is cast to
+    amp_dtype; the returned gradients are unscaled again.
+
+  Returns: Same as nn_forward_backward. If the low-precision backward pass
+  overflowed, some gradients contain inf or nan.
+  """
+  W1, b1 = params['W1'].to(amp_dtype), params['b1'].to(amp_dtype)
+  W2, b2 = params['W2'].to(amp_dtype), params['b2'].to(amp_dtype)
+  X = X.to(amp_dtype)
+  N = X.shape[0]
+
+  hidden = torch.addmm(b1, X, W1).clamp_(min=0)
+  scores = torch.addmm(b2, hidden, W2).float()
+  if y is None:
+    return scores
+
+  scores -= scores.max(dim=1, keepdim=True).values
+  log_probs = scores - scores.exp().sum(dim=1, keepdim=True).log()
+  loss = -log_probs[torch.arange(N, device=X.device), y].mean()
+  loss += reg * (params['W1'].pow(2).sum() + params['W2'].pow(2).sum())
+
+  dscores = log_probs.exp_()
+  dscores[torch.arange(N, device=X.device), y] -= 1
+  # Scale up before the cast: float16 flushes gradients below about 6e-8
+  # to zero, and the small entries of dscores / N easily get there.
+  dscores *= loss_scale / N
+  dscores = dscores.to(amp_dtype)
+
+  grads = {}
+  grads['W2'] = hidden.t().mm(dscores).float()
+  grads['b2'] = dscores.sum(dim=0, dtype=torch.float32)
+  dhidden = dscores.mm(W2.t())
+  dhidden *= hidden > 0
+  grads['W1'] = X.t().mm(dhidden).float()
+  grads['b1'] = dhidden.sum(dim=0, dtype=torch.float32)
+
+  for k in grads:
+    grads[k] /= loss_scale
+  grads['W1'] += 2 * reg * params['W1']
+  grads['W2'] += 2 * reg * params['W2']
+
+  return loss, grads
+
+
+def nn_train_amp(params, X, y, X_val, y_val,
+                 learning_rate=1e-3, learning_rate_decay=0.95,
+                 reg=5e-6, num_iters=100,
+                 batch_size=200, verbose=False,
+                 eval_every=None, num_val_samples=None, eval_chunk_size=None,
+                 amp_dtype=torch.bfloat16, loss_scale=None,
+                 growth_interval=1000):
+  """
+  Train a two-layer network with SGD in mixed precision. params keep the
+  float32 master weights, which are the only weights that are updated; the
+  forward and backward passes run in amp_dtype via nn_forward_backward_amp.
+
+  The loss scale is dynamic: if a step produces non-finite gradients the
+  step is skipped and the scale is halved, and after growth_interval
+  consecutive good steps the scale is doubled.
+
+  Inputs: Same as nn_train (without loss_func and pred_func; evaluation
+  always uses nn_predict_inference on the float32 weights), plus
+  - amp_dtype: torch.bfloat16 (works on CPU) or torch.float16.
+  - loss_scale: Optional, initial loss scale. Defaults to 2 ** 16 for float16
+    and 1 for other dtypes.
+  - growth_interval: Number of good steps between loss scale increases.
+
+  Returns: A dictionary like the one of nn_train, with the extra keys
+  'loss_scale_history' and 'num_skipped_steps'.
+  """
+  if loss_scale is None:
+    # bfloat16 keeps the 8-bit exponent of float32, so only float16 needs a
+    # scale to keep small gradients representable
+    loss_scale = 2.0 ** 16 if amp_dtype == torch.float16 else 1.0
+
+  num_train = X.shape[0]
+  iterations_per_epoch = max(num_train // batch_size, 1)
+  if eval_every is None:
+    eval_every = iterations_per_epoch
+
+  if num_val_samples is not None and num_val_samples < X_val.shape[0]:
+    val_idx = torch.randperm(X_val.shape[0], device=X_val.device)[:num_val_samples]
+    X_val, y_val = X_val[val_idx], y_val[val_idx]
+
+  loss_history = []
+  train_acc_history = []
+  val_acc_history = []
+  loss_scale_history = []
+  num_skipped_steps = 0
+  good_steps = 0
+
+  for it in range(num_iters):
+    X_batch, y_batch = sample_batch(X, y, num_train, batch_size)
+    loss, grads = nn_forward_backward_amp(params, X_batch, y=y_batch, reg=reg,
+                                          amp_dtype=amp_dtype,
+                                          loss_scale=loss_scale)
+    loss_history.append(loss.item())
+    loss_scale_history.append(loss_scale)
+
+    if all(torch.isfinite(g).all() for g in grads.values()):
+      for k in params:
+        params[k] -= learning_rate * grads[k]
+      good_steps += 1
+      if good_steps % growth_interval == 0:
+        loss_scale = min(loss_scale * 2, 2.0 ** 24)
+    else:
+      num_skipped_steps += 1
+      good_steps = 0
+      loss_scale /= 2
+
+    if verbose and it % 100 == 0:
+      print('iteration %d / %d: loss %f, loss scale %g'
+            % (it, num_iters, loss.item(), loss_scale))
+
+    # Check train and val accuracy on the evaluation schedule.
+    if eval_every and it % eval_every == 0:
+      train_acc = nn_accuracy(params, None, nn_predict_inference, X_batch, y_batch)
+      val_acc = nn_accuracy(params, None, nn_predict_inference, X_val, y_val,
+                            chunk_size=eval_chunk_size)
       train_acc_history.append(train_acc)
       val_acc_history.append(val_acc)
 
-      # Decay learning rate
+    # Every epoch, decay learning rate.
+    if it % iterations_per_epoch == 0:
       learning_rate *= learning_rate_decay
 
   return {
     'loss_history': loss_history,
     'train_acc_history': train_acc_history,
     'val_acc_history': val_acc_history,
+    'loss_scale_history': loss_scale_history,
+    'num_skipped_steps': num_skipped_steps,
   }
 
 
+def nn_benchmark_amp(data_dict, hidden_size=128, amp_dtype=torch.bfloat16,
+                     num_iters=200, batch_size=200, learning_rate=1e-1,
+                     reg=1e-5):
+  """
+  Train the same TwoLayerNet once in float32 with nn_train and once in mixed
+  precision with nn_train_amp, and report the speed and memory of both runs.
+
+  Peak memory is read from the CUDA allocator, so it is only measured when
+  the data is on a GPU; on CPU it is reported as None.
+
+  Inputs:
+  - data_dict (dict): a dictionary that includes
+                      ['X_train', 'y_train', 'X_val', 'y_val']
+  - hidden_size, num_iters, batch_size, learning_rate, reg: Training setup
+    shared by both runs.
+  - amp_dtype: Low-precision dtype for the mixed-precision run.
+
+  Returns: A dictionary mapping str(torch.float32) and str(amp_dtype) to
+  dictionaries with the keys 'time', 'memory' (bytes, or None on CPU) and
+  'val_acc' (of the final weights).
+  """
+  X_train, y_train = data_dict['X_train'], data_dict['y_train']
+  X_val, y_val = data_dict['X_val'], data_dict['y_val']
+  D = X_train.shape[1]
+  C = int(y_train.max().item()) + 1
+  is_cuda = X_train.is_cuda
+
+  results = {}
+  for dtype in [torch.float32, amp_dtype]:
+    net = TwoLayerNet(D, hidden_size, C, dtype=torch.float32,
+                      device=X_train.device)
+    if is_cuda:
+      torch.cuda.synchronize()
+      torch.cuda.reset_peak_memory_stats()
+    tic = time.perf_counter()
+    if dtype == torch.float32:
+      nn_train(net.params, nn_forward_backward, nn_predict_inference,
+               X_train, y_train, X_val, y_val,
+               learning_rate=learning_rate, reg=reg,
+               num_iters=num_iters, batch_size=batch_size)
+    else:
+      nn_train_amp(net.params, X_train, y_train, X_val, y_val,
+                   learning_rate=learning_rate, reg=reg,
+                   num_iters=num_iters, batch_size=batch_size,
+                   amp_dtype=dtype)
+    if is_cuda:
+      torch.cuda.synchronize()
+    elapsed = time.perf_counter() - tic
+
+    results[str(dtype)] = {
+      'time': elapsed,
+      'memory': torch.cuda.max_memory_allocated() if is_cuda else None,
+      'val_acc': nn_accuracy(net.params, None, nn_predict_inference,
+                             X_val, y_val),
+    }
+
+  base = results[str(torch.float32)]
+  for name, r in results.items():
+    if r['memory'] is None:
+      memory = 'n/a'
+    else:
+      memory = '%.2f MB (%.2fx)' % (r['memory'] / 2 ** 20,
+                                    r['memory'] / base['memory'])
+    print('%-16s time %.3fs (%.2fx)  memory %s  val acc %.4f'
+          % (name, r['time'], base['time'] / r['time'], memory, r['val_acc']))
+  return results
+
+
 def nn_predict(params, loss_func, X):
   """
   Use the trained weights of this two-layer network to predict labels for
@@ -316,7 +765,7 @@ def nn_predict(params, loss_func, X):
   # TODO: Implement this function; it should be VERY simple!                #
   ###########################################################################
   # Replace "pass" statement with your code
-  pass
+  y_pred = loss_func(params, X).argmax(dim=1)
   ###########################################################################
   #                              END OF YOUR CODE                           #
   ###########################################################################
@@ -324,6 +773,65 @@ def nn_predict(params, loss_func, X):
   return y_pred
 
 
+def nn_forward_inference(params, X):
+  """
+  Forward-only version of nn_forward_pass for evaluation. It computes the
+  same scores but does not keep the hidden activations around for a backward
+  pass, and it reuses the hidden buffer in place for the ReLU and bias.
+
+  Inputs:
+  - params: a dictionary of PyTorch Tensor that store the weights of a model.
+  - X: Input data of shape (N, D).
+
+  Returns:
+  - scores: Tensor of shape (N, C) giving the classification scores for X
+  """
+  W1, b1 = params['W1'], params['b1']
+  W2, b2 = params['W2'], params['b2']
+  with torch.no_grad():
+    hidden = X.mm(W1)
+    hidden += b1
+    hidden.clamp_(min=0)
+    scores = torch.addmm(b2, hidden, W2)
+  return scores
+
+
+def nn_predict_inference(params, loss_func, X):
+  """
+  Drop-in replacement for nn_predict that uses nn_forward_inference, so that
+  evaluation does not go through the training-time forward/backward code.
+  loss_func is accepted only to keep the pred_func signature of nn_train.
+
+  Returns:
+  - y_pred: A PyTorch tensor of shape (N,) giving predicted labels.
+  """
+  return nn_forward_inference(params, X).argmax(dim=1)
+
+
+def nn_accuracy(params, loss_func, pred_func, X, y, chunk_size=None):
+  """
+  Compute the accuracy of pred_func on (X, y) under torch.no_grad.
+
+  Inputs:
+  - params, loss_func, pred_func: Same as nn_train.
+  - X: A PyTorch tensor of shape (N, D) giving data to classify.
+  - y: A PyTorch tensor of shape (N,) giving the labels of X.
+  - chunk_size: Optional, if given, X is processed in chunks of this many
+    samples, so only one chunk of activations is alive at a time.
+
+  Returns:
+  - acc: A Python float giving the fraction of correctly classified samples.
+  """
+  num = X.shape[0]
+  if chunk_size is None:
+    chunk_size = max(num, 1)
+  num_correct = 0
+  with torch.no_grad():
+    for start in range(0, num, chunk_size):
+      y_pred = pred_func(params, loss_func, X[start:start + chunk_size])
+      num_correct += (y_pred == y[start:start + chunk_size]).sum().item()
+  return num_correct / max(num, 1)
+
 
 def nn_get_search_params():
   """
@@ -351,7 +859,10 @@ def nn_get_search_params():
   # classifier.                                                             #
   ###########################################################################
   # Replace "pass" statement with your code
-  pass
+  learning_rates = [1e-1, 5e-1, 1e0]
+  hidden_sizes = [128, 256]
+  regularization_strengths = [1e-5, 1e-4, 1e-3]
+  learning_rate_decays = [0.9, 0.95]
   ###########################################################################
   #                           END OF YOUR CODE                              #
   ###########################################################################
@@ -359,7 +870,7 @@ def nn_get_search_params():
   return learning_rates, hidden_sizes, regularization_strengths, learning_rate_decays
 
 
-def find_best_net(data_dict, get_param_set_fn):
+def find_best_net(data_dict, get_param_set_fn, num_iters=3000, batch_size=1000):
   """
   Tune hyperparameters using the validation set.
   Store your best trained TwoLayerNet model in best_net, with the return value
@@ -377,6 +888,7 @@ def find_best_net(data_dict, get_param_set_fn):
                                  regularization_strengths, learning_rate_decays)
                                  You should get hyperparameters from
                                  get_param_set_fn.
+  - num_iters, batch_size: Training setup of every candidate.
 
   Returns:
   - best_net (instance): a trained TwoLayerNet instances with
@@ -405,9 +917,167 @@ def find_best_net(data_dict, get_param_set_fn):
   # automatically like we did on the previous exercises.                      #
   #############################################################################
   # Replace "pass" statement with your code
-  pass
+  X_train, y_train = data_dict['X_train'], data_dict['y_train']
+  X_val, y_val = data_dict['X_val'], data_dict['y_val']
+  input_size = X_train.shape[1]
+  num_classes = int(max(y_train.max().item(), y_val.max().item())) + 1
+  for lr, hs, reg, decay in itertools.product(*get_param_set_fn()):
+    net = TwoLayerNet(input_size, hs, num_classes, dtype=X_train.dtype,
+                      device=X_train.device)
+    stat = net.train(X_train, y_train, X_val, y_val,
+                     learning_rate=lr, learning_rate_decay=decay, reg=reg,
+                     num_iters=num_iters, batch_size=batch_size)
+    val_acc = nn_accuracy(net.params, nn_forward_backward,
+                          nn_predict_inference, X_val, y_val)
+    if best_net is None or val_acc > best_val_acc:
+      best_net, best_stat, best_val_acc = net, stat, val_acc
   #############################################################################
   #                               END OF YOUR CODE                            #
   #############################################################################
 
   return best_net, best_stat, best_val_acc
+
+
+_search_data = None
+
+
+def _search_worker_init(data, num_threads):
+  """
+  Pool initializer of find_best_net_parallel: keep the shared training and
+  validation data in a module global of the worker process.
+  """
+  global _search_data
+  _search_data = data
+  if num_threads:
+    torch.set_num_threads(num_threads)
+
+
+def _search_train_chunk(task):
+  """
+  Worker task of find_best_net_parallel: train one candidate for up to one
+  epoch with nn_train, then measure its accuracy on a training minibatch and
+  on the validation set. Returns (params, stat, val_acc).
+  """
+  params, lr, decay, reg, num_steps, batch_size, seed = task
+  X_train, y_train, X_val, y_val = _search_data
+  torch.manual_seed(seed)
+  stat = nn_train(params, nn_forward_backward, nn_predict_inference,
+                  X_train, y_train, X_val, y_val,
+                  learning_rate=lr, learning_rate_decay=decay, reg=reg,
+                  num_iters=num_steps, batch_size=batch_size, eval_every=0)
+  X_batch, y_batch = sample_batch(X_train, y_train, X_train.shape[0], batch_size)
+  train_acc = nn_accuracy(params, nn_forward_backward, nn_predict_inference,
+                          X_batch, y_batch)
+  val_acc = nn_accuracy(params, nn_forward_backward, nn_predict_inference,
+                        X_val, y_val)
+  stat['train_acc_history'].append(train_acc)
+  stat['val_acc_history'].append(val_acc)
+  return params, stat, val_acc
+
+
+def find_best_net_parallel(data_dict, get_param_set_fn, num_iters=3000,
+                           batch_size=1000, num_workers=4, prune_after=2,
+                           prune_margin=0.05, num_threads=1, verbose=False):
+  """
+  Same search as find_best_net, but trains the candidate TwoLayerNets
+  concurrently in a pool of worker processes and stops unpromising
+  candidates early.
+
+  All candidates are trained in lockstep, one epoch at a time. The data is
+  moved to shared CPU memory once and the workers only read from it, so the
+  dataset is never copied; only the parameters of a candidate travel to and
+  from the workers. After prune_after epochs, every candidate whose
+  validation accuracy trails the current leader by more than prune_margin is
+  dropped. The accuracy checks of nn_train are turned off; each worker
+  measures the validation accuracy once at the end of every epoch instead,
+  so pruning sees the current weights.
+
+  Inputs:
+  - data_dict (dict): a dictionary that includes
+                      ['X_train', 'y_train', 'X_val', 'y_val']
+                      as the keys for training a classifier
+  - get_param_set_fn (function): A function that provides the hyperparameters
+                                 (e.g., nn_get_search_params)
+  - num_iters: Number of training iterations for a candidate that is never
+    pruned.
+  - batch_size: Number of training examples to use per step.
+  - num_workers: Number of worker processes, i.e. of candidates that are
+    trained at the same time.
+  - prune_after: Number of epochs every candidate is trained for before any
+    candidate can be pruned.
+  - prune_margin: Candidates whose validation accuracy is lower than the
+    leader's by more than this are pruned.
+  - num_threads: Optional number of torch threads per worker; keeps the
+    workers from oversubscribing the CPU cores. None keeps the default.
+  - verbose: boolean; if true print which candidates are pruned.
+
+  Returns: Same as find_best_net
+  - best_net (instance): the best trained TwoLayerNet instance, on the
+                         device of data_dict['X_train']
+  - best_stat (dict): training statistics of best_net, in the same format as
+                      the return value of "best_net.train()"
+  - best_val_acc (float): validation accuracy of the best_net
+  """
+  device = data_dict['X_train'].device
+  data = tuple(data_dict[k].cpu().share_memory_()
+               for k in ('X_train', 'y_train', 'X_val', 'y_val'))
+  X_train, y_train, X_val, y_val = data
+  num_train, input_size = X_train.shape
+  num_classes = int(max(y_train.max().item(), y_val.max().item())) + 1
+  iterations_per_epoch = max(num_train // batch_size, 1)
+
+  candidates = []
+  for index, (lr, hs, reg, decay) in enumerate(
+      itertools.product(*get_param_set_fn())):
+    net = TwoLayerNet(input_size, hs, num_classes, dtype=X_train.dtype,
+                      device='cpu')
+    candidates.append({
+      'net': net, 'lr': lr, 'hs': hs, 'reg': reg, 'decay': decay,
+      'seed': index, 'iters_done': 0, 'val_acc': 0.0,
+      'stat': {'loss_history': [], 'train_acc_history': [],
+               'val_acc_history': []},
+    })
+
+  def make_task(cand):
+    num_steps = min(iterations_per_epoch, num_iters - cand['iters_done'])
+    epochs_done = cand['iters_done'] // iterations_per_epoch
+    # nn_train decays the learning rate at the start of every epoch, so
+    # resuming at an epoch boundary matches one uninterrupted run.
+    lr = cand['lr'] * cand['decay'] ** epochs_done
+    return (cand['net'].params, lr, cand['decay'], cand['reg'], num_steps,
+            batch_size, cand['seed'] * 100003 + epochs_done)
+
+  active, finished = candidates, []
+  with mp.Pool(num_workers, initializer=_search_worker_init,
+               initargs=(data, num_threads)) as pool:
+    while active:
+      tasks = [make_task(cand) for cand in active]
+      results = pool.map(_search_train_chunk, tasks)
+      for cand, (params, stat, val_acc) in zip(active, results):
+        cand['net'].params = params
+        for k in cand['stat']:
+          cand['stat'][k] += stat[k]
+        cand['iters_done'] += len(stat['loss_history'])
+        cand['val_acc'] = val_acc
+      finished += [c for c in active if c['iters_done'] >= num_iters]
+      active = [c for c in active if c['iters_done'] < num_iters]
+
+      epochs_done = active[0]['iters_done'] // iterations_per_epoch if active else 0
+      if active and epochs_done >= prune_after:
+        leader = max(c['val_acc'] for c in active + finished)
+        pruned = [c for c in active if c['val_acc'] < leader - prune_margin]
+        active = [c for c in active if c['val_acc'] >= leader - prune_margin]
+        if verbose:
+          for c in pruned:
+            print('epoch %d: pruned lr %e hs %d reg %e decay %f (val acc %f, leader %f)'
+                  % (epochs_done, c['lr'], c['hs'], c['reg'], c['decay'],
+                     c['val_acc'], leader))
+
+  best_net, best_stat, best_val_acc = None, None, 0.0
+  for c in finished:
+    if best_net is None or c['val_acc'] > best_val_acc:
+      best_net, best_stat, best_val_acc = c['net'], c['stat'], c['val_acc']
+  if best_net is not None:
+    best_net.params = {k: v.to(device) for k, v in best_net.params.items()}
+
+  return best_net, best_stat, best_val_acc
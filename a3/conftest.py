@@ -0,0 +1,40 @@
+import pytest
+
+
+@pytest.fixture
+def small_data():
+  """
+  Factory for a small random classification set of 3 x 4 x 4 samples
+  (48 features when flattened), in float64 by default.
+  """
+  torch = pytest.importorskip('torch')
+
+  def make(seed=0, dtype=None):
+    dtype = dtype or torch.float64
+    torch.manual_seed(seed)
+    return {
+      'X_train': torch.randn(200, 3, 4, 4, dtype=dtype),
+      'y_train': torch.randint(10, (200,)),
+      'X_val': torch.randn(100, 3, 4, 4, dtype=dtype),
+      'y_val': torch.randint(10, (100,)),
+    }
+  return make
+
+
+@pytest.fixture
+def small_images():
+  """
+  Factory for a small random set of 3 x 8 x 8 images, in float32 by default.
+  """
+  torch = pytest.importorskip('torch')
+
+  def make(seed=0, dtype=None):
+    dtype = dtype or torch.float
+    torch.manual_seed(seed)
+    return {
+      'X_train': torch.randn(64, 3, 8, 8, dtype=dtype),
+      'y_train': torch.randint(10, (64,)),
+      'X_val': torch.randn(32, 3, 8, 8, dtype=dtype),
+      'y_val': torch.randint(10, (32,)),
+    }
+  return make
@@ -4,6 +4,11 @@ WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
 import torch
 import random
+import time
+import copy
+import json
+import threading
+from collections import namedtuple
 from eecs598 import Solver
 from a3_helper import svm_loss, softmax_loss
 from fully_connected_networks import *
@@ -57,7 +62,7 @@ class Conv(object):
     pad = conv_param["pad"]
     stride = conv_param["stride"]
     H_p = 1 + (H + 2 * pad - HH) // stride
-    W_p = 1 + (H + 2 * pad - WW) // stride
+    W_p = 1 + (W + 2 * pad - WW) // stride
 
     out = torch.zeros((N, F, H_p, W_p)).to(x.device).type(x.dtype)
     x_padded = torch.nn.functional.pad(x, (pad, pad, pad, pad)).to(x.device).type(x.dtype)
@@ -107,24 +112,19 @@ class Conv(object):
     dw = torch.zeros_like(w)
     db = torch.zeros_like(b)
 
-    dout_s = None
-    dout_s_p = None
-    new_h = H_p
-    new_w = W_p
     # dilation
-    H_dout_s = new_h = new_h+(H_p-1)*(stride-1)
-    W_dout_s = new_w = new_w+(W_p-1)*(stride-1)
-    dout_s = torch.zeros((N, F, new_h, new_w)).to(dout.device).type(dout.dtype)
-    dout_s[:, :, ::stride, ::stride] = dout 
-
-    if pad > 0:
-      new_h = new_h + pad*2
-      new_w = new_w + pad*2
-      dout_s_p = torch.nn.functional.pad(dout_s, (pad, pad, pad, pad))
-      dout_s_p = dout_s_p.to(dout_s.device).type(dout_s.dtype)
-    else:
-      dout_s_p = dout_s
-    
+    H_dout_s = H_p+(H_p-1)*(stride-1)
+    W_dout_s = W_p+(W_p-1)*(stride-1)
+    dout_s = torch.zeros((N, F, H_dout_s, W_dout_s)).to(dout.device).type(dout.dtype)
+    dout_s[:, :, ::stride, ::stride] = dout
+
+    # dx is the full correlation of the dilated dout with the flipped filters:
+    # pad by HH - 1 - pad on the top / left, and on the bottom / right up to
+    # the input rows / cols that no window reached (negative pads crop)
+    pad_top, pad_left = HH - 1 - pad, WW - 1 - pad
+    pad_bottom, pad_right = H + pad - H_dout_s, W + pad - W_dout_s
+    dout_s_p = torch.nn.functional.pad(dout_s, (pad_left, pad_right, pad_top, pad_bottom))
+
     x_padded = torch.nn.functional.pad(x, (pad, pad, pad, pad)).to(x.device).type(x.dtype)
     w_flipped = w.clone().to(w.device).type(w.dtype) 
     w_flipped = w_flipped.flip(dims=[2, 3]) # 180 deg rotatation
@@ -158,7 +158,9 @@ class MaxPool(object):
   @staticmethod
   def forward(x, pool_param):
     """
-    A naive implementation of the forward pass for a max-pooling layer.
+    A vectorized forward pass for a max-pooling layer. All pooling windows
+    are read through one strided view of x and reduced with a single max;
+    the position of every maximum is kept for the backward pass.
 
     Inputs:
     - x: Input data, of shape (N, C, H, W)
@@ -172,7 +174,10 @@ class MaxPool(object):
     - out: Output data, of shape (N, C, H', W') where H' and W' are given by
       H' = 1 + (H - pool_height) / stride
       W' = 1 + (W - pool_width) / stride
-    - cache: (x, pool_param)
+    - cache: (x_shape, pool_param, max_idx) where max_idx has the shape of
+      out and gives the flat (H * W) index in x of each window maximum.
+
+    A channels-last x gives a channels-last out and max_idx.
     """
     out = None
     #############################################################################
@@ -186,61 +191,58 @@ class MaxPool(object):
 
     H_p = 1 + (H - pool_height) // stride
     W_p = 1 + (W - pool_width) // stride
-    out = torch.zeros((N, C, H_p, W_p)).to(x.device).type(x.dtype)
 
-    for h_p in range(H_p):
-      for w_p in range(W_p):
-        x_h = h_p * stride
-        x_w = w_p * stride
-        window = x[:, :, x_h:x_h+pool_height, x_w:x_w+pool_width].flatten(start_dim=2)
-        out[:, :, h_p, w_p], _ = torch.max(window, dim=2)
+    sN, sC, sH, sW = x.stride()
+    windows = x.as_strided((N, C, H_p, W_p, pool_height, pool_width),
+                           (sN, sC, sH * stride, sW * stride, sH, sW))
+    if is_channels_last(x):
+      # reduce with the channels innermost, so that out stays NHWC
+      windows = windows.permute(0, 2, 3, 4, 5, 1).reshape(N, H_p, W_p, -1, C)
+      out, win_idx = windows.max(dim=3)
+      out, win_idx = out.permute(0, 3, 1, 2), win_idx.permute(0, 3, 1, 2)
+    else:
+      out, win_idx = windows.reshape(N, C, H_p, W_p, -1).max(dim=4)
 
+    # position of the maximum inside its window -> flat index into x
+    rows = torch.arange(H_p, device=x.device).view(H_p, 1) * stride + win_idx // pool_width
+    cols = torch.arange(W_p, device=x.device).view(1, W_p) * stride + win_idx % pool_width
+    max_idx = rows * W + cols
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
-    cache = (x, pool_param)
+    cache = (x.shape, pool_param, max_idx)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
     """
-    A naive implementation of the backward pass for a max-pooling layer.
+    A vectorized backward pass for a max-pooling layer. The upstream
+    derivatives are scattered onto the maxima found in the forward pass with
+    one scatter_add, which also accumulates correctly when windows overlap.
     Inputs:
     - dout: Upstream derivatives
-    - cache: A tuple of (x, pool_param) as in the forward pass.
+    - cache: A tuple of (x_shape, pool_param, max_idx) as in the forward pass.
     Returns:
-    - dx: Gradient with respect to x
+    - dx: Gradient with respect to x, channels-last if dout is.
     """
     dx = None
     #############################################################################
     # TODO: Implement the max-pooling backward pass                             #
     #############################################################################
     # Replace "pass" statement with your code
-    x, pool_param = cache
-    N, C, H, W = x.shape
-    stride = pool_param["stride"]
-    pool_height = pool_param["pool_height"]
-    pool_width = pool_param["pool_width"]
-
-    H_p = 1 + (H - pool_height) // stride
-    W_p = 1 + (W - pool_width) // stride
-
-    dx = torch.zeros_like(x).to(x.device)
-
-    for h_p in range(H_p):
-      for w_p in range(W_p):
-        x_h = h_p * stride
-        x_w = w_p * stride
-        x_window   = x[:, :, x_h:x_h+pool_height, x_w:x_w+pool_width].flatten(start_dim=2)
-        _, max_idx = torch.max(x_window, dim=2)
-        max_idx = max_idx.flatten()
-
-        dx_window = dx[:, :, x_h:x_h+pool_height, x_w:x_w+pool_width]
-        dx_window = dx_window.view(N*C, pool_height, pool_width)
-        row = (max_idx // pool_width)
-        col = (max_idx % pool_width)
-        dx_window[torch.arange(N*C), row, col] = dout[:, :, h_p, w_p].flatten()
-
+    x_shape, pool_param, max_idx = cache
+    N, C, H, W = x_shape
+
+    if is_channels_last(dout):
+      # scatter along the spatial dim of an (N, H * W, C) buffer
+      dx = torch.zeros((N, H * W, C), dtype=dout.dtype, device=dout.device)
+      dx.scatter_add_(1, max_idx.permute(0, 2, 3, 1).reshape(N, -1, C),
+                      dout.permute(0, 2, 3, 1).reshape(N, -1, C))
+      dx = dx.view(N, H, W, C).permute(0, 3, 1, 2)
+    else:
+      dx = torch.zeros((N * C, H * W), dtype=dout.dtype, device=dout.device)
+      dx.scatter_add_(1, max_idx.reshape(N * C, -1), dout.reshape(N * C, -1))
+      dx = dx.view(N, C, H, W)
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
@@ -400,6 +402,101 @@ class ThreeLayerConvNet(object):
 
     return loss, grads
 
+  def predict(self, X, buffers=None):
+    """
+    Forward-only class scores for X, the same as loss(X) but without
+    building backward caches. Pooling is applied before the ReLU, which
+    gives the same result on a 4x smaller tensor. params are only read, so
+    concurrent calls are safe as long as they do not share buffers.
+
+    Inputs:
+    - X: Input data of shape (N, C, H, W)
+    - buffers: Optional dictionary in which the output tensors of the linear
+      layers are kept and reused by later calls with the same N. The
+      returned scores are one of these buffers.
+
+    Returns:
+    - scores: Tensor of shape (N, num_classes)
+    """
+    W1, b1 = self.params['W1'], self.params['b1']
+    W2, b2 = self.params['W2'], self.params['b2']
+    W3, b3 = self.params['W3'], self.params['b3']
+    pad = (W1.shape[2] - 1) // 2
+    N = X.shape[0]
+    if buffers is None:
+      buffers = {}
+    hidden = buffers.get('hidden')
+    if hidden is None or hidden.shape[0] != N:
+      hidden = buffers['hidden'] = W2.new_empty((N, W2.shape[1]))
+      buffers['scores'] = W3.new_empty((N, W3.shape[1]))
+    scores = buffers['scores']
+
+    with torch.no_grad():
+      a = torch.nn.functional.conv2d(X.to(self.dtype), W1, b1, padding=pad)
+      a = torch.nn.functional.max_pool2d(a, 2, stride=2).relu_()
+      torch.addmm(b2, a.reshape(N, -1), W2, out=hidden).relu_()
+      torch.addmm(b3, hidden, W3, out=scores)
+    return scores
+
+
+class InferenceServer(object):
+  """
+  Thread-safe batched inference for a ThreeLayerConvNet.
+
+  Requests are padded up to the smallest bucket size that fits them
+  (larger requests are split into chunks of the largest bucket). Every
+  bucket owns an input buffer of the model dtype, which the request is
+  copied (and cast) into, and the predict buffers of the model, so steady
+  state serving allocates only the conv activations. A lock per bucket lets
+  requests of different sizes run concurrently from several threads.
+  """
+
+  def __init__(self, model, buckets=(1, 8, 32, 128)):
+    """
+    Inputs:
+    - model: A trained ThreeLayerConvNet
+    - buckets: Batch sizes that requests are padded to
+    """
+    self.model = model
+    self.buckets = sorted(buckets)
+    self.slots = {b: (threading.Lock(), {}) for b in self.buckets}
+
+  def predict(self, X):
+    """
+    Returns the class scores of X, of shape (N, num_classes).
+    """
+    N = X.shape[0]
+    W3 = self.model.params['W3']
+    out = W3.new_empty((N, W3.shape[1]))
+    largest = self.buckets[-1]
+    for start in range(0, N, largest):
+      chunk = X[start:start + largest]
+      n = chunk.shape[0]
+      bucket = next(b for b in self.buckets if b >= n)
+      lock, buffers = self.slots[bucket]
+      with lock:
+        inp = buffers.get('input')
+        if inp is None or inp.shape[1:] != chunk.shape[1:]:
+          inp = buffers['input'] = W3.new_zeros((bucket,) + tuple(chunk.shape[1:]))
+        inp[:n].copy_(chunk)
+        scores = self.model.predict(inp, buffers)
+        out[start:start + n] = scores[:n]
+    return out
+
+  def classify(self, X):
+    """
+    Returns the predicted labels of X, of shape (N,).
+    """
+    return self.predict(X).argmax(dim=1)
+
+def _dtype_name(dtype):
+  """
+  Name of a torch.dtype in the torch namespace, e.g. 'float16', so that
+  getattr(torch, name) gives it back.
+  """
+  return str(dtype).split('.')[-1]
+
+
 class DeepConvNet(object):
   """
   A convolutional neural network with an arbitrary number of convolutional
@@ -427,7 +524,8 @@ class DeepConvNet(object):
                batchnorm=False,
                num_classes=10, weight_scale=1e-3, reg=0.0,
                weight_initializer=None,
-               dtype=torch.float, device='cpu'):
+               dtype=torch.float, device='cpu', checkpoint_every=None,
+               conv_engines=None, channels_last=False, amp_dtype=None):
     """
     Initialize a new network.
 
@@ -448,9 +546,31 @@ class DeepConvNet(object):
       this datatype. float is faster but less accurate, so you should use
       double for numeric gradient checking.
     - device: device to use for computation. 'cpu' or 'cuda'    
+    - checkpoint_every: Optional activation checkpointing policy; same as
+      for FullyConnectedNet, counted in macro layers.
+    - conv_engines: Optional convolution engine (a key of CONV_ENGINES) for
+      every macro layer; either one name for all layers or a list of length
+      (L - 1). Defaults to 'fast'. 'fft' cannot be combined with amp_dtype.
+    - channels_last: If True, the conv weights, the input and every
+      activation and cache are kept in NHWC (torch.channels_last) order. The
+      'fast' and 'im2col' engines, the pooling layers and spatial batchnorm
+      preserve this layout, so no layer converts it back to NCHW.
+    - amp_dtype: Optional low-precision dtype (torch.bfloat16 or
+      torch.float16) for mixed precision training. The convolutions, the
+      activations and the caches use amp_dtype, while params (the master
+      weights), the batchnorm statistics, the loss and the gradients keep
+      dtype. Train with AmpSolver for dynamic loss scaling.
     """
     self.params = {}
     self.num_layers = len(num_filters)+1
+    self.checkpoint_every = checkpoint_every
+    if conv_engines is None or isinstance(conv_engines, str):
+      conv_engines = [conv_engines or 'fast'] * len(num_filters)
+    self.conv_engines = list(conv_engines)
+    if amp_dtype is not None and 'fft' in self.conv_engines:
+      raise ValueError("the 'fft' conv engine does not support amp_dtype")
+    self.channels_last = channels_last
+    self.amp_dtype = amp_dtype
     self.max_pools = max_pools
     self.batchnorm = batchnorm
     self.reg = reg
@@ -535,6 +655,11 @@ class DeepConvNet(object):
     msg = msg % (len(self.params), num_params)
     assert len(self.params) == num_params, msg
 
+    if self.channels_last:
+      for i in range(1, self.num_layers):
+        self.params[f'W{i}'] = self.params[f'W{i}'].contiguous(
+          memory_format=torch.channels_last)
+
     # Check that all parameters have the correct device and dtype:
     for k, param in self.params.items():
       msg = 'param "%s" has device %r; should be %r' % (k, param.device, device)
@@ -578,13 +703,289 @@ class DeepConvNet(object):
 
     print("load checkpoint file: {}".format(path))
 
+  def save_sharded(self, path, shard_bytes=64 * 2 ** 20, background=False):
+    """
+    Save the model as a sharded checkpoint directory, optionally from a
+    background thread; see save_sharded_checkpoint. The running statistics
+    of the batchnorm layers are stored as tensors, the other bn_params
+    entries in the index; dtypes (amp_dtype, a bn_param cache_dtype) are
+    stored by name.
+    """
+    tensors = {'params/' + k: v for k, v in self.params.items()}
+    bn_params, bn_dtypes = [], []
+    for i, bn_param in enumerate(self.bn_params):
+      bn_params.append({})
+      bn_dtypes.append({})
+      for k, v in bn_param.items():
+        if torch.is_tensor(v):
+          tensors['bn_params/%d/%s' % (i, k)] = v
+        elif isinstance(v, torch.dtype):
+          bn_dtypes[i][k] = _dtype_name(v)
+        else:
+          bn_params[i][k] = v
+    meta = {
+      'reg': self.reg,
+      'num_layers': self.num_layers,
+      'max_pools': self.max_pools,
+      'batchnorm': self.batchnorm,
+      'bn_params': bn_params,
+      'bn_dtypes': bn_dtypes,
+      'conv_engines': self.conv_engines,
+      'channels_last': self.channels_last,
+      'amp_dtype': self.amp_dtype and _dtype_name(self.amp_dtype),
+    }
+    return save_sharded_checkpoint(path, meta, tensors, shard_bytes, background)
 
-  def loss(self, X, y=None):
+  def load_sharded(self, path, dtype, device):
+    """
+    Load a checkpoint written by save_sharded, tensor by tensor, straight
+    into dtype on device; see load_sharded_checkpoint.
+    """
+    meta, tensors = load_sharded_checkpoint(path, dtype, device)
+    self.dtype = dtype
+    self.reg = meta['reg']
+    self.num_layers = meta['num_layers']
+    self.max_pools = meta['max_pools']
+    self.batchnorm = meta['batchnorm']
+    self.bn_params = meta['bn_params']
+    for bn_param, dtypes in zip(self.bn_params, meta['bn_dtypes']):
+      for k, name in dtypes.items():
+        bn_param[k] = getattr(torch, name)
+    self.conv_engines = meta['conv_engines']
+    self.channels_last = meta['channels_last']
+    self.amp_dtype = meta['amp_dtype'] and getattr(torch, meta['amp_dtype'])
+    self.params = {}
+    for k, v in tensors.items():
+      group, _, name = k.partition('/')
+      if group == 'params':
+        self.params[name] = v
+      else:
+        i, key = name.split('/')
+        self.bn_params[int(i)][key] = v
+    if self.channels_last:
+      for i in range(1, self.num_layers):
+        self.params[f'W{i}'] = self.params[f'W{i}'].contiguous(
+          memory_format=torch.channels_last)
+    print("load checkpoint file: {}".format(path))
+
+
+  def fold_batchnorm(self, X_check=None):
+    """
+    Export an inference-only copy of this network with every batchnorm layer
+    folded into the preceding convolution. In test mode batchnorm is the
+    affine map y = gamma * (x - running_mean) / sqrt(running_var + eps) + beta
+    so it can be absorbed by scaling each filter and shifting its bias:
+
+    W' = W * scale, b' = (b - running_mean) * scale + beta,
+    where scale = gamma / sqrt(running_var + eps)
+
+    The returned model has batchnorm=False, so its loss(X) runs only
+    conv - relu - [pool] macro layers followed by the linear layer.
+
+    Inputs:
+    - X_check: Optional batch of inputs. If given, the test-time scores of
+      the folded model are checked against those of this model, and a
+      RuntimeError is raised if they differ.
+
+    Returns:
+    - folded: A new DeepConvNet whose params do not share storage with self.
+    """
+    folded = copy.copy(self)
+    folded.params = {k: v.clone() for k, v in self.params.items()
+                     if not k.startswith(('gamma', 'beta'))}
+    folded.batchnorm = False
+    folded.bn_params = []
+    if not self.batchnorm:
+      return folded
+
+    for i in range(1, self.num_layers):
+      bn_param = self.bn_params[i-1]
+      if 'running_mean' not in bn_param:
+        raise ValueError('batchnorm layer %d has no running statistics; '
+                         'train the model before folding it' % i)
+      eps = bn_param.get('eps', 1e-5)
+      scale = self.params[f'gamma{i}'] * torch.rsqrt(bn_param['running_var'] + eps)
+      folded.params[f'W{i}'] = self.params[f'W{i}'] * scale.view(-1, 1, 1, 1)
+      folded.params[f'b{i}'] = ((self.params[f'b{i}'] - bn_param['running_mean'])
+                                * scale + self.params[f'beta{i}'])
+
+    if X_check is not None:
+      expected = self.loss(X_check)
+      scores = folded.loss(X_check)
+      err = ((scores - expected).abs().max() / expected.abs().max().clamp(min=1e-12)).item()
+      tol = 1e-10 if self.dtype == torch.float64 else 1e-4
+      if not err < tol:
+        raise RuntimeError('folded scores differ from the original model '
+                           '(relative error %e)' % err)
+
+    return folded
+
+
+  def quantize(self, X_calib):
+    """
+    Post-training quantization: export an int8 inference copy of this
+    network. Batchnorm is folded into the convolutions first. The weights of
+    every conv and of the linear layer are quantized symmetrically with one
+    scale per output channel; the input of every layer gets one scale,
+    calibrated from its largest magnitude while X_calib runs through the
+    float model.
+
+    Inputs:
+    - X_calib: A representative batch of inputs, of shape (N, C, H, W)
+
+    Returns:
+    - A QuantizedDeepConvNet
+    """
+    folded = self.fold_batchnorm()
+    folded.amp_dtype = None
+    conv_param = {'stride': 1, 'pad': 1}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+    # largest magnitude of the input of each layer, from the float model
+    in_max = []
+    x = X_calib.to(self.dtype)
+    with torch.no_grad():
+      for i in range(1, self.num_layers):
+        in_max.append(x.abs().max().item())
+        x, _ = folded._forward_layer(i, x, conv_param, pool_param)
+      in_max.append(x.abs().max().item())
+    return QuantizedDeepConvNet(folded, in_max)
+
+  def prune_channels(self, amount=0.25, criterion='l1'):
+    """
+    Structured channel pruning: export a smaller copy of this network with
+    the lowest-ranked filters of every conv layer removed. Filters are
+    ranked by the L1 norm of their weights ('l1') or by the magnitude of
+    the batchnorm scale gamma that follows them ('gamma'). The matching
+    bias, batchnorm parameters and running statistics are removed with
+    them, as are the input channels of the next conv layer or, after the
+    last conv layer, the rows of the final linear layer. Train the result
+    with a new Solver to fine-tune it.
+
+    Inputs:
+    - amount: Fraction of the filters to remove, either for every conv
+      layer or a list with one fraction per conv layer
+    - criterion: 'l1' or 'gamma'; 'gamma' needs batchnorm
+
+    Returns:
+    - pruned: A new DeepConvNet whose params do not share storage with self.
+    """
+    if criterion not in ('l1', 'gamma'):
+      raise ValueError('Invalid pruning criterion "%s"' % criterion)
+    if criterion == 'gamma' and not self.batchnorm:
+      raise ValueError("criterion 'gamma' needs a network with batchnorm")
+    L = self.num_layers
+    if not isinstance(amount, (list, tuple)):
+      amount = [amount] * (L - 1)
+
+    pruned = copy.copy(self)
+    pruned.params = {}
+    pruned.bn_params = [dict(bn_param) for bn_param in self.bn_params]
+    names = ['b', 'beta', 'gamma'] if self.batchnorm else ['b']
+    keep = None
+    for i in range(1, L):
+      W = self.params[f'W{i}']
+      if keep is not None:
+        W = W[:, keep]
+      F = W.shape[0]
+      if criterion == 'l1':
+        score = W.abs().sum(dim=(1, 2, 3))
+      else:
+        score = self.params[f'gamma{i}'].abs()
+      num_keep = max(1, F - int(round(amount[i-1] * F)))
+      keep = score.topk(num_keep).indices.sort().values
+
+      W = W[keep]
+      if self.channels_last:
+        W = W.contiguous(memory_format=torch.channels_last)
+      pruned.params[f'W{i}'] = W
+      for name in names:
+        pruned.params[f'{name}{i}'] = self.params[f'{name}{i}'][keep]
+      if self.batchnorm:
+        bn_param = pruned.bn_params[i-1]
+        for k in ('running_mean', 'running_var'):
+          if k in bn_param:
+            bn_param[k] = bn_param[k][keep]
+
+    # rows of the linear weight are ordered (C, H, W)
+    W = self.params[f'W{L}']
+    F = self.params[f'W{L-1}'].shape[0]
+    pruned.params[f'W{L}'] = W.view(F, -1, W.shape[1])[keep].reshape(-1, W.shape[1])
+    pruned.params[f'b{L}'] = self.params[f'b{L}'].clone()
+    return pruned
+
+  def flops(self, input_dims):
+    """
+    Number of floating point operations (2 per multiply-add) of the conv and
+    linear layers for one input image of shape input_dims = (C, H, W).
+    """
+    _, H, W = input_dims
+    total = 0
+    for i in range(1, self.num_layers):
+      F, C, HH, WW = self.params[f'W{i}'].shape
+      total += 2 * F * C * HH * WW * H * W
+      if i-1 in self.max_pools:
+        H //= 2
+        W //= 2
+    D, K = self.params[f'W{self.num_layers}'].shape
+    return total + 2 * D * K
+
+  def _forward_layer(self, i, x, conv_param, pool_param, recompute=False):
+    """
+    Forward pass of macro layer i; returns (out, cache). When recompute is
+    True (activation checkpointing runs the layer again during backward) the
+    batchnorm layer gets a copy of its bn_param, so the running statistics
+    are not updated twice.
+    """
+    compute_dtype = self.amp_dtype or self.dtype
+    W = self.params[f'W{i}'].to(compute_dtype)
+    b = self.params[f'b{i}'].to(compute_dtype)
+    conv_param = dict(conv_param, engine=self.conv_engines[i-1])
+    if self.batchnorm:
+      gamma = self.params[f'gamma{i}']
+      beta = self.params[f'beta{i}']
+      bn_param = self.bn_params[i-1]
+      if recompute:
+        bn_param = dict(bn_param)
+
+    if i-1 in self.max_pools:
+      if self.batchnorm:
+        return Conv_BatchNorm_ReLU_Pool.forward(x, W, b, gamma, beta,
+          conv_param, bn_param, pool_param)
+      return Conv_ReLU_Pool.forward(x, W, b, conv_param, pool_param)
+    if self.batchnorm:
+      return Conv_BatchNorm_ReLU.forward(x, W, b, gamma, beta, conv_param, bn_param)
+    return Conv_ReLU.forward(x, W, b, conv_param)
+
+  def _backward_layer(self, i, dout, cache, grads):
+    """
+    Backward pass of macro layer i; stores the parameter gradients of the
+    layer in grads and returns the gradient with respect to its input.
+    """
+    if i-1 in self.max_pools:
+      if self.batchnorm:
+        dx, grads[f'W{i}'], grads[f'b{i}'], grads[f'gamma{i}'], grads[f'beta{i}'] = Conv_BatchNorm_ReLU_Pool.backward(dout, cache)
+      else:
+        dx, grads[f'W{i}'], grads[f'b{i}'] = Conv_ReLU_Pool.backward(dout, cache)
+    else:
+      if self.batchnorm:
+        dx, grads[f'W{i}'], grads[f'b{i}'], grads[f'gamma{i}'], grads[f'beta{i}'] = Conv_BatchNorm_ReLU.backward(dout, cache)
+      else:
+        dx, grads[f'W{i}'], grads[f'b{i}'] = Conv_ReLU.backward(dout, cache)
+    return dx
+
+  def loss(self, X, y=None, loss_scale=1.0):
     """
     Evaluate loss and gradient for the deep convolutional network.
-    Input / output: Same API as ThreeLayerConvNet.
+    Input / output: Same API as ThreeLayerConvNet, plus
+    - loss_scale: Factor for the upstream gradient of the backward pass;
+      the returned gradients are unscaled again, and contain inf or nan if
+      the backward pass overflowed.
     """
-    X = X.to(self.dtype)
+    compute_dtype = self.amp_dtype or self.dtype
+    X = X.to(compute_dtype)
+    if self.channels_last:
+      X = X.contiguous(memory_format=torch.channels_last)
     mode = 'test' if y is None else 'train'
 
     # Set train/test mode for batchnorm params since they
@@ -614,34 +1015,28 @@ class DeepConvNet(object):
     caches = {}
     layer = {}
     layer[0] = X
-    for i in range(1, self.num_layers):
-      W = self.params[f'W{i}']
-      b = self.params[f'b{i}']
-      X_input = layer[i-1]
-      beta = gamma = None
-      if self.batchnorm:
-        gamma = self.params[f'gamma{i}']
-        beta = self.params[f'beta{i}']
-        bn_param = self.bn_params[i-1]
-
-      if i-1 in self.max_pools:
-        if self.batchnorm:
-          layer[i], caches[i] = Conv_BatchNorm_ReLU_Pool.forward(X_input, W, b, gamma, beta, 
-          conv_param, bn_param, pool_param)
-        else:
-          layer[i], caches[i] = Conv_ReLU_Pool.forward(X_input, W, b, conv_param, pool_param)
-      else:
-        if self.batchnorm:
-          layer[i], caches[i] = Conv_BatchNorm_ReLU.forward(X_input, W, b, gamma, beta, 
-          conv_param, bn_param)
-        else:
-          layer[i], caches[i] = Conv_ReLU.forward(X_input, W, b, conv_param)
-        
-
-    W = self.params[f'W{self.num_layers}']
-    b = self.params[f'b{self.num_layers}']
-
-    scores, caches[self.num_layers] = Linear.forward(layer[self.num_layers-1], W, b)
+    forward_layer = lambda i, x, recompute=False: self._forward_layer(
+      i, x, conv_param, pool_param, recompute)
+    checkpoint_every = checkpoint_interval(self.checkpoint_every, self.num_layers)
+    if mode == 'train' and checkpoint_every:
+      layer[self.num_layers-1], checkpoints = checkpointed_forward(
+        forward_layer, X, self.num_layers, checkpoint_every)
+    else:
+      for i in range(1, self.num_layers):
+        layer[i], caches[i] = forward_layer(i, layer[i-1])
+
+    W = self.params[f'W{self.num_layers}'].to(compute_dtype)
+    b = self.params[f'b{self.num_layers}'].to(compute_dtype)
+    x = layer[self.num_layers-1]
+    if self.channels_last:
+      # flatten in (H, W, C) order, which is a view of an NHWC activation,
+      # and permute the rows of the (much smaller) linear weight to match
+      N, C, H, Wd = x.shape
+      x = x.permute(0, 2, 3, 1).reshape(N, -1)
+      W = W.view(C, H, Wd, -1).permute(1, 2, 0, 3).reshape(C * H * Wd, -1)
+
+    scores, caches[self.num_layers] = Linear.forward(x, W, b)
+    scores = scores.to(self.dtype)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -662,22 +1057,31 @@ class DeepConvNet(object):
     ############################################################################
     # Replace "pass" statement with your code
     loss, dout = softmax_loss(scores, y)
+    if loss_scale != 1.0:
+      # keeps small activation gradients above the float16 underflow
+      # threshold while the backward pass runs in amp_dtype
+      dout = dout * loss_scale
+    dout = dout.to(compute_dtype)
     dx = {}
     W = f'W{self.num_layers}'
     b = f'b{self.num_layers}'
     dx[self.num_layers], grads[W], grads[b] = Linear.backward(dout, caches[self.num_layers])
-    for i in reversed(range(1, self.num_layers)):
-      if i-1 in self.max_pools:
-        if self.batchnorm:
-          dx[i], grads[f'W{i}'], grads[f'b{i}'], grads[f'gamma{i}'], grads[f'beta{i}'] = Conv_BatchNorm_ReLU_Pool.backward(dx[i+1], caches[i])
-        else:
-          dx[i], grads[f'W{i}'], grads[f'b{i}'] = Conv_ReLU_Pool.backward(dx[i+1], caches[i])
-      else:
-        if self.batchnorm:
-          dx[i], grads[f'W{i}'], grads[f'b{i}'], grads[f'gamma{i}'], grads[f'beta{i}'] = Conv_BatchNorm_ReLU.backward(dx[i+1], caches[i])
-        else:
-          dx[i], grads[f'W{i}'], grads[f'b{i}'] = Conv_ReLU.backward(dx[i+1], caches[i])
-    
+    if self.channels_last:
+      dx[self.num_layers] = dx[self.num_layers].view(N, H, Wd, C).permute(0, 3, 1, 2)
+      grads[W] = grads[W].view(H, Wd, C, -1).permute(2, 0, 1, 3).reshape(C * H * Wd, -1)
+    if checkpoint_every:
+      dx[1] = checkpointed_backward(forward_layer, self._backward_layer,
+                                    dx[self.num_layers], checkpoints,
+                                    self.num_layers, grads)
+    else:
+      for i in reversed(range(1, self.num_layers)):
+        dx[i] = self._backward_layer(i, dx[i+1], caches[i], grads)
+
+    for k, grad in grads.items():
+      grads[k] = grad.to(self.dtype)
+      if loss_scale != 1.0:
+        grads[k] /= loss_scale
+
     for i in range(1, self.num_layers + 1):
       W = self.params[f'W{i}'] 
       loss += 0.5 * self.reg * torch.sum(W * W)
@@ -704,7 +1108,12 @@ def find_overfit_parameters():
   return weight_scale, learning_rate
 
 
-def create_convolutional_solver_instance(data_dict, dtype, device):
+def create_convolutional_solver_instance(data_dict, dtype, device, prefetch=False):
+  """
+  Inputs:
+  - prefetch: If True, train with a PrefetchSolver, which prepares randomly
+    cropped and flipped minibatches in background worker processes.
+  """
   model = None
   solver = None
   ################################################################################
@@ -718,7 +1127,8 @@ def create_convolutional_solver_instance(data_dict, dtype, device):
                          weight_scale='kaiming',
                          batchnorm=True,
                          reg=1e-4, dtype=dtype, device=device)
-  solver = Solver(bn_model, data_dict,
+  solver_class = PrefetchSolver if prefetch else Solver
+  solver = solver_class(bn_model, data_dict,
                      num_epochs=3, batch_size=128,
                      update_rule=adam,
                      optim_config={
@@ -732,6 +1142,56 @@ def create_convolutional_solver_instance(data_dict, dtype, device):
   ################################################################################
   return solver
 
+class AmpSolver(BatchSolver):
+  """
+  A Solver with dynamic loss scaling for mixed precision models, such as a
+  DeepConvNet with amp_dtype, whose loss(X, y, loss_scale) returns unscaled
+  gradients that are non-finite when the low-precision backward pass
+  overflowed. Such steps are skipped and the loss scale is halved; after
+  growth_interval consecutive good steps it is doubled, up to 2 ** 24.
+
+  Extra arguments:
+  - loss_scale: Initial loss scale. Defaults to 2 ** 16 for float16 models
+    and 1 otherwise.
+  - growth_interval: Number of good steps between loss scale increases.
+
+  Only the loss computation hook of BatchSolver is overridden, so AmpSolver
+  combines with solvers that override the batch fetch, e.g.
+  class PrefetchAmpSolver(PrefetchSolver, AmpSolver).
+  """
+
+  def __init__(self, model, data, loss_scale=None, growth_interval=1000, **kwargs):
+    super().__init__(model, data, **kwargs)
+    if loss_scale is None:
+      # bfloat16 has the range of float32; only float16 gradients underflow
+      loss_scale = 2.0 ** 16 if getattr(model, 'amp_dtype', None) == torch.float16 else 1.0
+    self.loss_scale = loss_scale
+    self.growth_interval = growth_interval
+    self.good_steps = 0
+    self.num_skipped_steps = 0
+    self.loss_scale_history = []
+
+  def _loss_and_grads(self, X_batch, y_batch):
+    """
+    Returns (loss, grads) computed with the current loss scale, or
+    (loss, None) to skip the update if the gradients overflowed.
+    """
+    loss, grads = self.model.loss(X_batch, y_batch, loss_scale=self.loss_scale)
+    self.loss_scale_history.append(self.loss_scale)
+
+    finite = torch.stack([torch.isfinite(g).all() for g in grads.values()]).all()
+    if not finite.item():
+      self.num_skipped_steps += 1
+      self.good_steps = 0
+      self.loss_scale /= 2
+      return loss, None
+
+    self.good_steps += 1
+    if self.good_steps % self.growth_interval == 0:
+      self.loss_scale = min(self.loss_scale * 2, 2.0 ** 24)
+    return loss, grads
+
+
 def kaiming_initializer(Din, Dout, K=None, relu=True, device='cpu',
                         dtype=torch.float32):
   """
@@ -823,10 +1283,13 @@ class BatchNorm(object):
       - momentum: Constant for running mean / variance.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+      - cache_dtype: Optional dtype (e.g. torch.float16) used to store the
+        normalized input in the cache, to save memory in training.
 
     Returns a tuple of:
     - out: of shape (N, D)
-    - cache: A tuple of values needed in the backward pass
+    - cache: A tuple (x_hat, inv_std, gamma) of the normalized input, the
+      inverse standard deviation of each feature, and the scale parameter.
     """
     mode = bn_param['mode']
     eps = bn_param.get('eps', 1e-5)
@@ -860,14 +1323,18 @@ class BatchNorm(object):
       # might prove to be helpful.                                          #
       #######################################################################
       # Replace "pass" statement with your code
-      sample_mean = x.t().mean(dim=1) # D 
-      sample_var = (x - sample_mean).pow(2).t().mean(dim=1) # D
-      out = ((x - sample_mean) / torch.sqrt(sample_var+eps)) * gamma + beta # N * D
+      sample_mean = x.mean(dim=0) # D
+      x_hat = x - sample_mean # N * D
+      sample_var = x_hat.pow(2).mean(dim=0) # D
+      inv_std = torch.rsqrt(sample_var + eps) # D
+      x_hat *= inv_std
+      out = torch.addcmul(beta, x_hat, gamma) # N * D
 
       running_mean = momentum * running_mean + (1 - momentum) * sample_mean
       running_var = momentum * running_var + (1 - momentum) * sample_var
 
-      cache = (x, bn_param, gamma)
+      cache_dtype = bn_param.get('cache_dtype', x.dtype)
+      cache = (x_hat.to(cache_dtype), inv_std, gamma)
       #######################################################################
       #                           END OF YOUR CODE                          #
       #######################################################################
@@ -919,23 +1386,15 @@ class BatchNorm(object):
     # Don't forget to implement train and test mode separately.               #
     ###########################################################################
     # Replace "pass" statement with your code
-    dbeta = dout.t().sum(dim=1)
-    
-    x, bn_param, gamma = cache
-    N, D = x.shape
-    eps = bn_param.get('eps', 1e-5)
-    sample_mean = x.t().mean(dim=1) # D 
-    sample_var = (x - sample_mean).pow(2).t().mean(dim=1) # D
-    x_hat = (x - sample_mean) / torch.sqrt(sample_var+eps)
-    dgamma = (x_hat * dout).t().sum(dim=1) # D
+    x_hat, inv_std, gamma = cache
+    x_hat = x_hat.to(dout.dtype)
+    N = x_hat.shape[0]
+    dbeta = dout.sum(dim=0) # D
+    dgamma = (x_hat * dout).sum(dim=0) # D
 
     # derivation acknowledgement : https://kevinzakka.github.io/2016/09/14/batch_normalization/
-    dx_hat = gamma * dout
-    term1 = N * dx_hat 
-    term2 = dx_hat.t().sum(dim=1)
-    term3 = x_hat * (x_hat * dx_hat).t().sum(dim=1)
-    term4 = N * torch.sqrt(sample_var+eps)
-    dx = (term1 - term2 - term3) / term4
+    # dx = gamma / (N * std) * (N * dout - sum(dout) - x_hat * sum(x_hat * dout))
+    dx = (gamma * inv_std / N) * (N * dout - dbeta - x_hat * dgamma)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -966,31 +1425,15 @@ class BatchNorm(object):
     # single statement; our implementation fits on a single 80-character line.#
     ###########################################################################
     # Replace "pass" statement with your code
-    dbeta = dout.t().sum(dim=1)
-    
-    x, bn_param, gamma = cache
-    N, D = x.shape
-    eps = bn_param.get('eps', 1e-5)
-    sample_mean = x.t().mean(dim=1) # D 
-    var = (x - sample_mean).pow(2).t().mean(dim=1) # D
-    x_hat = (x - sample_mean) / torch.sqrt(var+eps)
-    dgamma = (x_hat * dout).t().sum(dim=1) # D
-
-    # local gradients
-    dy_du = -1 / torch.sqrt(var+eps)
-    dvar_du = -2 * (x - sample_mean).t().mean(dim=1)
-    dy_dstd = (sample_mean - x) / (var+eps)
-    dstd_dvar = 1 / (2 * torch.sqrt(var+eps))
-    dy_dx = 1 / torch.sqrt(var+eps)
-    dvar_dx = (2 / N) * (x - sample_mean)
-    du_dx = 1 / N
-
-    dl_dy = gamma * dout # N * D 
-    dl_dstd = (dl_dy * dy_dstd).t().sum(dim=1) # D
-    dl_dvar = dl_dstd * dstd_dvar # D
-    dl_du = dl_dvar * dvar_du + (dl_dy * dy_du).t().sum(dim=1) # D
-    dl_dx = dx = dl_du * du_dx + dl_dvar * dvar_dx + dl_dy * dy_dx # N * D
-
+    x_hat, inv_std, gamma = cache
+    x_hat = x_hat.to(dout.dtype)
+    dbeta = dout.sum(dim=0) # D
+    dgamma = (x_hat * dout).sum(dim=0) # D
+
+    # with dx_hat = gamma * dout, the gradient through the batch statistics
+    # reduces to dx = (dx_hat - mean(dx_hat) - x_hat * mean(dx_hat * x_hat)) / std
+    dx_hat = gamma * dout # N * D
+    dx = inv_std * (dx_hat - dx_hat.mean(dim=0) - x_hat * (dx_hat * x_hat).mean(dim=0))
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -1005,6 +1448,13 @@ class SpatialBatchNorm(object):
     """
     Computes the forward pass for spatial batch normalization.
 
+    The statistics are reduced over dims (0, 2, 3) of x directly and the
+    per-channel parameters are broadcast as (1, C, 1, 1), so x is never
+    permuted or flattened into another layout; a channels-last x gives a
+    channels-last out and x_hat. If x has a lower precision than gamma (mixed
+    precision training), the statistics and the affine transform are
+    computed in the dtype of gamma, while out and x_hat keep the dtype of x.
+
     Inputs:
     - x: Input data of shape (N, C, H, W)
     - gamma: Scale parameter, of shape (C,)
@@ -1018,10 +1468,12 @@ class SpatialBatchNorm(object):
       default of momentum=0.9 should work well in most situations.
       - running_mean: Array of shape (C,) giving running mean of features
       - running_var Array of shape (C,) giving running variance of features
+      - cache_dtype: Optional dtype used to store x_hat in the cache.
 
     Returns a tuple of:
     - out: Output data, of shape (N, C, H, W)
-    - cache: Values needed for the backward pass
+    - cache: Values needed for the backward pass; (x_hat, inv_std, gamma)
+      as in BatchNorm.forward, with x_hat of shape (N, C, H, W).
     """
     out, cache = None, None
 
@@ -1033,10 +1485,45 @@ class SpatialBatchNorm(object):
     # Your implementation should be very short; ours is less than five lines. #
     ###########################################################################
     # Replace "pass" statement with your code
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+    x_dtype = x.dtype
+    x = x.to(gamma.dtype)
+
     N, C, H, W = x.shape
-    x_p = x.permute(1, 0, 2, 3).flatten(start_dim=1).t() # (N*H*W) X C => N X D
-    x_bn, cache = BatchNorm.forward(x_p, gamma, beta, bn_param)
-    out = x_bn.t().view(C, N, H, W).permute(1, 0, 2, 3)
+    shape = (1, C, 1, 1)
+    if 'running_mean' not in bn_param:
+      bn_param['running_mean'] = torch.zeros(C, dtype=x.dtype, device=x.device)
+    if 'running_var' not in bn_param:
+      bn_param['running_var'] = torch.zeros(C, dtype=x.dtype, device=x.device)
+    running_mean = bn_param['running_mean']
+    running_var = bn_param['running_var']
+
+    if mode == 'train':
+      sample_mean = x.mean(dim=(0, 2, 3)) # C
+      x_hat = x - sample_mean.view(shape)
+      sample_var = x_hat.pow(2).mean(dim=(0, 2, 3)) # C
+      inv_std = torch.rsqrt(sample_var + eps) # C
+      x_hat *= inv_std.view(shape)
+      out = torch.addcmul(beta.view(shape), x_hat, gamma.view(shape))
+
+      running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+      running_var = momentum * running_var + (1 - momentum) * sample_var
+
+      cache_dtype = bn_param.get('cache_dtype', x_dtype)
+      cache = (x_hat.to(cache_dtype), inv_std, gamma)
+    elif mode == 'test':
+      # fold the running statistics into one scale and shift per channel
+      scale = gamma * torch.rsqrt(running_var + eps)
+      shift = beta - running_mean * scale
+      out = torch.addcmul(shift.view(shape), x, scale.view(shape))
+    else:
+      raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    out = out.to(x_dtype)
+    bn_param['running_mean'] = running_mean.detach()
+    bn_param['running_var'] = running_var.detach()
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -1051,7 +1538,8 @@ class SpatialBatchNorm(object):
     - dout: Upstream derivatives, of shape (N, C, H, W)
     - cache: Values from the forward pass
     Returns a tuple of:
-    - dx: Gradient with respect to inputs, of shape (N, C, H, W)
+    - dx: Gradient with respect to inputs, of shape (N, C, H, W) and of the
+      dtype of dout
     - dgamma: Gradient with respect to scale parameter, of shape (C,)
     - dbeta: Gradient with respect to shift parameter, of shape (C,)
     """
@@ -1065,10 +1553,18 @@ class SpatialBatchNorm(object):
     # Your implementation should be very short; ours is less than five lines. #
     ###########################################################################
     # Replace "pass" statement with your code
+    x_hat, inv_std, gamma = cache
+    dout_dtype = dout.dtype
+    dout = dout.to(gamma.dtype)
+    x_hat = x_hat.to(dout.dtype)
     N, C, H, W = dout.shape
-    dout_p = dout.permute(1, 0, 2, 3).flatten(start_dim=1).t()
-    dx, dgamma, dbeta = BatchNorm.backward(dout_p, cache)
-    dx = dx.t().view(C, N, H, W).permute(1, 0, 2, 3)
+    M = N * H * W
+    shape = (1, C, 1, 1)
+    dbeta = dout.sum(dim=(0, 2, 3)) # C
+    dgamma = (x_hat * dout).sum(dim=(0, 2, 3)) # C
+    # same expression as BatchNorm.backward, reduced over N, H and W
+    dx = (gamma * inv_std / M).view(shape) * (M * dout - dbeta.view(shape) - x_hat * dgamma.view(shape))
+    dx = dx.to(dout_dtype)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -1082,33 +1578,33 @@ class SpatialBatchNorm(object):
 ################################################################################
 ################################################################################
 
+def is_channels_last(x):
+  """
+  Return True if the 4D tensor x is stored in NHWC (torch.channels_last)
+  order rather than as a contiguous NCHW tensor.
+  """
+  return (x.dim() == 4 and not x.is_contiguous()
+          and x.is_contiguous(memory_format=torch.channels_last))
+
+
 class FastConv(object):
 
   @staticmethod
   def forward(x, w, b, conv_param):
-    N, C, H, W = x.shape
-    F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
-    layer = torch.nn.Conv2d(C, F, (HH, WW), stride=stride, padding=pad)
-    layer.weight = torch.nn.Parameter(w)
-    layer.bias = torch.nn.Parameter(b)
-    tx = x.detach()
-    tx.requires_grad = True
-    out = layer(tx)
-    cache = (x, w, b, conv_param, tx, out, layer)
+    with torch.no_grad():
+      out = torch.nn.functional.conv2d(x, w, b, stride=stride, padding=pad)
+    cache = (x, w, b, conv_param)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
-    try:
-      x, _, _, _, tx, out, layer = cache
-      out.backward(dout)
-      dx = tx.grad.detach()
-      dw = layer.weight.grad.detach()
-      db = layer.bias.grad.detach()
-      layer.weight.grad = layer.bias.grad = None
-    except RuntimeError:
-      dx, dw, db = torch.zeros_like(tx), torch.zeros_like(layer.weight), torch.zeros_like(layer.bias)
+    x, w, b, conv_param = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    with torch.no_grad():
+      dx = torch.nn.grad.conv2d_input(x.shape, w, dout, stride=stride, padding=pad)
+      dw = torch.nn.grad.conv2d_weight(x, w.shape, dout, stride=stride, padding=pad)
+      db = dout.sum(dim=(0, 2, 3))
     return dx, dw, db
 
 
@@ -1116,25 +1612,335 @@ class FastMaxPool(object):
 
   @staticmethod
   def forward(x, pool_param):
-    N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
     stride = pool_param['stride']
-    layer = torch.nn.MaxPool2d(kernel_size=(pool_height, pool_width), stride=stride)
-    tx = x.detach()
-    tx.requires_grad = True
-    out = layer(tx)
-    cache = (x, pool_param, tx, out, layer)
+    with torch.no_grad():
+      out, max_idx = torch.nn.functional.max_pool2d(
+        x, (pool_height, pool_width), stride=stride, return_indices=True)
+    # max_idx holds flat (H * W) indices, the same cache layout as MaxPool
+    cache = (x.shape, pool_param, max_idx)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
-    try:
-      x, _, tx, out, layer = cache
-      out.backward(dout)
-      dx = tx.grad.detach()
-    except RuntimeError:
-      dx = torch.zeros_like(tx)
-    return dx
+    return MaxPool.backward(dout, cache)
+
+
+class ConvIm2Col(object):
+
+  @staticmethod
+  def forward(x, w, b, conv_param):
+    """
+    A vectorized forward pass for a convolutional layer using im2col + GEMM.
+    Every receptive field of the padded input is read through a strided view
+    and copied into one column matrix, so the whole convolution becomes a
+    single batched matrix multiply with the flattened filters.
+
+    Inputs / outputs: Same as Conv.forward, except that the cache is
+    (x, w, b, conv_param, cols) where cols is the (N, C * HH * WW, H' * W')
+    column matrix, which is reused to compute dw in the backward pass.
+
+    A channels-last x is handled by _forward_nhwc, which keeps the output
+    and the column matrix in NHWC order.
+    """
+    if is_channels_last(x):
+      return ConvIm2Col._forward_nhwc(x, w, b, conv_param)
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+    H_p = 1 + (H + 2 * pad - HH) // stride
+    W_p = 1 + (W + 2 * pad - WW) // stride
+
+    x_padded = torch.nn.functional.pad(x, (pad, pad, pad, pad))
+    sN, sC, sH, sW = x_padded.stride()
+    windows = x_padded.as_strided((N, C, HH, WW, H_p, W_p),
+                                  (sN, sC, sH, sW, sH * stride, sW * stride))
+    cols = windows.reshape(N, C * HH * WW, H_p * W_p)
+
+    out = torch.matmul(w.reshape(F, -1), cols).view(N, F, H_p, W_p)
+    out += b.view(1, F, 1, 1)
+    cache = (x, w, b, conv_param, cols)
+    return out, cache
+
+  @staticmethod
+  def backward(dout, cache):
+    """
+    A vectorized backward pass for a convolutional layer using im2col + GEMM.
+    dw is one GEMM against the cached column matrix; dx is one GEMM that
+    produces the column gradients, which are scattered back onto the input
+    (col2im) with one strided add per kernel tap.
+
+    Inputs:
+    - dout: Upstream derivatives.
+    - cache: A tuple of (x, w, b, conv_param, cols) as in ConvIm2Col.forward
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x
+    - dw: Gradient with respect to w
+    - db: Gradient with respect to b
+    """
+    x, w, b, conv_param, cols = cache
+    if is_channels_last(x):
+      return ConvIm2Col._backward_nhwc(dout, cache)
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, H_p, W_p = dout.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+
+    dout_r = dout.reshape(N, F, H_p * W_p)
+    db = dout_r.sum(dim=(0, 2))
+    dw = torch.tensordot(dout_r, cols, dims=([0, 2], [0, 2])).view(w.shape)
+
+    dcols = torch.matmul(w.reshape(F, -1).t(), dout_r)
+    dcols = dcols.view(N, C, HH, WW, H_p, W_p)
+    dx_padded = torch.zeros((N, C, H + 2 * pad, W + 2 * pad),
+                            dtype=dout.dtype, device=dout.device)
+    for hh in range(HH):
+      for ww in range(WW):
+        dx_padded[:, :, hh:hh + stride * H_p:stride, ww:ww + stride * W_p:stride] += dcols[:, :, hh, ww]
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+    return dx, dw, db
+
+  @staticmethod
+  def _forward_nhwc(x, w, b, conv_param):
+    """
+    ConvIm2Col.forward for a channels-last x: the column matrix has shape
+    (N, H' * W', HH * WW * C), so the GEMM output is already NHWC. cols is
+    cached in this layout.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+    H_p = 1 + (H + 2 * pad - HH) // stride
+    W_p = 1 + (W + 2 * pad - WW) // stride
+
+    x_padded = torch.nn.functional.pad(x, (pad, pad, pad, pad))
+    sN, sC, sH, sW = x_padded.stride()
+    windows = x_padded.as_strided((N, H_p, W_p, HH, WW, C),
+                                  (sN, sH * stride, sW * stride, sH, sW, sC))
+    cols = windows.reshape(N, H_p * W_p, HH * WW * C)
+
+    # a view when w is channels-last too
+    w_r = w.permute(0, 2, 3, 1).reshape(F, -1)
+    out = torch.matmul(cols, w_r.t())
+    out += b
+    out = out.view(N, H_p, W_p, F).permute(0, 3, 1, 2)
+    cache = (x, w, b, conv_param, cols)
+    return out, cache
+
+  @staticmethod
+  def _backward_nhwc(dout, cache):
+    """
+    ConvIm2Col.backward for a cache from _forward_nhwc; dx and dw are
+    returned channels-last.
+    """
+    x, w, b, conv_param, cols = cache
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, H_p, W_p = dout.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+
+    dout_r = dout.permute(0, 2, 3, 1).reshape(N, H_p * W_p, F)
+    db = dout_r.sum(dim=(0, 1))
+    dw = torch.tensordot(dout_r, cols, dims=([0, 1], [0, 1]))
+    dw = dw.view(F, HH, WW, C).permute(0, 3, 1, 2)
+
+    w_r = w.permute(0, 2, 3, 1).reshape(F, -1)
+    dcols = torch.matmul(dout_r, w_r).view(N, H_p, W_p, HH, WW, C)
+    dx_padded = torch.zeros((N, H + 2 * pad, W + 2 * pad, C),
+                            dtype=dout.dtype, device=dout.device)
+    for hh in range(HH):
+      for ww in range(WW):
+        dx_padded[:, hh:hh + stride * H_p:stride, ww:ww + stride * W_p:stride] += dcols[:, :, :, hh, ww]
+    dx = dx_padded[:, pad:pad + H, pad:pad + W].permute(0, 3, 1, 2)
+    return dx, dw, db
+
+
+class ConvWinograd(object):
+  """
+  Convolution with the Winograd minimal filtering algorithm F(2x2, 3x3):
+  every 2x2 output tile is computed from a 4x4 input tile with 16 instead of
+  36 multiplies per channel pair. Only 3x3 filters with stride 1 are
+  supported, which is what DeepConvNet uses.
+  """
+
+  # Input, filter and output transforms of F(2x2, 3x3)
+  BT = [[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0], [0, 1, 0, -1]]
+  G = [[1, 0, 0], [0.5, 0.5, 0.5], [0.5, -0.5, 0.5], [0, 0, 1]]
+  AT = [[1, 1, 1, 0], [0, 1, -1, -1]]
+
+  @staticmethod
+  def forward(x, w, b, conv_param):
+    """
+    Inputs / outputs: Same as Conv.forward, except that the cache is
+    (x, w, b, conv_param, U, V) with the transformed filters U and the
+    transformed input tiles V, which the backward pass reuses.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+    if (HH, WW) != (3, 3) or stride != 1:
+      raise ValueError('ConvWinograd only supports 3x3 filters with stride 1')
+    BT, G, AT = [torch.tensor(m, dtype=x.dtype, device=x.device)
+                 for m in (ConvWinograd.BT, ConvWinograd.G, ConvWinograd.AT)]
+
+    H_p = H + 2 * pad - 2
+    W_p = W + 2 * pad - 2
+    th, tw = (H_p + 1) // 2, (W_p + 1) // 2
+    # pad the bottom / right so that every 4x4 input tile exists
+    x_padded = torch.nn.functional.pad(
+      x, (pad, pad + 2 * tw - W_p, pad, pad + 2 * th - H_p))
+    sN, sC, sH, sW = x_padded.stride()
+    tiles = x_padded.as_strided((N, C, th, tw, 4, 4),
+                                (sN, sC, 2 * sH, 2 * sW, sH, sW))
+
+    U = torch.einsum('ik,fckl,jl->ijfc', G, w, G).reshape(16, F, C)
+    V = torch.einsum('ik,nctukl,jl->ijcntu', BT, tiles, BT).reshape(16, C, -1)
+    M = torch.bmm(U, V).view(4, 4, F, N, th, tw)
+    out = torch.einsum('ai,ijfntu,bj->nftaub', AT, M, AT).reshape(N, F, 2 * th, 2 * tw)
+    out = out[:, :, :H_p, :W_p] + b.view(1, F, 1, 1)
+    cache = (x, w, b, conv_param, U, V)
+    return out, cache
+
+  @staticmethod
+  def backward(dout, cache):
+    """
+    Backward pass of ConvWinograd. Every step of the forward pass is linear,
+    so the gradients go back through the transposed transforms: the output
+    transform for dout, one batched GEMM each for the transformed filters and
+    tiles, then the filter and input transforms.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x
+    - dw: Gradient with respect to w
+    - db: Gradient with respect to b
+    """
+    x, w, b, conv_param, U, V = cache
+    N, C, H, W = x.shape
+    F = w.shape[0]
+    pad = conv_param['pad']
+    BT, G, AT = [torch.tensor(m, dtype=dout.dtype, device=dout.device)
+                 for m in (ConvWinograd.BT, ConvWinograd.G, ConvWinograd.AT)]
+    H_p = H + 2 * pad - 2
+    W_p = W + 2 * pad - 2
+    th, tw = (H_p + 1) // 2, (W_p + 1) // 2
+
+    db = dout.sum(dim=(0, 2, 3))
+    dY = torch.nn.functional.pad(dout, (0, 2 * tw - W_p, 0, 2 * th - H_p))
+    dY = dY.view(N, F, th, 2, tw, 2)
+    dM = torch.einsum('ai,nftaub,bj->ijfntu', AT, dY, AT).reshape(16, F, -1)
+
+    dU = torch.bmm(dM, V.transpose(1, 2)).view(4, 4, F, C)
+    dw = torch.einsum('ik,ijfc,jl->fckl', G, dU, G)
+
+    dV = torch.bmm(U.transpose(1, 2), dM).view(4, 4, C, N, th, tw)
+    dtiles = torch.einsum('ik,ijcntu,jl->nctukl', BT, dV, BT)
+    dx_padded = torch.zeros((N, C, 2 * th + 2, 2 * tw + 2),
+                            dtype=dout.dtype, device=dout.device)
+    for k in range(4):
+      for l in range(4):
+        dx_padded[:, :, k:k + 2 * th:2, l:l + 2 * tw:2] += dtiles[..., k, l]
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+    return dx, dw, db
+
+
+class ConvFFT(object):
+  """
+  Convolution computed as a pointwise product in the frequency domain. The
+  padded input and the filters are transformed with a real 2D FFT of the
+  padded input size, so the circular correlation never wraps around inside
+  the valid output region. Strides are supported by subsampling the output.
+  torch.fft has no bfloat16 kernels, so DeepConvNet rejects this engine
+  together with amp_dtype.
+  """
+
+  @staticmethod
+  def forward(x, w, b, conv_param):
+    """
+    Inputs / outputs: Same as Conv.forward, except that the cache is
+    (x, w, b, conv_param, x_f, w_f) with the spectra of the padded input and
+    of the filters, which the backward pass reuses.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+    Hx, Wx = H + 2 * pad, W + 2 * pad
+    H_p = 1 + (Hx - HH) // stride
+    W_p = 1 + (Wx - WW) // stride
+
+    x_padded = torch.nn.functional.pad(x, (pad, pad, pad, pad))
+    x_f = torch.fft.rfft2(x_padded)
+    w_f = torch.fft.rfft2(w, s=(Hx, Wx))
+    out_f = torch.einsum('nchw,fchw->nfhw', x_f, w_f.conj())
+    out = torch.fft.irfft2(out_f, s=(Hx, Wx))
+    out = out[:, :, :(H_p - 1) * stride + 1:stride, :(W_p - 1) * stride + 1:stride]
+    out = out + b.view(1, F, 1, 1)
+    cache = (x, w, b, conv_param, x_f, w_f)
+    return out, cache
+
+  @staticmethod
+  def backward(dout, cache):
+    """
+    Backward pass of ConvFFT: dx is the convolution of dout with the filters
+    and dw the correlation of the padded input with dout, both computed as
+    products of spectra.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x
+    - dw: Gradient with respect to w
+    - db: Gradient with respect to b
+    """
+    x, w, b, conv_param, x_f, w_f = cache
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, H_p, W_p = dout.shape
+    pad = conv_param['pad']
+    stride = conv_param['stride']
+    Hx, Wx = H + 2 * pad, W + 2 * pad
+
+    db = dout.sum(dim=(0, 2, 3))
+    g = torch.zeros((N, F, Hx, Wx), dtype=dout.dtype, device=dout.device)
+    g[:, :, :(H_p - 1) * stride + 1:stride, :(W_p - 1) * stride + 1:stride] = dout
+    g_f = torch.fft.rfft2(g)
+
+    dx_f = torch.einsum('nfhw,fchw->nchw', g_f, w_f)
+    dx = torch.fft.irfft2(dx_f, s=(Hx, Wx))[:, :, pad:pad + H, pad:pad + W]
+    dw_f = torch.einsum('nfhw,nchw->fchw', g_f.conj(), x_f)
+    dw = torch.fft.irfft2(dw_f, s=(Hx, Wx))[:, :, :HH, :WW]
+    return dx, dw, db
+
+
+# Convolution implementations that the sandwich layers can use, selected by
+# the optional 'engine' key of conv_param. Every engine stores conv_param at
+# index 3 of its cache, so the backward pass can find the same engine again.
+CONV_ENGINES = {
+  'naive': Conv,
+  'im2col': ConvIm2Col,
+  'winograd': ConvWinograd,
+  'fft': ConvFFT,
+  'fast': FastConv,
+}
+
+
+def conv_engine(conv_param):
+  """
+  Return the convolution layer class selected by conv_param['engine'],
+  defaulting to FastConv.
+  """
+  return CONV_ENGINES[conv_param.get('engine', 'fast')]
+
+
+# The single cache of a conv sandwich layer: the conv cache, the batchnorm
+# and pool caches (None when the layer has none), and the ReLU mask packed
+# to one bit per activation with pack_mask.
+SandwichCache = namedtuple('SandwichCache', ['conv', 'bn', 'relu_mask', 'pool'])
+
 
 class Conv_ReLU(object):
 
@@ -1149,9 +1955,9 @@ class Conv_ReLU(object):
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
-    out, relu_cache = ReLU.forward(a)
-    cache = (conv_cache, relu_cache)
+    a, conv_cache = conv_engine(conv_param).forward(x, w, b, conv_param)
+    out, relu_mask = ReLU.forward(a, inplace=True, pack=True)
+    cache = SandwichCache(conv_cache, None, relu_mask, None)
     return out, cache
 
   @staticmethod
@@ -1159,9 +1965,8 @@ class Conv_ReLU(object):
     """
     Backward pass for the conv-relu convenience layer.
     """
-    conv_cache, relu_cache = cache
-    da = ReLU.backward(dout, relu_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    da = ReLU.backward(dout, cache.relu_mask)
+    dx, dw, db = conv_engine(cache.conv[3]).backward(da, cache.conv)
     return dx, dw, db
 
 
@@ -1179,10 +1984,10 @@ class Conv_ReLU_Pool(object):
     - out: Output from the pooling layer
     - cache: Object to give to the backward pass
     """
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
-    s, relu_cache = ReLU.forward(a)
+    a, conv_cache = conv_engine(conv_param).forward(x, w, b, conv_param)
+    s, relu_mask = ReLU.forward(a, inplace=True, pack=True)
     out, pool_cache = FastMaxPool.forward(s, pool_param)
-    cache = (conv_cache, relu_cache, pool_cache)
+    cache = SandwichCache(conv_cache, None, relu_mask, pool_cache)
     return out, cache
 
   @staticmethod
@@ -1190,10 +1995,9 @@ class Conv_ReLU_Pool(object):
     """
     Backward pass for the conv-relu-pool convenience layer
     """
-    conv_cache, relu_cache, pool_cache = cache
-    ds = FastMaxPool.backward(dout, pool_cache)
-    da = ReLU.backward(ds, relu_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    da = FastMaxPool.backward(dout, cache.pool)
+    da = ReLU.backward(da, cache.relu_mask, inplace=True)
+    dx, dw, db = conv_engine(cache.conv[3]).backward(da, cache.conv)
     return dx, dw, db
 
 class Linear_BatchNorm_ReLU(object):
@@ -1236,18 +2040,17 @@ class Conv_BatchNorm_ReLU(object):
 
   @staticmethod
   def forward(x, w, b, gamma, beta, conv_param, bn_param):
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    a, conv_cache = conv_engine(conv_param).forward(x, w, b, conv_param)
     an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
-    out, relu_cache = ReLU.forward(an)
-    cache = (conv_cache, bn_cache, relu_cache)
+    out, relu_mask = ReLU.forward(an, inplace=True, pack=True)
+    cache = SandwichCache(conv_cache, bn_cache, relu_mask, None)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
-    conv_cache, bn_cache, relu_cache = cache
-    dan = ReLU.backward(dout, relu_cache)
-    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    dan = ReLU.backward(dout, cache.relu_mask)
+    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, cache.bn)
+    dx, dw, db = conv_engine(cache.conv[3]).backward(da, cache.conv)
     return dx, dw, db, dgamma, dbeta
 
 
@@ -1255,18 +2058,813 @@ class Conv_BatchNorm_ReLU_Pool(object):
 
   @staticmethod
   def forward(x, w, b, gamma, beta, conv_param, bn_param, pool_param):
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    a, conv_cache = conv_engine(conv_param).forward(x, w, b, conv_param)
     an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
-    s, relu_cache = ReLU.forward(an)
+    s, relu_mask = ReLU.forward(an, inplace=True, pack=True)
     out, pool_cache = FastMaxPool.forward(s, pool_param)
-    cache = (conv_cache, bn_cache, relu_cache, pool_cache)
+    cache = SandwichCache(conv_cache, bn_cache, relu_mask, pool_cache)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
-    conv_cache, bn_cache, relu_cache, pool_cache = cache
-    ds = FastMaxPool.backward(dout, pool_cache)
-    dan = ReLU.backward(ds, relu_cache)
-    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    dan = FastMaxPool.backward(dout, cache.pool)
+    dan = ReLU.backward(dan, cache.relu_mask, inplace=True)
+    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, cache.bn)
+    dx, dw, db = conv_engine(cache.conv[3]).backward(da, cache.conv)
     return dx, dw, db, dgamma, dbeta
+
+
+def time_per_call(fn, num_runs, device='cpu'):
+  """
+  Call fn() once to warm up, then return the average wall time in seconds of
+  num_runs further calls, synchronizing CUDA around them if needed.
+  """
+  cuda = torch.device(device).type == 'cuda'
+  fn()
+  if cuda:
+    torch.cuda.synchronize()
+  tic = time.perf_counter()
+  for _ in range(num_runs):
+    fn()
+  if cuda:
+    torch.cuda.synchronize()
+  return (time.perf_counter() - tic) / num_runs
+
+
+def benchmark_conv(N=16, C=16, H=32, W=32, F=32, filter_size=3, stride=1,
+                   pad=1, num_runs=5, dtype=torch.float, device='cpu'):
+  """
+  Time the forward + backward pass of every convolution engine in
+  CONV_ENGINES on the same random problem, and print the speedup of each one
+  over the naive Conv implementation.
+
+  Returns: A dictionary mapping engine names to the average time in seconds
+  of one forward + backward pass.
+  """
+  x = torch.randn(N, C, H, W, dtype=dtype, device=device)
+  w = torch.randn(F, C, filter_size, filter_size, dtype=dtype, device=device)
+  b = torch.randn(F, dtype=dtype, device=device)
+
+  times = {}
+  for name in CONV_ENGINES:
+    conv_param = {'stride': stride, 'pad': pad, 'engine': name}
+    layer = conv_engine(conv_param)
+
+    def step():
+      out, cache = layer.forward(x, w, b, conv_param)
+      layer.backward(torch.ones_like(out), cache)
+
+    times[name] = time_per_call(step, num_runs, device)
+
+  for name, t in times.items():
+    print('%-8s %10.6fs  speedup vs naive %8.2fx  vs fast %6.2fx'
+          % (name, t, times['naive'] / t, times['fast'] / t))
+  return times
+
+
+def benchmark_fast_layers(batch_sizes=(1, 2, 4, 8, 16, 32), C=16, H=32, W=32,
+                          F=16, num_runs=20, dtype=torch.float, device='cpu'):
+  """
+  Measure the per-step time of a FastConv + FastMaxPool forward and backward
+  pass at small batch sizes, where per-call overhead dominates, and compare
+  it against building a torch.nn.Conv2d / torch.nn.MaxPool2d module and
+  running autograd on every call.
+
+  Returns: A dictionary mapping each batch size to a tuple
+  (functional_time, module_time) in seconds per step.
+  """
+  conv_param = {'stride': 1, 'pad': 1}
+  pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+  w = torch.randn(F, C, 3, 3, dtype=dtype, device=device)
+  b = torch.randn(F, dtype=dtype, device=device)
+
+  def functional_step(x):
+    a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    out, pool_cache = FastMaxPool.forward(a, pool_param)
+    da = FastMaxPool.backward(torch.ones_like(out), pool_cache)
+    FastConv.backward(da, conv_cache)
+
+  def module_step(x):
+    conv = torch.nn.Conv2d(C, F, 3, stride=1, padding=1).to(dtype=dtype, device=device)
+    conv.weight = torch.nn.Parameter(w)
+    conv.bias = torch.nn.Parameter(b)
+    pool = torch.nn.MaxPool2d(kernel_size=2, stride=2)
+    tx = x.detach()
+    tx.requires_grad = True
+    out = pool(conv(tx))
+    out.backward(torch.ones_like(out))
+
+  results = {}
+  for N in batch_sizes:
+    x = torch.randn(N, C, H, W, dtype=dtype, device=device)
+    t_functional = time_per_call(lambda: functional_step(x), num_runs, device)
+    t_module = time_per_call(lambda: module_step(x), num_runs, device)
+    results[N] = (t_functional, t_module)
+    print('N=%-4d functional %9.6fs  per-call modules %9.6fs  speedup %5.2fx'
+          % (N, t_functional, t_module, t_module / t_functional))
+  return results
+
+
+def benchmark_batchnorm(shapes=((128 * 32 * 32, 16), (128 * 16 * 16, 32),
+                                (128 * 8 * 8, 64)),
+                        cache_dtypes=(None, torch.float16), num_runs=10,
+                        dtype=torch.float, device='cpu'):
+  """
+  Time BatchNorm.forward + BatchNorm.backward on the (N * H * W, C) shapes
+  that SpatialBatchNorm produces, storing x_hat in the cache either in the
+  input dtype (cache_dtype None) or in a lower precision.
+
+  Returns: A dictionary mapping (shape, cache_dtype) to a tuple
+  (seconds per forward + backward, bytes held by the cache).
+  """
+  results = {}
+  for shape in shapes:
+    x = torch.randn(*shape, dtype=dtype, device=device)
+    gamma = torch.ones(shape[1], dtype=dtype, device=device)
+    beta = torch.zeros(shape[1], dtype=dtype, device=device)
+    dout = torch.randn_like(x)
+    for cache_dtype in cache_dtypes:
+      bn_param = {'mode': 'train'}
+      if cache_dtype is not None:
+        bn_param['cache_dtype'] = cache_dtype
+
+      def step():
+        _, cache = BatchNorm.forward(x, gamma, beta, bn_param)
+        BatchNorm.backward(dout, cache)
+
+      elapsed = time_per_call(step, num_runs, device)
+      _, cache = BatchNorm.forward(x, gamma, beta, bn_param)
+      cache_bytes = sum(t.numel() * t.element_size() for t in cache)
+      results[(shape, cache_dtype)] = (elapsed, cache_bytes)
+      print('%-16s cache %-14s %9.6fs  cache %8.2f MB'
+            % (shape, cache_dtype or dtype, elapsed, cache_bytes / 2 ** 20))
+  return results
+
+
+def benchmark_spatial_batchnorm(input_dims=(3, 32, 32), num_filters=(32, 64, 128),
+                                max_pools=(0, 1, 2), batch_size=128,
+                                num_runs=5, dtype=torch.float, device='cpu'):
+  """
+  Compare SpatialBatchNorm against running BatchNorm on a permuted and
+  flattened (N * H * W, C) copy of the input, then measure the training
+  throughput and peak memory of a DeepConvNet with batchnorm enabled.
+
+  Returns: A dictionary with the keys 'native_time' and 'permute_time'
+  (seconds per forward + backward of one SpatialBatchNorm-sized input),
+  'images_per_sec' and 'peak_memory' (bytes) of one DeepConvNet step.
+  """
+  def permute_step(x, gamma, beta, dout):
+    N, C, H, W = x.shape
+    x_p = x.permute(1, 0, 2, 3).flatten(start_dim=1).t()
+    out, cache = BatchNorm.forward(x_p, gamma, beta, {'mode': 'train'})
+    out = out.t().reshape(C, N, H, W).permute(1, 0, 2, 3)
+    dout_p = dout.permute(1, 0, 2, 3).flatten(start_dim=1).t()
+    dx, _, _ = BatchNorm.backward(dout_p, cache)
+    return dx.t().reshape(C, N, H, W).permute(1, 0, 2, 3)
+
+  def native_step(x, gamma, beta, dout):
+    _, cache = SpatialBatchNorm.forward(x, gamma, beta, {'mode': 'train'})
+    dx, _, _ = SpatialBatchNorm.backward(dout, cache)
+    return dx
+
+  C, H, W = input_dims
+  x = torch.randn(batch_size, num_filters[0], H, W, dtype=dtype, device=device)
+  gamma = torch.ones(num_filters[0], dtype=dtype, device=device)
+  beta = torch.zeros(num_filters[0], dtype=dtype, device=device)
+  dout = torch.randn_like(x)
+
+  results = {}
+  results['native_time'] = time_per_call(
+    lambda: native_step(x, gamma, beta, dout), num_runs, device)
+  results['permute_time'] = time_per_call(
+    lambda: permute_step(x, gamma, beta, dout), num_runs, device)
+
+  model = DeepConvNet(input_dims=input_dims, num_filters=list(num_filters),
+                      max_pools=list(max_pools), batchnorm=True,
+                      weight_scale='kaiming', dtype=dtype, device=device)
+  X = torch.randn(batch_size, *input_dims, dtype=dtype, device=device)
+  y = torch.randint(10, (batch_size,), device=device)
+  results['images_per_sec'] = batch_size / time_per_call(
+    lambda: model.loss(X, y), num_runs, device)
+  results['peak_memory'] = peak_memory_usage(lambda: model.loss(X, y), device)
+
+  print('SpatialBatchNorm native %9.6fs  permute+BatchNorm %9.6fs  speedup %5.2fx'
+        % (results['native_time'], results['permute_time'],
+           results['permute_time'] / results['native_time']))
+  print('DeepConvNet with batchnorm: %.1f images/s, peak memory %.2f MB'
+        % (results['images_per_sec'], results['peak_memory'] / 2 ** 20))
+  return results
+
+
+def benchmark_sandwich_memory(N=64, C=16, H=32, W=32, F=32,
+                              dtype=torch.float, device='cpu'):
+  """
+  Compare the memory of one conv - batchnorm - relu - pool macro layer built
+  from the separate layers (FastConv, SpatialBatchNorm, ReLU, FastMaxPool)
+  against Conv_BatchNorm_ReLU_Pool.
+
+  Returns: A dictionary mapping 'separate' and 'fused' to a tuple
+  (bytes held by the cache, peak bytes during the forward pass).
+  """
+  x = torch.randn(N, C, H, W, dtype=dtype, device=device)
+  w = torch.randn(F, C, 3, 3, dtype=dtype, device=device)
+  b = torch.zeros(F, dtype=dtype, device=device)
+  gamma = torch.ones(F, dtype=dtype, device=device)
+  beta = torch.zeros(F, dtype=dtype, device=device)
+  conv_param = {'stride': 1, 'pad': 1}
+  pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+  def separate():
+    a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, {'mode': 'train'})
+    s, relu_cache = ReLU.forward(an)
+    out, pool_cache = FastMaxPool.forward(s, pool_param)
+    return out, (conv_cache, bn_cache, relu_cache, pool_cache)
+
+  def fused():
+    return Conv_BatchNorm_ReLU_Pool.forward(x, w, b, gamma, beta, conv_param,
+                                            {'mode': 'train'}, pool_param)
+
+  results = {}
+  for name, fn in [('separate', separate), ('fused', fused)]:
+    _, cache = fn()
+    results[name] = (cache_bytes(cache) - cache_bytes((x, w, b, gamma)),
+                     peak_memory_usage(fn, device))
+    print('%-9s cache %8.2f MB  peak %8.2f MB'
+          % (name, results[name][0] / 2 ** 20, results[name][1] / 2 ** 20))
+  return results
+
+
+# How LayerProfiler estimates the FLOPs of a layer, by class name. Layers that
+# are not listed (such as the sandwich layers) only call other layers, whose
+# FLOPs are counted where they happen.
+LAYER_FLOP_KINDS = {
+  'Linear': 'linear',
+  'Conv': 'conv',
+  'ConvIm2Col': 'conv',
+  'FastConv': 'conv',
+  'ConvWinograd': 'conv',
+  'ConvFFT': 'conv',
+  'ReLU': 'elementwise',
+  'Dropout': 'elementwise',
+  'BatchNorm': 'norm',
+  'SpatialBatchNorm': 'norm',
+  'MaxPool': 'pool',
+  'FastMaxPool': 'pool',
+}
+
+
+def estimate_layer_flops(name, phase, args, result):
+  """
+  Rough FLOP count of one call of layer class name. phase is 'forward' or
+  'backward', args are the arguments of the call and result its return
+  value. Matrix multiplies count 2 FLOPs per multiply-add, and the backward
+  pass of a linear or conv layer costs twice its forward pass.
+  """
+  kind = LAYER_FLOP_KINDS.get(name)
+  if kind is None:
+    return 0
+  out = result[0] if phase == 'forward' else args[0]
+  if kind in ('linear', 'conv'):
+    w = args[1] if phase == 'forward' else args[1][1]
+    per_output = w.shape[0] if kind == 'linear' else w[0].numel()
+    flops = 2 * out.numel() * per_output
+    return flops if phase == 'forward' else 2 * flops
+  if kind == 'pool':
+    pool_param = args[1] if phase == 'forward' else args[1][1]
+    return out.numel() * pool_param['pool_height'] * pool_param['pool_width']
+  if kind == 'norm':
+    return (4 if phase == 'forward' else 8) * out.numel()
+  return out.numel()
+
+
+class LayerProfiler(object):
+  """
+  Opt-in profiler for the modular layer API. While the profiler is active
+  (as a context manager), the forward and backward staticmethods of every
+  profiled layer class are replaced with wrappers that record, per call:
+
+  - time: wall time of the call, including the layers it calls
+  - self_time: time minus the time spent in nested profiled layers
+  - flops: an estimate from estimate_layer_flops
+  - alloc_bytes: bytes of tensor storages returned by the call that were not
+    passed in, i.e. the outputs, caches and gradients it allocated
+  - cache_bytes: bytes kept alive by the cache returned by a forward pass
+
+  Example:
+    with LayerProfiler() as prof:
+      model.loss(X, y)
+    prof.table()
+    prof.export_chrome_trace('trace.json')
+
+  The original methods are restored when the block exits.
+  """
+
+  def __init__(self, layers=None, sync_cuda=True):
+    """
+    Inputs:
+    - layers: Optional list of layer classes to profile. Defaults to every
+      class of this module with forward and backward staticmethods.
+    - sync_cuda: If True, synchronize CUDA around every call on GPU tensors so
+      the recorded times include the kernels.
+    """
+    if layers is None:
+      layers = [obj for obj in globals().values()
+                if isinstance(obj, type)
+                and isinstance(obj.__dict__.get('forward'), staticmethod)
+                and isinstance(obj.__dict__.get('backward'), staticmethod)]
+    self.layers = layers
+    self.sync_cuda = sync_cuda
+    self.events = []
+    self._stack = []
+    self._originals = []
+
+  def __enter__(self):
+    self._t0 = time.perf_counter()
+    for cls in self.layers:
+      for phase in ('forward', 'backward'):
+        method = cls.__dict__[phase]
+        self._originals.append((cls, phase, method))
+        setattr(cls, phase, staticmethod(self._wrap(cls.__name__, phase, method.__func__)))
+    return self
+
+  def __exit__(self, *exc_info):
+    for cls, phase, method in reversed(self._originals):
+      setattr(cls, phase, method)
+    self._originals = []
+    return False
+
+  def _wrap(self, name, phase, fn):
+    def wrapper(*args, **kwargs):
+      sync = (self.sync_cuda and torch.is_tensor(args[0]) and args[0].is_cuda)
+      frame = {'child_time': 0.0}
+      self._stack.append(frame)
+      if sync:
+        torch.cuda.synchronize()
+      start = time.perf_counter()
+      try:
+        result = fn(*args, **kwargs)
+        if sync:
+          torch.cuda.synchronize()
+      finally:
+        elapsed = time.perf_counter() - start
+        self._stack.pop()
+      if self._stack:
+        self._stack[-1]['child_time'] += elapsed
+
+      inputs = tensor_storages((args, kwargs))
+      outputs = tensor_storages(result)
+      self.events.append({
+        'name': name,
+        'phase': phase,
+        'start': start - self._t0,
+        'time': elapsed,
+        'self_time': elapsed - frame['child_time'],
+        'depth': len(self._stack),
+        'flops': estimate_layer_flops(name, phase, args, result),
+        'alloc_bytes': sum(n for ptr, n in outputs.items() if ptr not in inputs),
+        'cache_bytes': cache_bytes(result[1]) if phase == 'forward' else 0,
+      })
+      return result
+    return wrapper
+
+  def summary(self):
+    """
+    Aggregate the recorded calls per (layer, phase).
+
+    Returns: A list of dictionaries with the keys 'name', 'phase', 'calls',
+    'time', 'self_time', 'flops', 'alloc_bytes' and 'cache_bytes' (totals
+    over all calls), sorted by decreasing self_time.
+    """
+    rows = {}
+    for e in self.events:
+      key = (e['name'], e['phase'])
+      if key not in rows:
+        rows[key] = {'name': e['name'], 'phase': e['phase'], 'calls': 0,
+                     'time': 0.0, 'self_time': 0.0, 'flops': 0,
+                     'alloc_bytes': 0, 'cache_bytes': 0}
+      row = rows[key]
+      row['calls'] += 1
+      for k in ('time', 'self_time', 'flops', 'alloc_bytes', 'cache_bytes'):
+        row[k] += e[k]
+    return sorted(rows.values(), key=lambda r: -r['self_time'])
+
+  def table(self):
+    """
+    Print the per-layer summary as a table and return it as a string.
+    """
+    lines = ['%-26s %-8s %6s %10s %10s %9s %10s %10s'
+             % ('layer', 'phase', 'calls', 'time ms', 'self ms', 'GFLOP',
+                'alloc MB', 'cache MB')]
+    for r in self.summary():
+      lines.append('%-26s %-8s %6d %10.3f %10.3f %9.3f %10.2f %10.2f'
+                   % (r['name'], r['phase'], r['calls'], 1e3 * r['time'],
+                      1e3 * r['self_time'], r['flops'] / 1e9,
+                      r['alloc_bytes'] / 2 ** 20, r['cache_bytes'] / 2 ** 20))
+    text = '\n'.join(lines)
+    print(text)
+    return text
+
+  def export_chrome_trace(self, path):
+    """
+    Write the recorded calls to path as a Chrome trace (open it in
+    chrome://tracing or https://ui.perfetto.dev). Nested layer calls show up
+    as nested slices.
+    """
+    trace = []
+    for e in self.events:
+      trace.append({
+        'name': '%s.%s' % (e['name'], e['phase']),
+        'cat': e['phase'],
+        'ph': 'X',
+        'ts': 1e6 * e['start'],
+        'dur': 1e6 * e['time'],
+        'pid': 0,
+        'tid': 0,
+        'args': {k: e[k] for k in ('flops', 'alloc_bytes', 'cache_bytes')},
+      })
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': trace}, f)
+
+
+def check_conv_engine(engine, N=2, C=3, H=8, W=8, F=4, filter_size=3,
+                      stride=1, pad=1, dtype=torch.float64, device='cpu'):
+  """
+  Check a convolution engine from CONV_ENGINES against PyTorch's reference
+  convolution (torch.nn.functional.conv2d and the torch.nn.grad helpers for
+  its input and weight gradients) on a random problem.
+
+  Returns: A dictionary mapping 'out', 'dx', 'dw' and 'db' to the maximum
+  relative error of the engine's result.
+  """
+  x = torch.randn(N, C, H, W, dtype=dtype, device=device)
+  w = torch.randn(F, C, filter_size, filter_size, dtype=dtype, device=device)
+  b = torch.randn(F, dtype=dtype, device=device)
+
+  out = torch.nn.functional.conv2d(x, w, b, stride=stride, padding=pad)
+  dout = torch.randn_like(out)
+  dx = torch.nn.grad.conv2d_input(x.shape, w, dout, stride=stride, padding=pad)
+  dw = torch.nn.grad.conv2d_weight(x, w.shape, dout, stride=stride, padding=pad)
+  db = dout.sum(dim=(0, 2, 3))
+  expected = (out, dx, dw, db)
+
+  conv_param = {'stride': stride, 'pad': pad, 'engine': engine}
+  layer = conv_engine(conv_param)
+  out, cache = layer.forward(x, w, b, conv_param)
+  result = (out,) + layer.backward(dout, cache)
+
+  errors = {}
+  for name, e, r in zip(('out', 'dx', 'dw', 'db'), expected, result):
+    errors[name] = ((e - r).abs().max() / e.abs().max().clamp(min=1e-12)).item()
+  return errors
+
+
+def benchmark_conv_crossover(channels=(4, 8, 16, 32, 64, 128), N=16, H=32,
+                             W=32, engines=('im2col', 'winograd', 'fft', 'fast'),
+                             num_runs=3, dtype=torch.float, device='cpu'):
+  """
+  Time the forward + backward pass of the DeepConvNet convolution (3x3,
+  stride 1, pad 1, as many filters as input channels) for every engine and
+  channel count, to find where each algorithm starts to win.
+
+  Returns: A dictionary mapping each channel count to a dictionary from
+  engine name to seconds per forward + backward pass.
+  """
+  results = {}
+  print('%8s' % 'channels' + ''.join('%12s' % e for e in engines) + '   fastest')
+  for C in channels:
+    x = torch.randn(N, C, H, W, dtype=dtype, device=device)
+    w = torch.randn(C, C, 3, 3, dtype=dtype, device=device)
+    b = torch.randn(C, dtype=dtype, device=device)
+    results[C] = {}
+    for name in engines:
+      conv_param = {'stride': 1, 'pad': 1, 'engine': name}
+      layer = conv_engine(conv_param)
+
+      def step():
+        out, cache = layer.forward(x, w, b, conv_param)
+        layer.backward(torch.ones_like(out), cache)
+
+      results[C][name] = time_per_call(step, num_runs, device)
+    fastest = min(results[C], key=results[C].get)
+    print('%8d' % C + ''.join('%11.5fs' % results[C][e] for e in engines)
+          + '   ' + fastest)
+  return results
+
+
+def benchmark_channels_last(input_dims=(3, 32, 32), num_filters=(32, 64, 128),
+                            max_pools=(0, 1, 2), batch_size=64, engines=('fast', 'im2col'),
+                            num_runs=3, dtype=torch.float, device='cpu'):
+  """
+  Time one training step (loss and gradients) of a batchnorm DeepConvNet in
+  NCHW and in channels-last mode for every conv engine, and check that both
+  layouts give the same loss.
+
+  Returns: A dictionary mapping (engine, channels_last) to seconds per step.
+  """
+  C, H, W = input_dims
+  X = torch.randn(batch_size, C, H, W, dtype=dtype, device=device)
+  y = torch.randint(10, (batch_size,), device=device)
+  results = {}
+  for engine in engines:
+    losses = []
+    for channels_last in (False, True):
+      torch.manual_seed(0)
+      model = DeepConvNet(input_dims=input_dims, num_filters=list(num_filters),
+                          max_pools=list(max_pools), batchnorm=True,
+                          weight_scale='kaiming', dtype=dtype, device=device,
+                          conv_engines=engine, channels_last=channels_last)
+      losses.append(model.loss(X, y)[0].item())
+      results[(engine, channels_last)] = time_per_call(
+        lambda: model.loss(X, y), num_runs, device)
+    print('%-8s NCHW %.5fs   NHWC %.5fs   speedup %.2fx   loss diff %.2e'
+          % (engine, results[(engine, False)], results[(engine, True)],
+             results[(engine, False)] / results[(engine, True)],
+             abs(losses[0] - losses[1])))
+  return results
+
+
+def benchmark_mixed_precision(input_dims=(3, 32, 32), num_filters=(32, 64, 128),
+                              max_pools=(0, 1, 2), batch_size=64,
+                              amp_dtype=torch.bfloat16, num_runs=3, device='cpu'):
+  """
+  Time one training step (loss and gradients) of a batchnorm DeepConvNet in
+  float32 and in mixed precision with amp_dtype, and measure the peak memory
+  of the step and the loss difference between the two modes.
+
+  Returns: A dictionary mapping 'float32' and str(amp_dtype) to a tuple
+  (seconds per step, peak bytes, loss).
+  """
+  C, H, W = input_dims
+  X = torch.randn(batch_size, C, H, W, device=device)
+  y = torch.randint(10, (batch_size,), device=device)
+  results = {}
+  for name, dtype in [('float32', None), (str(amp_dtype), amp_dtype)]:
+    torch.manual_seed(0)
+    model = DeepConvNet(input_dims=input_dims, num_filters=list(num_filters),
+                        max_pools=list(max_pools), batchnorm=True,
+                        weight_scale='kaiming', dtype=torch.float32,
+                        device=device, amp_dtype=dtype)
+    step = lambda: model.loss(X, y)
+    loss = step()[0].item()
+    results[name] = (time_per_call(step, num_runs, device),
+                     peak_memory_usage(step, device), loss)
+
+  base = results['float32']
+  for name, (elapsed, memory, loss) in results.items():
+    print('%-16s step %.4fs (%.2fx)  peak %8.2f MB (%.2fx)  loss %.4f'
+          % (name, elapsed, base[0] / elapsed, memory / 2 ** 20,
+             memory / base[1], loss))
+  return results
+
+
+def quantize_per_channel(w, dim=0):
+  """
+  Symmetric int8 quantization of w with one scale per slice along dim.
+
+  Returns a tuple of:
+  - w_q: int8 tensor of the shape of w, in [-127, 127]
+  - scale: Float tensor of shape (w.shape[dim],) with w ~= w_q * scale
+  """
+  dims = [d for d in range(w.dim()) if d != dim]
+  scale = w.abs().amax(dim=dims).clamp(min=1e-12) / 127
+  shape = [1] * w.dim()
+  shape[dim] = -1
+  w_q = (w / scale.view(shape)).round_().clamp_(-127, 127).to(torch.int8)
+  return w_q, scale
+
+
+# Device types on which torch._int_mm turned out to have no kernel
+_INT_MM_MISSING = set()
+
+
+def int8_mm(a, b):
+  """
+  Matrix product of int8 matrices a (M, K) and b (K, N) with int32
+  accumulation. Uses the int8 GEMM kernel of torch._int_mm where this build
+  has one for the device (CPU kernels exist from torch 2.3 on; the CUDA
+  kernel needs M > 16 and K, N divisible by 8), and an int32 GEMM otherwise.
+  """
+  device_type = a.device.type
+  use_int_mm = (hasattr(torch, '_int_mm') and device_type not in _INT_MM_MISSING
+                and (device_type != 'cuda' or (a.shape[0] > 16 and
+                     a.shape[1] % 8 == 0 and b.shape[1] % 8 == 0)))
+  if use_int_mm:
+    try:
+      return torch._int_mm(a, b)
+    except RuntimeError:
+      # the op is defined, but not implemented for this device
+      _INT_MM_MISSING.add(device_type)
+  return torch.mm(a.to(torch.int32), b.to(torch.int32))
+
+
+class QuantizedDeepConvNet(object):
+  """
+  Int8 inference copy of a DeepConvNet, built by DeepConvNet.quantize.
+
+  Activations are int8 between layers. Every conv runs as an im2col GEMM
+  of int8 values with int32 accumulation (via int8_mm); the accumulator is
+  rescaled, shifted by the float bias, passed through the ReLU and
+  requantized to the scale of the next layer in one fused step. Max pooling
+  runs directly on int8 values, since quantization preserves the order.
+  """
+
+  def __init__(self, folded, in_max):
+    """
+    Inputs:
+    - folded: A DeepConvNet without batchnorm (see fold_batchnorm)
+    - in_max: Largest magnitude of the input of every layer, of length
+      num_layers
+    """
+    self.dtype = folded.dtype
+    self.num_layers = folded.num_layers
+    self.max_pools = folded.max_pools
+    self.in_scales = [max(m, 1e-12) / 127 for m in in_max]
+    self.layers = []
+    for i in range(1, self.num_layers):
+      W = folded.params[f'W{i}']
+      F, C, HH, WW = W.shape
+      # rows ordered (HH, WW, C), the column order of int8_conv
+      w_q, w_scale = quantize_per_channel(W.permute(0, 2, 3, 1).reshape(F, -1))
+      next_scale = self.in_scales[i]
+      self.layers.append({
+        'w_q': w_q.t().contiguous(),
+        'kernel': (HH, WW),
+        'requant': self.in_scales[i-1] * w_scale / next_scale,
+        'bias': folded.params[f'b{i}'] / next_scale,
+        'pool': i-1 in self.max_pools,
+      })
+    W = folded.params[f'W{self.num_layers}']
+    self.fc_w_q, fc_w_scale = quantize_per_channel(W, dim=1)
+    self.fc_scale = self.in_scales[-1] * fc_w_scale
+    self.fc_bias = folded.params[f'b{self.num_layers}']
+
+  @staticmethod
+  def int8_conv(x_q, w_q, kernel, pad):
+    """
+    Stride-1 convolution of int8 x_q (N, C, H, W) with int8 filters w_q of
+    shape (HH * WW * C, F). Returns the int32 accumulator of shape
+    (N, F, H', W'), stored channels-last.
+    """
+    N, C, H, W = x_q.shape
+    HH, WW = kernel
+    F = w_q.shape[1]
+    H_p = H + 2 * pad - HH + 1
+    W_p = W + 2 * pad - WW + 1
+    x_padded = torch.nn.functional.pad(x_q, (pad, pad, pad, pad))
+    sN, sC, sH, sW = x_padded.stride()
+    windows = x_padded.as_strided((N, H_p, W_p, HH, WW, C),
+                                  (sN, sH, sW, sH, sW, sC))
+    cols = windows.reshape(N * H_p * W_p, HH * WW * C)
+    acc = int8_mm(cols, w_q)
+    return acc.view(N, H_p, W_p, F).permute(0, 3, 1, 2)
+
+  def loss(self, X, y=None):
+    """
+    Compute the float class scores of X with the int8 network. Only
+    inference is supported, so y must be None.
+    """
+    if y is not None:
+      raise ValueError('QuantizedDeepConvNet only supports inference')
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+    x = (X.to(self.dtype) / self.in_scales[0]).round_().clamp_(-127, 127)
+    x = x.to(torch.int8)
+    for layer in self.layers:
+      acc = self.int8_conv(x, layer['w_q'], layer['kernel'], pad=1)
+      shape = (1, -1, 1, 1)
+      # rescale, add the bias, relu and requantize in the next layer's scale
+      out = torch.addcmul(layer['bias'].view(shape), acc.to(self.dtype),
+                          layer['requant'].view(shape))
+      x = out.round_().clamp_(0, 127).to(torch.int8)
+      if layer['pool']:
+        x, _ = MaxPool.forward(x, pool_param)
+
+    # flatten in (C, H, W) order, the row order of the linear weight
+    acc = int8_mm(x.reshape(x.shape[0], -1), self.fc_w_q)
+    return torch.addcmul(self.fc_bias, acc.to(self.dtype), self.fc_scale)
+
+
+def benchmark_quantization(model, X_calib, X_test, y_test, num_runs=3,
+                           batch_size=None):
+  """
+  Quantize a trained DeepConvNet with X_calib and compare the int8 model
+  against the float model on (X_test, y_test): test accuracy and
+  inference latency.
+
+  Returns: A dictionary mapping 'float' and 'int8' to a tuple
+  (accuracy, seconds per inference of X_test).
+  """
+  qmodel = model.quantize(X_calib)
+  if batch_size is not None:
+    X_test, y_test = X_test[:batch_size], y_test[:batch_size]
+  results = {}
+  for name, m in [('float', model), ('int8', qmodel)]:
+    with torch.no_grad():
+      scores = m.loss(X_test)
+      acc = (scores.argmax(dim=1) == y_test).float().mean().item()
+      results[name] = (acc, time_per_call(lambda: m.loss(X_test), num_runs))
+  base = results['float']
+  for name, (acc, elapsed) in results.items():
+    print('%-6s accuracy %.4f (%+.4f)  latency %.4fs (%.2fx)'
+          % (name, acc, acc - base[0], elapsed, base[1] / elapsed))
+  return results
+
+
+def check_layer_gradients(num_directions=8, h=1e-6, seed=0, device='cpu'):
+  """
+  Check the backward passes of every conv engine, MaxPool, FastMaxPool,
+  BatchNorm and SpatialBatchNorm in float64. Input gradients of the conv
+  and pooling layers use batched_directional_grad_check (one forward pass
+  for all directions); weights and the batchnorm gradients use
+  directional_grad_check.
+
+  Returns: Dictionary mapping 'layer.input' names to relative errors; all
+  of them should be below about 1e-6.
+  """
+  generator = torch.Generator().manual_seed(seed)
+  randn = lambda *shape: torch.randn(*shape, dtype=torch.float64,
+                                     generator=generator).to(device)
+  errors = {}
+
+  x, w, b = randn(2, 3, 8, 8), randn(4, 3, 3, 3), randn(4)
+  for name in CONV_ENGINES:
+    conv_param = {'stride': 1, 'pad': 1, 'engine': name}
+    layer = conv_engine(conv_param)
+    out, cache = layer.forward(x, w, b, conv_param)
+    dout = randn(*out.shape)
+    dx, dw, db = layer.backward(dout, cache)
+    errors[layer.__name__ + '.x'] = batched_directional_grad_check(
+      lambda X: layer.forward(X, w, b, conv_param)[0], x, dout, dx,
+      num_directions, h, generator)
+    f = lambda: (layer.forward(x, w, b, conv_param)[0] * dout).sum()
+    for k, e in directional_grad_check(f, {'w': w, 'b': b}, {'w': dw, 'b': db},
+                                       num_directions, None, h, generator).items():
+      errors[layer.__name__ + '.' + k] = e
+
+  pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+  for layer in (MaxPool, FastMaxPool):
+    out, cache = layer.forward(x, pool_param)
+    dout = randn(*out.shape)
+    dx = layer.backward(dout, cache)
+    errors[layer.__name__ + '.x'] = batched_directional_grad_check(
+      lambda X: layer.forward(X, pool_param)[0], x, dout, dx,
+      num_directions, h, generator)
+
+  for layer, shape in ((BatchNorm, (16, 5)), (SpatialBatchNorm, (4, 5, 6, 6))):
+    x, gamma, beta = randn(*shape), randn(5), randn(5)
+    out, cache = layer.forward(x, gamma, beta, {'mode': 'train'})
+    dout = randn(*out.shape)
+    dx, dgamma, dbeta = layer.backward(dout, cache)
+    f = lambda: (layer.forward(x, gamma, beta, {'mode': 'train'})[0] * dout).sum()
+    for k, e in directional_grad_check(
+        f, {'x': x, 'gamma': gamma, 'beta': beta},
+        {'x': dx, 'gamma': dgamma, 'beta': dbeta},
+        num_directions, None, h, generator).items():
+      errors[layer.__name__ + '.' + k] = e
+  return errors
+
+
+def benchmark_pruning(model, X, y, amount=0.25, criterion='l1', data_dict=None,
+                      num_runs=3, **solver_kwargs):
+  """
+  Prune a trained DeepConvNet with prune_channels, optionally fine-tune the
+  pruned network with a Solver, and compare both networks on (X, y):
+  FLOPs per image, number of parameters, inference latency of loss(X) and
+  accuracy.
+
+  Inputs:
+  - model: A trained DeepConvNet
+  - X, y: Evaluation data and labels
+  - amount, criterion: Passed to prune_channels
+  - data_dict: If given, the pruned network is fine-tuned on it with
+    Solver(pruned, data_dict, **solver_kwargs)
+
+  Returns a tuple of:
+  - pruned: The pruned (and fine-tuned) network
+  - results: Dictionary mapping 'original' and 'pruned' to dictionaries
+    with the keys 'flops', 'params', 'latency' and 'accuracy'
+  """
+  pruned = model.prune_channels(amount, criterion)
+  if data_dict is not None:
+    solver = Solver(pruned, data_dict, **solver_kwargs)
+    solver.train()
+
+  results = {}
+  for name, m in [('original', model), ('pruned', pruned)]:
+    with torch.no_grad():
+      accuracy = (m.loss(X).argmax(dim=1) == y).float().mean().item()
+      latency = time_per_call(lambda: m.loss(X), num_runs, X.device)
+    results[name] = {
+      'flops': m.flops(tuple(X.shape[1:])),
+      'params': sum(p.numel() for p in m.params.values()),
+      'latency': latency,
+      'accuracy': accuracy,
+    }
+
+  base = results['original']
+  for name, r in results.items():
+    print('%-8s %8.2f MFLOPs (%.2fx)  %8d params  latency %.4fs (%.2fx)  accuracy %.4f'
+          % (name, r['flops'] / 1e6, base['flops'] / r['flops'], r['params'],
+             r['latency'], base['latency'] / r['latency'], r['accuracy']))
+  return pruned, results
@@ -3,7 +3,15 @@ Implements fully connected networks in PyTorch.
 WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
 import torch
+import torch.multiprocessing as mp
 import random
+import math
+import json
+import os
+import queue
+import threading
+import time
+import traceback
 from a3_helper import svm_loss, softmax_loss
 from eecs598 import Solver
 
@@ -15,6 +23,63 @@ def hello_fully_connected_networks():
   print('Hello from fully_connected_networks.py!')
 
 
+def peak_memory_usage(fn, device='cpu'):
+  """
+  Run fn() once and return the peak number of bytes allocated by PyTorch
+  while it runs, on top of what was already allocated before.
+
+  On CUDA devices this is read from the caching allocator. On CPU there is
+  no allocator statistic, so the allocations and frees recorded by the
+  profiler are replayed in order to find the peak.
+  """
+  if torch.device(device).type == 'cuda':
+    torch.cuda.synchronize()
+    base = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() - base
+
+  activities = [torch.profiler.ProfilerActivity.CPU]
+  with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+    fn()
+  events = [e for e in prof.events() if e.name == '[memory]']
+  events.sort(key=lambda e: e.time_range.start)
+  live = peak = 0
+  for e in events:
+    live += e.cpu_memory_usage
+    peak = max(peak, live)
+  return peak
+
+
+def tensor_storages(obj):
+  """
+  Return a dictionary mapping the data pointer of every distinct tensor
+  storage reachable from obj (through nested tuples, lists and dicts) to its
+  size in bytes. Views of the same storage are counted once.
+  """
+  storages = {}
+  stack = [obj]
+  while stack:
+    obj = stack.pop()
+    if torch.is_tensor(obj):
+      storage = obj.untyped_storage()
+      storages[storage.data_ptr()] = storage.nbytes()
+    elif isinstance(obj, (tuple, list)):
+      stack.extend(obj)
+    elif isinstance(obj, dict):
+      stack.extend(obj.values())
+  return storages
+
+
+def cache_bytes(cache):
+  """
+  Return the number of bytes kept alive by a layer cache: the total size of
+  the distinct tensor storages reachable from it.
+  """
+  return sum(tensor_storages(cache).values())
+
+
 class Linear(object):
 
   @staticmethod
@@ -80,53 +145,93 @@ class Linear(object):
 class ReLU(object):
 
   @staticmethod
-  def forward(x):
+  def forward(x, inplace=False, pack=False):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
     Input:
     - x: Input; a tensor of any shape
+    - inplace: If True, x is overwritten with the output. Only use this when
+      nothing else needs x afterwards.
+    - pack: If True, the cache is the mask of x >= 0 bit-packed with
+      pack_mask (one bit per element).
     Returns a tuple of:
     - out: Output, a tensor of the same shape as x
-    - cache: x
+    - cache: x, or when inplace is True (x is gone) a bool mask of x >= 0;
+      the packed mask when pack is True
     """
     out = None
     #############################################################################
     # TODO: Implement the ReLU forward pass.                                    #
-    # You should not change the input tensor with an in-place operation.        #
+    # Unless inplace is True, you should not change the input tensor with an    #
+    # in-place operation.                                                       #
     #############################################################################
     # Replace "pass" statement with your code
-    out = x.clone()
-    out[out<0] = 0
+    if pack:
+      cache = pack_mask(x >= 0)
+    elif inplace:
+      cache = x >= 0
+    else:
+      cache = x
+    out = x.clamp_min_(0) if inplace else x.clamp_min(0)
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
-    cache = x
     return out, cache
 
   @staticmethod
-  def backward(dout, cache):
+  def backward(dout, cache, inplace=False):
     """
     Computes the backward pass for a layer of rectified linear units (ReLUs).
     Input:
     - dout: Upstream derivatives, of any shape
-    - cache: Input x, of same shape as dout
+    - cache: Input x or a bool mask of same shape as dout, or a mask packed
+      by pack_mask
+    - inplace: If True, dout is overwritten with dx.
     Returns:
     - dx: Gradient with respect to x
     """
-    dx, x = None, cache
+    dx = None
     #############################################################################
     # TODO: Implement the ReLU backward pass.                                   #
-    # You should not change the input tensor with an in-place operation.        #
+    # Unless inplace is True, you should not change the input tensor with an    #
+    # in-place operation.                                                       #
     #############################################################################
     # Replace "pass" statement with your code
-    dx = dout.clone()
-    dx[x<0] = 0
+    if cache.dtype == torch.uint8:
+      mask = unpack_mask(cache, dout.shape)
+    else:
+      mask = cache if cache.dtype == torch.bool else cache >= 0
+    dx = dout.mul_(mask) if inplace else dout * mask
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
     return dx
 
 
+def pack_mask(mask):
+  """
+  Pack a bool tensor into a flat uint8 tensor holding 8 mask bits per byte.
+  """
+  flat = mask.flatten()
+  pad = -flat.numel() % 8
+  if pad:
+    flat = torch.cat([flat, flat.new_zeros(pad)])
+  bits = torch.tensor([1, 2, 4, 8, 16, 32, 64, 128], dtype=torch.uint8, device=mask.device)
+  return (flat.view(-1, 8).to(torch.uint8) * bits).sum(dim=1, dtype=torch.uint8)
+
+
+def unpack_mask(packed, shape):
+  """
+  Inverse of pack_mask: return the bool tensor of the given shape.
+  """
+  shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+  flat = ((packed.unsqueeze(1) >> shifts) & 1).flatten().to(torch.bool)
+  numel = 1
+  for d in shape:
+    numel *= d
+  return flat[:numel].view(shape)
+
+
 class Linear_ReLU(object):
 
   @staticmethod
@@ -142,7 +247,7 @@ class Linear_ReLU(object):
     - cache: Object to give to the backward pass
     """
     a, fc_cache = Linear.forward(x, w, b)
-    out, relu_cache = ReLU.forward(a)
+    out, relu_cache = ReLU.forward(a, inplace=True)
     cache = (fc_cache, relu_cache)
     return out, cache
 
@@ -160,7 +265,7 @@ class Linear_ReLU(object):
 class Dropout(object):
 
   @staticmethod
-  def forward(x, dropout_param):
+  def forward(x, dropout_param, inplace=False):
     """
     Performs the forward pass for (inverted) dropout.
     Inputs:
@@ -172,10 +277,14 @@ class Dropout(object):
       - seed: Seed for the random number generator. Passing seed makes this
       function deterministic, which is needed for gradient checking but not
       in real networks.
+      - pack_mask: Optional; if True the mask is stored bit-packed (one bit
+      per element) instead of as a bool tensor (one byte per element).
+    - inplace: If True, x is overwritten with the output in train mode.
     Outputs:
     - out: Tensor of the same shape as x.
     - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+      mask that was used to multiply the input, already scaled by 1 / (1 - p)
+      (or the packed bool mask with pack_mask); in test mode, mask is None.
     NOTE: Please implement **inverted** dropout, not the vanilla version of dropout.
     See http://cs231n.github.io/neural-networks-2/#reg for more details.
     NOTE 2: Keep in mind that p is the probability of **dropping** a neuron
@@ -195,12 +304,12 @@ class Dropout(object):
       # Store the dropout mask in the mask variable.                            #
       ###########################################################################
       # Replace "pass" statement with your code
-      keep_prop = 1-p
-      mask = (torch.rand(x.shape) < keep_prop).to(x.device)
-      out = torch.zeros_like(x).to(x.device)
-      out[mask] = 1
-      out /= keep_prop
-      out *= x
+      keep_prop = 1 - p
+      # one buffer holding 0 or 1 / keep_prop, applied with a single multiply
+      mask = torch.empty_like(x).bernoulli_(keep_prop).div_(keep_prop)
+      out = x.mul_(mask) if inplace else x * mask
+      if dropout_param.get('pack_mask', False):
+        mask = pack_mask(mask != 0)
       ###########################################################################
       #                             END OF YOUR CODE                            #
       ###########################################################################
@@ -209,8 +318,7 @@ class Dropout(object):
       # TODO: Implement the test phase forward pass for inverted dropout.       #
       ###########################################################################
       # Replace "pass" statement with your code
-      mask = torch.ones_like(x).to(x.device)
-      out = x.clone().to(x.device)
+      out = x
       ###########################################################################
       #                             END OF YOUR CODE                            #
       ###########################################################################
@@ -220,12 +328,13 @@ class Dropout(object):
     return out, cache
 
   @staticmethod
-  def backward(dout, cache):
+  def backward(dout, cache, inplace=False):
     """
     Perform the backward pass for (inverted) dropout.
     Inputs:
     - dout: Upstream derivatives, of any shape
     - cache: (dropout_param, mask) from Dropout.forward.
+    - inplace: If True, dout is overwritten with dx.
     """
     dropout_param, mask = cache
     mode = dropout_param['mode']
@@ -236,8 +345,10 @@ class Dropout(object):
       # TODO: Implement training phase backward pass for inverted dropout       #
       ###########################################################################
       # Replace "pass" statement with your code
-      keep_prop = 1 - dropout_param['p']
-      dx = mask * dout / keep_prop
+      if mask.dtype == torch.uint8:
+        keep_prop = 1 - dropout_param['p']
+        mask = unpack_mask(mask, dout.shape).to(dout.dtype).div_(keep_prop)
+      dx = dout.mul_(mask) if inplace else dout * mask
       ###########################################################################
       #                            END OF YOUR CODE                             #
       ###########################################################################
@@ -262,7 +373,7 @@ class Linear_ReLU_Dropout(object):
     """
     out, cache = Linear_ReLU.forward(x, w, b)
     fc_cache, relu_cache = cache
-    out, dp_cache = Dropout.forward(out, dropout_param)
+    out, dp_cache = Dropout.forward(out, dropout_param, inplace=True)
     cache = (fc_cache, relu_cache, dp_cache)
     return out, cache
 
@@ -273,7 +384,7 @@ class Linear_ReLU_Dropout(object):
     """
     fc_cache, relu_cache, dp_cache = cache
     ddp_out = Dropout.backward(dout, dp_cache)
-    drl_out = ReLU.backward(ddp_out, relu_cache)
+    drl_out = ReLU.backward(ddp_out, relu_cache, inplace=True)
     dx, dw, db = Linear.backward(drl_out, fc_cache)
     return dx, dw, db
 
@@ -411,6 +522,97 @@ class TwoLayerNet(object):
 
     return loss, grads
 
+def save_sharded_checkpoint(path, meta, tensors, shard_bytes=64 * 2 ** 20,
+                            background=False):
+  """
+  Write a checkpoint as a directory of shard files. The tensors are split
+  into shards of about shard_bytes, each written with torch.save, and
+  index.json holds meta (which must be JSON serializable) and the shard of
+  every tensor. The index is written last, so an unfinished checkpoint is
+  never picked up by load_sharded_checkpoint.
+
+  The tensors are first copied to CPU, so training may keep updating them
+  in place while the files are written.
+
+  Inputs:
+  - path: Directory of the checkpoint; created if needed
+  - meta: Dictionary of non-tensor values to store
+  - tensors: Dictionary mapping names to tensors
+  - shard_bytes: Approximate size of every shard file
+  - background: If True, write the files from a background thread
+
+  Returns:
+  - thread: With background=True the writing threading.Thread; join() it
+    before reading the checkpoint. None otherwise.
+  """
+  snapshot = {k: v.detach().to('cpu', copy=True) for k, v in tensors.items()}
+
+  def write():
+    os.makedirs(path, exist_ok=True)
+    shards, shard, size = [], {}, 0
+    for k, v in snapshot.items():
+      nbytes = v.numel() * v.element_size()
+      if shard and size + nbytes > shard_bytes:
+        shards.append(shard)
+        shard, size = {}, 0
+      shard[k] = v
+      size += nbytes
+    if shard:
+      shards.append(shard)
+
+    index = {}
+    for n, shard in enumerate(shards):
+      name = 'shard-%05d.pt' % n
+      torch.save(shard, os.path.join(path, name))
+      for k in shard:
+        index[k] = name
+    tmp = os.path.join(path, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+      json.dump({'meta': meta, 'tensors': index}, f)
+    os.replace(tmp, os.path.join(path, 'index.json'))
+
+  if not background:
+    write()
+    return None
+  thread = threading.Thread(target=write)
+  thread.start()
+  return thread
+
+
+def load_sharded_checkpoint(path, dtype=None, device='cpu'):
+  """
+  Read a checkpoint written by save_sharded_checkpoint, one shard and one
+  tensor at a time. Shards are memory-mapped when torch.load supports it,
+  and every tensor is converted with a single .to(device, dtype), so it is
+  copied at most once; a tensor that already has the target dtype on CPU
+  is used straight from the mapped file.
+
+  Inputs:
+  - path: Directory of the checkpoint
+  - dtype: Optional dtype for the floating point tensors; other tensors
+    keep their dtype
+  - device: Device of the returned tensors
+
+  Returns a tuple of:
+  - meta: The meta dictionary that was saved
+  - tensors: Dictionary mapping names to tensors, in the saved order
+  """
+  with open(os.path.join(path, 'index.json')) as f:
+    index = json.load(f)
+  tensors = {}
+  for name in sorted(set(index['tensors'].values())):
+    filename = os.path.join(path, name)
+    try:
+      shard = torch.load(filename, map_location='cpu', mmap=True)
+    except TypeError:
+      # torch.load has no mmap option before PyTorch 2.1
+      shard = torch.load(filename, map_location='cpu')
+    for k, v in shard.items():
+      target = dtype if dtype is not None and v.is_floating_point() else v.dtype
+      tensors[k] = v.to(device=device, dtype=target)
+  return index['meta'], tensors
+
+
 class FullyConnectedNet(object):
   """
   A fully-connected neural network with an arbitrary number of hidden layers,
@@ -427,7 +629,7 @@ class FullyConnectedNet(object):
 
   def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                dropout=0.0, reg=0.0, weight_scale=1e-2, seed=None,
-               dtype=torch.float, device='cpu'):
+               dtype=torch.float, device='cpu', checkpoint_every=None):
     """
     Initialize a new FullyConnectedNet.
 
@@ -447,8 +649,13 @@ class FullyConnectedNet(object):
       this datatype. float is faster but less accurate, so you should use
       double for numeric gradient checking.
     - device: device to use for computation. 'cpu' or 'cuda'
+    - checkpoint_every: Optional activation checkpointing policy. If an
+      integer k, the training forward pass keeps only the input of every k-th
+      hidden layer and the backward pass recomputes the rest; 'sqrt' picks
+      k = sqrt(L). None (default) keeps every activation.
     """
     self.use_dropout = dropout != 0
+    self.checkpoint_every = checkpoint_every
     self.reg = reg
     self.num_layers = 1 + len(hidden_dims)
     self.dtype = dtype
@@ -510,6 +717,55 @@ class FullyConnectedNet(object):
 
     print("load checkpoint file: {}".format(path))
 
+  def save_sharded(self, path, shard_bytes=64 * 2 ** 20, background=False):
+    """
+    Save the model as a sharded checkpoint directory, optionally from a
+    background thread; see save_sharded_checkpoint.
+    """
+    meta = {
+      'reg': self.reg,
+      'num_layers': self.num_layers,
+      'use_dropout': self.use_dropout,
+      'dropout_param': self.dropout_param,
+    }
+    tensors = {'params/' + k: v for k, v in self.params.items()}
+    return save_sharded_checkpoint(path, meta, tensors, shard_bytes, background)
+
+  def load_sharded(self, path, dtype, device):
+    """
+    Load a checkpoint written by save_sharded, tensor by tensor, straight
+    into dtype on device; see load_sharded_checkpoint.
+    """
+    meta, tensors = load_sharded_checkpoint(path, dtype, device)
+    self.params = {k[len('params/'):]: v for k, v in tensors.items()}
+    self.dtype = dtype
+    self.reg = meta['reg']
+    self.num_layers = meta['num_layers']
+    self.use_dropout = meta['use_dropout']
+    self.dropout_param = meta['dropout_param']
+    print("load checkpoint file: {}".format(path))
+
+  def _forward_layer(self, i, x, recompute=False):
+    """
+    Forward pass of hidden layer i; returns (out, cache). recompute is True
+    when activation checkpointing runs the layer again during backward.
+    """
+    W, b = self.params[f'W{i}'], self.params[f'b{i}']
+    if self.use_dropout:
+      return Linear_ReLU_Dropout.forward(x, W, b, self.dropout_param)
+    return Linear_ReLU.forward(x, W, b)
+
+  def _backward_layer(self, i, dout, cache, grads):
+    """
+    Backward pass of hidden layer i; stores the gradients of W{i} and b{i}
+    in grads and returns the gradient with respect to the layer input.
+    """
+    if self.use_dropout:
+      dx, grads[f'W{i}'], grads[f'b{i}'] = Linear_ReLU_Dropout.backward(dout, cache)
+    else:
+      dx, grads[f'W{i}'], grads[f'b{i}'] = Linear_ReLU.backward(dout, cache)
+    return dx
+
   def loss(self, X, y=None):
     """
     Compute loss and gradient for the fully-connected net.
@@ -534,12 +790,14 @@ class FullyConnectedNet(object):
     caches = {}
     layer = {}
     layer[0] = X
-    for i in range(1, self.num_layers):
-      if self.use_dropout:
-        layer[i], caches[i] = Linear_ReLU_Dropout.forward(layer[i-1], self.params[f'W{i}'], self.params[f'b{i}'], self.dropout_param)
-      else:
-        layer[i], caches[i] = Linear_ReLU.forward(layer[i-1], self.params[f'W{i}'], self.params[f'b{i}'])
-        
+    checkpoint_every = checkpoint_interval(self.checkpoint_every, self.num_layers)
+    if mode == 'train' and checkpoint_every:
+      layer[self.num_layers-1], checkpoints = checkpointed_forward(
+        self._forward_layer, X, self.num_layers, checkpoint_every)
+    else:
+      for i in range(1, self.num_layers):
+        layer[i], caches[i] = self._forward_layer(i, layer[i-1])
+
     scores, caches[self.num_layers] = Linear.forward(layer[self.num_layers-1], self.params[f'W{self.num_layers}'], self.params[f'b{self.num_layers}'])
     ############################################################################
     #                             END OF YOUR CODE                             #
@@ -563,12 +821,14 @@ class FullyConnectedNet(object):
     loss, dout = softmax_loss(scores, y)
     dx = {}
     dx[self.num_layers], grads[f'W{self.num_layers}'], grads[f'b{self.num_layers}'] = Linear.backward(dout, caches[self.num_layers])
-    for i in reversed(range(1, self.num_layers)):
-      if self.use_dropout:
-        dx[i], grads[f'W{i}'], grads[f'b{i}'] = Linear_ReLU_Dropout.backward(dx[i+1], caches[i])
-      else:
-        dx[i], grads[f'W{i}'], grads[f'b{i}'] = Linear_ReLU.backward(dx[i+1], caches[i])
-    
+    if checkpoint_every:
+      dx[1] = checkpointed_backward(self._forward_layer, self._backward_layer,
+                                    dx[self.num_layers], checkpoints,
+                                    self.num_layers, grads)
+    else:
+      for i in reversed(range(1, self.num_layers)):
+        dx[i] = self._backward_layer(i, dx[i+1], caches[i], grads)
+
     for i in range(1, self.num_layers + 1):
       loss += 0.5 * self.reg * torch.sum(self.params[f'W{i}'] * self.params[f'W{i}'])
       grads[f'W{i}'] += self.reg * self.params[f'W{i}']
@@ -579,7 +839,458 @@ class FullyConnectedNet(object):
     return loss, grads
 
 
-def create_solver_instance(data_dict, dtype, device):
+def checkpoint_interval(checkpoint_every, num_layers):
+  """
+  Resolve a checkpoint_every policy (None, an integer, or 'sqrt') to the
+  number of hidden layers per checkpointed segment, or None if disabled.
+  """
+  if checkpoint_every is None:
+    return None
+  if checkpoint_every == 'sqrt':
+    return max(1, int(round(math.sqrt(num_layers - 1))))
+  return int(checkpoint_every)
+
+
+def checkpointed_forward(forward_layer, x, num_layers, every):
+  """
+  Training forward pass through hidden layers 1, ..., num_layers - 1 that
+  keeps only the input of every every-th layer (a checkpoint) and throws
+  all other outputs and caches away.
+
+  Inputs:
+  - forward_layer: Function (i, x, recompute=False) -> (out, cache)
+  - x: Input of layer 1
+  - num_layers: Number of layers of the model, including the output layer
+  - every: Number of layers per checkpointed segment
+
+  Returns a tuple of:
+  - out: Output of layer num_layers - 1
+  - checkpoints: Dictionary mapping the first layer i of each segment to
+    (input of layer i, RNG state before layer i), for checkpointed_backward
+  """
+  checkpoints = {}
+  for i in range(1, num_layers):
+    if (i - 1) % every == 0:
+      rng_state = [torch.get_rng_state()]
+      if x.is_cuda:
+        rng_state.append(torch.cuda.get_rng_state(x.device))
+      checkpoints[i] = (x, rng_state)
+    x, _ = forward_layer(i, x)
+  return x, checkpoints
+
+
+def checkpointed_backward(forward_layer, backward_layer, dout, checkpoints,
+                          num_layers, grads):
+  """
+  Backward pass matching checkpointed_forward. Segments are processed from
+  the last to the first: the caches of a segment are rebuilt by running its
+  layers forward again from the checkpoint, with the RNG state restored so
+  that dropout draws the same masks, and then the segment is backpropagated
+  and its caches are released.
+
+  Inputs:
+  - forward_layer: Same as checkpointed_forward; called with recompute=True
+  - backward_layer: Function (i, dout, cache, grads) -> dx, which stores the
+    parameter gradients of layer i in grads
+  - dout: Upstream derivative with respect to the output of the last hidden
+    layer
+  - checkpoints, num_layers: Same as checkpointed_forward
+  - grads: Dictionary that receives the parameter gradients
+
+  Returns:
+  - dx: Gradient with respect to the input of layer 1
+  """
+  end = num_layers
+  for start in sorted(checkpoints, reverse=True):
+    x, rng_state = checkpoints.pop(start)
+    caches = {}
+    devices = [x.device] if x.is_cuda else []
+    with torch.random.fork_rng(devices=devices):
+      torch.set_rng_state(rng_state[0])
+      if x.is_cuda:
+        torch.cuda.set_rng_state(rng_state[1], x.device)
+      for i in range(start, end):
+        x, caches[i] = forward_layer(i, x, recompute=True)
+    for i in reversed(range(start, end)):
+      dout = backward_layer(i, dout, caches.pop(i), grads)
+    end = start
+  return dout
+
+
+def _relative_error(numeric, analytic, atol=1e-8):
+  """
+  Relative error in the form of eecs598.grad.rel_error: the largest absolute
+  difference divided by the largest magnitude. Only when both are below
+  atol, as for a gradient that is exactly zero (e.g. the bias of a conv that
+  feeds batchnorm, whose numeric value is pure round-off), the absolute
+  difference is returned instead.
+  """
+  top = (numeric - analytic).abs().max().item()
+  bot = (numeric.abs() + analytic.abs()).max().item()
+  if bot < atol:
+    return top
+  return top / bot
+
+
+def random_direction(shape, num_coords=None, dtype=torch.float64, device='cpu',
+                     generator=None):
+  """
+  Return a random Gaussian direction of the given shape. If num_coords is
+  given, only that many randomly chosen coordinates are nonzero.
+  """
+  v = torch.randn(shape, dtype=dtype, generator=generator)
+  numel = v.numel()
+  if num_coords is not None and num_coords < numel:
+    mask = torch.zeros(numel, dtype=dtype)
+    mask[torch.randperm(numel, generator=generator)[:num_coords]] = 1
+    v *= mask.view(shape)
+  return v.to(device)
+
+
+def directional_grad_check(f, tensors, grads, num_directions=5, num_coords=None,
+                           h=1e-6, generator=None):
+  """
+  Check analytic gradients with directional derivatives. Instead of
+  perturbing one coordinate at a time, every tensor is perturbed along a few
+  random directions v; the central difference (f(x + hv) - f(x - hv)) / 2h
+  must match <grad, v>. Each check costs two evaluations of f regardless of
+  the size of the tensor, and a wrong gradient formula changes <grad, v>
+  for almost every v.
+
+  Inputs:
+  - f: Function with no arguments that returns the scalar value computed
+    from the current contents of tensors
+  - tensors: Dictionary of tensors; they are perturbed in place and restored
+  - grads: Dictionary with the analytic gradient of f for every tensor
+  - num_directions: Number of random directions per tensor
+  - num_coords: Optional number of randomly sampled coordinates that every
+    direction is supported on; None perturbs all coordinates
+  - h: Step size of the finite differences
+  - generator: Optional torch.Generator for the directions
+
+  Returns:
+  - errors: Dictionary mapping every name in tensors to the largest
+    relative error over its directions
+  """
+  errors = {}
+  with torch.no_grad():
+    for k, x in tensors.items():
+      numeric = torch.empty(num_directions, dtype=torch.float64)
+      analytic = torch.empty(num_directions, dtype=torch.float64)
+      for d in range(num_directions):
+        v = random_direction(x.shape, num_coords, x.dtype, x.device, generator)
+        x.add_(v, alpha=h)
+        fp = float(f())
+        x.add_(v, alpha=-2 * h)
+        fm = float(f())
+        x.add_(v, alpha=h)
+        numeric[d] = (fp - fm) / (2 * h)
+        analytic[d] = (grads[k] * v).sum().item()
+      errors[k] = _relative_error(numeric, analytic)
+  return errors
+
+
+def batched_directional_grad_check(forward, x, dout, dx, num_directions=16,
+                                   h=1e-6, generator=None):
+  """
+  Directional gradient check of a layer input in a single forward pass.
+  The 2 * num_directions perturbed copies x + hv and x - hv are stacked
+  along the batch dimension and evaluated with one call to forward, so this
+  only applies to layers that treat the samples independently (conv,
+  pooling, ReLU, linear; not batchnorm in train mode).
+
+  Inputs:
+  - forward: Function mapping a batch of inputs to the layer output
+  - x: Input of shape (N, ...)
+  - dout: Upstream derivative; the checked scalar is sum(forward(x) * dout)
+  - dx: Analytic gradient with respect to x
+  - num_directions, h, generator: As in directional_grad_check
+
+  Returns:
+  - The largest relative error over the directions
+  """
+  K, N = num_directions, x.shape[0]
+  v = random_direction((K,) + tuple(x.shape), None, x.dtype, x.device, generator)
+  with torch.no_grad():
+    X = torch.cat([x + h * v, x - h * v]).reshape((2 * K * N,) + tuple(x.shape[1:]))
+    out = forward(X).reshape((2, K) + tuple(dout.shape))
+    values = (out * dout).flatten(2).sum(dim=2)
+  numeric = (values[0] - values[1]) / (2 * h)
+  analytic = (dx * v).flatten(1).sum(dim=1)
+  return _relative_error(numeric, analytic)
+
+
+def check_model_gradients(model, X, y, num_directions=3, num_coords=None,
+                          h=1e-6, seed=0):
+  """
+  Check all gradients returned by model.loss(X, y) with
+  directional_grad_check; use a float64 model. Batchnorm running statistics
+  are updated by the extra loss evaluations, which does not change the
+  training loss.
+
+  Unlike batched_directional_grad_check for layer inputs, the directions of
+  a parameter cannot be stacked into one batch, since model.loss takes a
+  single set of weights; every direction costs two loss evaluations. Use
+  num_directions and num_coords to bound the cost. A model with dropout
+  must fix dropout_param['seed'] (the seed argument of FullyConnectedNet),
+  otherwise every evaluation draws a new mask.
+
+  Returns: Dictionary mapping every parameter name to its relative error.
+  """
+  if getattr(model, 'use_dropout', False) and 'seed' not in model.dropout_param:
+    raise ValueError('check_model_gradients needs a fixed dropout seed; '
+                     'build the model with seed=...')
+  _, grads = model.loss(X, y)
+  generator = torch.Generator().manual_seed(seed)
+  return directional_grad_check(lambda: model.loss(X, y)[0], model.params,
+                                grads, num_directions, num_coords, h, generator)
+
+
+def augment_batch(X, crop_padding=4, flip=True, generator=None, out=None):
+  """
+  Randomly crop and horizontally flip a batch of images. Every image is
+  zero-padded by crop_padding pixels on each side and a window of the
+  original size is cut out at a random offset; then it is mirrored with
+  probability 1/2. All images are processed with one gather.
+
+  Inputs:
+  - X: Images of shape (N, C, H, W)
+  - crop_padding: Maximum shift of the crop in pixels; 0 disables cropping
+  - flip: Whether to apply random horizontal flips
+  - generator: Optional torch.Generator used for the random choices
+  - out: Optional tensor of the shape of X to write the result to
+
+  Returns:
+  - out: The augmented images
+  """
+  N, C, H, W = X.shape
+  p = crop_padding
+  rows = torch.arange(H).view(1, H)
+  cols = torch.arange(W).view(1, W)
+  if p > 0:
+    X = torch.nn.functional.pad(X, (p, p, p, p))
+    rows = rows + torch.randint(2 * p + 1, (N, 1), generator=generator)
+    cols = cols + torch.randint(2 * p + 1, (N, 1), generator=generator)
+  else:
+    rows, cols = rows.expand(N, H), cols.expand(N, W)
+  if flip:
+    # a flipped crop reads its columns right to left
+    flips = torch.rand(N, 1, generator=generator) < 0.5
+    cols = torch.where(flips, cols.flip(1), cols)
+
+  n = torch.arange(N).view(N, 1, 1, 1)
+  c = torch.arange(C).view(1, C, 1, 1)
+  result = X[n, c, rows.view(N, 1, H, 1), cols.view(N, 1, 1, W)]
+  if out is None:
+    return result
+  out.copy_(result)
+  return out
+
+
+def _prefetch_worker(X, y, slots_X, slots_y, free_slots, ready_slots,
+                     crop_padding, flip, seed):
+  """
+  Worker process of PrefetchLoader: fills free ring buffer slots with random
+  augmented minibatches until it receives None.
+  """
+  torch.set_num_threads(1)
+  generator = torch.Generator().manual_seed(seed)
+  num_train, batch_size = X.shape[0], slots_X.shape[1]
+  while True:
+    slot = free_slots.get()
+    if slot is None:
+      return
+    batch_mask = torch.randperm(num_train, generator=generator)[:batch_size]
+    if X.dim() == 4 and (crop_padding > 0 or flip):
+      augment_batch(X[batch_mask], crop_padding, flip, generator, out=slots_X[slot])
+    else:
+      torch.index_select(X, 0, batch_mask, out=slots_X[slot])
+    torch.index_select(y, 0, batch_mask, out=slots_y[slot])
+    ready_slots.put(slot)
+
+
+class PrefetchLoader(object):
+  """
+  Prepares random (and optionally augmented) minibatches in worker processes
+  ahead of the training loop.
+
+  The training data and a ring buffer of `depth` batch slots live in shared
+  memory. Workers take free slots from one queue, fill them and hand them
+  back through a second queue, so batches are never pickled. next_batch()
+  returns views into a slot; the slot is recycled on the following call, so
+  a batch is valid until the next one is requested.
+
+  The loader counts how often and for how long the training thread had to
+  wait for a batch: `stalls` and `stall_time` (seconds).
+  """
+
+  def __init__(self, X, y, batch_size, num_workers=2, depth=4,
+               crop_padding=4, flip=True, seed=0):
+    """
+    Inputs:
+    - X, y: Training data and labels; they are moved to shared CPU memory
+    - batch_size: Size of every minibatch
+    - num_workers: Number of worker processes
+    - depth: Number of batch slots in the ring buffer; should exceed
+      num_workers so that workers are not starved while a batch is in use
+    - crop_padding, flip: Augmentation of 4D image data, see augment_batch
+    - seed: Base seed; worker k uses seed + k
+    """
+    self.X = X.cpu().share_memory_()
+    self.y = y.cpu().share_memory_()
+    self.slots_X = torch.empty((depth, batch_size) + tuple(X.shape[1:]),
+                               dtype=X.dtype).share_memory_()
+    self.slots_y = torch.empty((depth, batch_size), dtype=y.dtype).share_memory_()
+    self.free_slots = mp.Queue()
+    self.ready_slots = mp.Queue()
+    for slot in range(depth):
+      self.free_slots.put(slot)
+
+    self.stalls = 0
+    self.stall_time = 0.0
+    self.num_batches = 0
+    self.current = None
+    self.workers = []
+    for k in range(num_workers):
+      worker = mp.Process(target=_prefetch_worker, daemon=True,
+        args=(self.X, self.y, self.slots_X, self.slots_y, self.free_slots,
+              self.ready_slots, crop_padding, flip, seed + k))
+      worker.start()
+      self.workers.append(worker)
+
+  def next_batch(self):
+    """
+    Returns a tuple (X_batch, y_batch) of the next prepared minibatch.
+    """
+    if not self.workers:
+      raise RuntimeError('next_batch() called on a closed PrefetchLoader')
+    if self.current is not None:
+      self.free_slots.put(self.current)
+      self.current = None
+    try:
+      slot = self.ready_slots.get_nowait()
+    except queue.Empty:
+      self.stalls += 1
+      tic = time.perf_counter()
+      while True:
+        try:
+          slot = self.ready_slots.get(timeout=1.0)
+          break
+        except queue.Empty:
+          if not all(w.is_alive() for w in self.workers):
+            raise RuntimeError('a PrefetchLoader worker exited unexpectedly')
+      self.stall_time += time.perf_counter() - tic
+    self.current = slot
+    self.num_batches += 1
+    return self.slots_X[slot], self.slots_y[slot]
+
+  def close(self):
+    """
+    Stops and joins the worker processes.
+    """
+    for _ in self.workers:
+      self.free_slots.put(None)
+    for worker in self.workers:
+      worker.join()
+    self.workers = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class BatchSolver(Solver):
+  """
+  A Solver whose _step is split into hooks that subclasses override instead
+  of copying the whole step:
+
+  - _next_batch() returns the (X_batch, y_batch) minibatch on self.device.
+  - _loss_and_grads(X_batch, y_batch) returns (loss, grads); grads may be
+    None to skip the parameter update for this step.
+  - _update(grads) applies the update rule to every parameter.
+
+  With the default hooks this trains exactly like Solver. Subclasses that
+  override different hooks can be combined by multiple inheritance.
+  """
+
+  def _next_batch(self):
+    num_train = self.X_train.shape[0]
+    batch_mask = torch.randperm(num_train)[:self.batch_size]
+    X_batch = self.X_train[batch_mask].to(self.device)
+    y_batch = self.y_train[batch_mask].to(self.device)
+    return X_batch, y_batch
+
+  def _loss_and_grads(self, X_batch, y_batch):
+    return self.model.loss(X_batch, y_batch)
+
+  def _update(self, grads):
+    with torch.no_grad():
+      for p, w in self.model.params.items():
+        dw = grads[p]
+        config = self.optim_configs[p]
+        next_w, next_config = self.update_rule(w, dw, config)
+        self.model.params[p] = next_w
+        self.optim_configs[p] = next_config
+
+  def _step(self):
+    """
+    Make a single gradient update. This is called by train() and should not
+    be called manually.
+    """
+    X_batch, y_batch = self._next_batch()
+    loss, grads = self._loss_and_grads(X_batch, y_batch)
+    self.loss_history.append(loss.item())
+    if grads is not None:
+      self._update(grads)
+
+
+class PrefetchSolver(BatchSolver):
+  """
+  A Solver that takes its training minibatches from a PrefetchLoader instead
+  of slicing data['X_train'] on the training thread. It accepts the Solver
+  arguments plus the PrefetchLoader options num_workers, depth,
+  crop_padding, flip and seed. Each call to train() starts a fresh loader,
+  available as self.loader, and closes it when train() returns.
+  """
+
+  def __init__(self, model, data, **kwargs):
+    self.loader_kwargs = {k: kwargs.pop(k) for k in
+                          ('num_workers', 'depth', 'crop_padding', 'flip',
+                           'seed')
+                          if k in kwargs}
+    super().__init__(model, data, **kwargs)
+    self.loader = None
+
+  def _next_batch(self):
+    if self.loader is None:
+      raise RuntimeError('PrefetchSolver batches are only available '
+                         'inside train()')
+    X_batch, y_batch = self.loader.next_batch()
+    X_batch = X_batch.to(self.device, non_blocking=True)
+    y_batch = y_batch.to(self.device, non_blocking=True)
+    return X_batch, y_batch
+
+  def train(self, *args, **kwargs):
+    self.loader = PrefetchLoader(self.X_train, self.y_train, self.batch_size,
+                                 **self.loader_kwargs)
+    try:
+      result = super().train(*args, **kwargs)
+    finally:
+      self.loader.close()
+    if self.verbose:
+      print('data loader: %d stalls in %d batches, %.2fs waiting' % (
+        self.loader.stalls, self.loader.num_batches, self.loader.stall_time))
+    return result
+
+
+def create_solver_instance(data_dict, dtype, device, prefetch=False):
+  """
+  Inputs:
+  - prefetch: If True, train with a PrefetchSolver, which prepares augmented
+    minibatches in background worker processes.
+  """
   model = TwoLayerNet(hidden_dim=200, dtype=dtype, device=device)
   ##############################################################################
   # TODO: Use a Solver instance to train a TwoLayerNet that achieves at least  #
@@ -587,7 +1298,8 @@ def create_solver_instance(data_dict, dtype, device):
   ##############################################################################
   solver = None
   # Replace "pass" statement with your code
-  solver = Solver(model, data_dict,
+  solver_class = PrefetchSolver if prefetch else Solver
+  solver = solver_class(model, data_dict,
           update_rule=sgd,
           optim_config={
             'learning_rate': 1,
@@ -650,6 +1362,8 @@ def sgd(w, dw, config=None):
 def sgd_momentum(w, dw, config=None):
   """
   Performs stochastic gradient descent with momentum.
+  w and the velocity are updated in place, so the rule also works on a flat
+  parameter buffer whose views are held by a model (see FlatParams).
   config format:
   - learning_rate: Scalar learning rate.
   - momentum: Scalar between 0 and 1 giving the momentum value.
@@ -660,7 +1374,9 @@ def sgd_momentum(w, dw, config=None):
   if config is None: config = {}
   config.setdefault('learning_rate', 1e-2)
   config.setdefault('momentum', 0.9)
-  v = config.get('velocity', torch.zeros_like(w))
+  v = config.get('velocity')
+  if v is None:
+    v = torch.zeros_like(w)
 
   next_w = None
   #############################################################################
@@ -671,8 +1387,8 @@ def sgd_momentum(w, dw, config=None):
   mu = config['momentum']
   learning_rate = config['learning_rate']
 
-  v = mu * v - learning_rate * dw # integrate velocity
-  next_w = v + w # integrate position
+  v.mul_(mu).add_(dw, alpha=-learning_rate) # integrate velocity
+  next_w = w.add_(v) # integrate position
   #############################################################################
   #                              END OF YOUR CODE                             #
   #############################################################################
@@ -684,6 +1400,7 @@ def rmsprop(w, dw, config=None):
   """
   Uses the RMSProp update rule, which uses a moving average of squared
   gradient values to set adaptive per-parameter learning rates.
+  w and the cache are updated in place.
   config format:
   - learning_rate: Scalar learning rate.
   - decay_rate: Scalar between 0 and 1 giving the decay rate for the squared
@@ -695,7 +1412,8 @@ def rmsprop(w, dw, config=None):
   config.setdefault('learning_rate', 1e-2)
   config.setdefault('decay_rate', 0.99)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('cache', torch.zeros_like(w))
+  if 'cache' not in config:
+    config['cache'] = torch.zeros_like(w)
 
   next_w = None
   ###########################################################################
@@ -704,9 +1422,11 @@ def rmsprop(w, dw, config=None):
   # config['cache'].                                                        #
   ###########################################################################
   # Replace "pass" statement with your code
-
-  config['cache'] = config['decay_rate'] * config['cache'] + (1 - config['decay_rate']) * dw.pow(2)
-  next_w = w - config['learning_rate'] * dw / (torch.sqrt(config['cache']) + config['epsilon'])
+  decay_rate = config['decay_rate']
+  config['cache'].mul_(decay_rate).addcmul_(dw, dw, value=1 - decay_rate)
+  denom = _scratch(config, w)
+  torch.sqrt(config['cache'], out=denom).add_(config['epsilon'])
+  next_w = w.addcdiv_(dw, denom, value=-config['learning_rate'])
   ###########################################################################
   #                             END OF YOUR CODE                            #
   ###########################################################################
@@ -717,6 +1437,7 @@ def adam(w, dw, config=None):
   """
   Uses the Adam update rule, which incorporates moving averages of both the
   gradient and its square and a bias correction term.
+  w and the moments are updated in place.
   config format:
   - learning_rate: Scalar learning rate.
   - beta1: Decay rate for moving average of first moment of gradient.
@@ -731,8 +1452,10 @@ def adam(w, dw, config=None):
   config.setdefault('beta1', 0.9)
   config.setdefault('beta2', 0.999)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('m', torch.zeros_like(w))
-  config.setdefault('v', torch.zeros_like(w))
+  if 'm' not in config:
+    config['m'] = torch.zeros_like(w)
+  if 'v' not in config:
+    config['v'] = torch.zeros_like(w)
   config.setdefault('t', 0)
 
   next_w = None
@@ -745,14 +1468,240 @@ def adam(w, dw, config=None):
   # using it in any calculations.                                             #
   #############################################################################
   # Replace "pass" statement with your code
+  beta1, beta2 = config['beta1'], config['beta2']
   config['t'] = config['t'] + 1
-  config['m'] = config['beta1']*config['m'] + (1-config['beta1'])*dw
-  config['v'] = config['beta2']*config['v'] + (1-config['beta2'])*(dw.pow(2))
-  mt = config['m'] / (1-(config['beta1']**config['t']))
-  vt = config['v'] / (1-(config['beta2']**config['t']))
-  next_w = w - (config['learning_rate'] * mt) / (torch.sqrt(vt) + config['epsilon'])
+  config['m'].mul_(beta1).add_(dw, alpha=1 - beta1)
+  config['v'].mul_(beta2).addcmul_(dw, dw, value=1 - beta2)
+  bias1 = 1 - beta1 ** config['t']
+  bias2 = 1 - beta2 ** config['t']
+  # w -= lr * (m / bias1) / (sqrt(v / bias2) + eps)
+  denom = _scratch(config, w)
+  torch.sqrt(config['v'], out=denom).div_(math.sqrt(bias2)).add_(config['epsilon'])
+  next_w = w.addcdiv_(config['m'], denom, value=-config['learning_rate'] / bias1)
   #############################################################################
   #                              END OF YOUR CODE                             #
   #############################################################################
 
   return next_w, config
+
+
+def _scratch(config, w):
+  """
+  Return a scratch tensor shaped like w that is kept in config, so that the
+  update rules do not allocate a temporary on every step.
+  """
+  buf = config.get('scratch')
+  if buf is None or buf.shape != w.shape:
+    buf = config['scratch'] = torch.empty_like(w)
+  return buf
+
+
+class _FlatParamDict(dict):
+  """
+  The {'flat': buffer} params dictionary of FlatParams. Assigning a tensor to
+  an entry copies it into the buffer instead of replacing the buffer, so the
+  model's parameter views always see the new values.
+  """
+
+  def __setitem__(self, key, value):
+    buf = self[key]
+    if value is not buf:
+      buf.copy_(value)
+
+
+class FlatParams(object):
+  """
+  Wraps a model so that all of its parameters live in one contiguous buffer.
+  model.params[k] is replaced by a view into the buffer, and the wrapper
+  exposes the buffer as a single parameter, self.params = {'flat': buffer}.
+  Its loss() gathers the model's gradients into one flat gradient buffer.
+
+  Handing the wrapper to a Solver makes it call the update rule once per step
+  for the whole model instead of once per tensor, with a single config dict.
+  Since the update rules work in place, the model's parameter views see every
+  update. Every view keeps the strides of the parameter it replaces, so
+  channels-last weights stay channels-last.
+
+  Assigning to params (as Solver.train does with its best params) or to
+  params['flat'] copies the values into the buffer, so the wrapped model
+  always holds them. Do not reassign model.params[k] (for example with
+  model.load) while the wrapper is in use. All other attributes are
+  forwarded to the wrapped model.
+  """
+
+  def __init__(self, model):
+    self.model = model
+    self.keys = list(model.params)
+    first = model.params[self.keys[0]]
+    total = sum(model.params[k].numel() for k in self.keys)
+    self.flat = torch.empty(total, dtype=first.dtype, device=first.device)
+    self.flat_grad = torch.empty_like(self.flat)
+
+    offset = 0
+    self.grad_views = {}
+    for k in self.keys:
+      p = model.params[k]
+      view = self.flat.as_strided(p.shape, p.stride(), offset)
+      view.copy_(p)
+      model.params[k] = view
+      self.grad_views[k] = self.flat_grad.as_strided(p.shape, p.stride(), offset)
+      offset += p.numel()
+    self._params = _FlatParamDict(flat=self.flat)
+
+  @property
+  def params(self):
+    return self._params
+
+  @params.setter
+  def params(self, new):
+    self.flat.copy_(new['flat'])
+
+  def loss(self, X, y=None):
+    """
+    Same as model.loss, but returns the gradients as {'flat': flat_grad}.
+    """
+    out = self.model.loss(X, y)
+    if y is None:
+      return out
+    loss, grads = out
+    for k in self.keys:
+      self.grad_views[k].copy_(grads[k])
+    return loss, {'flat': self.flat_grad}
+
+  def __getattr__(self, name):
+    if name == 'model':
+      raise AttributeError(name)
+    return getattr(self.model, name)
+
+
+def _data_parallel_worker(rank, model, grad_buffer, tasks, results, seed,
+                          num_threads):
+  """
+  Worker process of DataParallel: runs model.loss on the shards it receives
+  and writes the gradients into row `rank` of the shared grad_buffer.
+  """
+  if num_threads:
+    torch.set_num_threads(num_threads)
+  torch.manual_seed(seed + rank)
+  # model.params are views into the shared flat buffer, so the storage
+  # offset of each one is its offset in a row of grad_buffer
+  row = rank * grad_buffer.shape[1]
+  grad_views = {k: grad_buffer.as_strided(p.shape, p.stride(), row + p.storage_offset())
+                for k, p in model.params.items()}
+  bn_params = getattr(model, 'bn_params', [])
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    X, y, bn_stats = task
+    try:
+      for bn_param, stats in zip(bn_params, bn_stats or []):
+        bn_param['running_mean'], bn_param['running_var'] = stats
+      loss, grads = model.loss(X, y)
+      for k, view in grad_views.items():
+        view.copy_(grads[k])
+      stats = [(p['running_mean'], p['running_var']) for p in bn_params]
+      results.put((rank, loss.item(), stats))
+    except Exception:
+      results.put((rank, None, traceback.format_exc()))
+
+
+class DataParallel(FlatParams):
+  """
+  Synchronous data-parallel training of a model on several CPU processes.
+
+  Like FlatParams, the wrapper exposes the model's parameters as one flat
+  buffer, which is moved to shared memory so that every worker process
+  reads the same weights and sees each update. loss(X, y) splits the
+  minibatch into one shard per worker; each worker writes its gradients to
+  its own row of a shared (num_workers, D) buffer and the rows are reduced
+  into the flat gradient, weighted by shard size, with one matrix-vector
+  product. Hand the wrapper to a Solver (whose update rule then runs on the
+  shared buffer) or call loss() and update the flat buffer directly.
+
+  Batchnorm layers normalize with the statistics of their own shard. After
+  every step the running_mean / running_var of the workers are averaged,
+  weighted by shard size, stored in the wrapped model's bn_params and sent
+  to all workers with the next shard, so they stay identical everywhere.
+  Test-time scores (y is None) are computed by the calling process.
+  """
+
+  def __init__(self, model, num_workers=2, num_threads=None, seed=0):
+    """
+    Inputs:
+    - model: A model with params and loss(X, y), such as FullyConnectedNet
+      or DeepConvNet, whose params are CPU tensors
+    - num_workers: Number of worker processes
+    - num_threads: Optional number of torch threads per worker; by default
+      the cores are divided evenly between the workers
+    - seed: Base seed of the workers' random generators (for dropout)
+    """
+    super().__init__(model)
+    self.flat.share_memory_()
+    self.num_workers = num_workers
+    self.grad_buffer = torch.zeros((num_workers, self.flat.numel()),
+                                   dtype=self.flat.dtype).share_memory_()
+    if num_threads is None:
+      num_threads = max(1, torch.get_num_threads() // num_workers)
+    self.tasks = [mp.Queue() for _ in range(num_workers)]
+    self.results = mp.Queue()
+    self.workers = []
+    for rank in range(num_workers):
+      worker = mp.Process(target=_data_parallel_worker, daemon=True,
+        args=(rank, model, self.grad_buffer, self.tasks[rank], self.results,
+              seed, num_threads))
+      worker.start()
+      self.workers.append(worker)
+
+  def loss(self, X, y=None):
+    """
+    Same as FlatParams.loss, with the loss and gradients computed by the
+    workers on shards of the minibatch.
+    """
+    if y is None:
+      return self.model.loss(X)
+    X = X.cpu().share_memory_()
+    y = y.cpu().share_memory_()
+    N = X.shape[0]
+    bn_params = getattr(self.model, 'bn_params', [])
+    bn_stats = [(p['running_mean'], p['running_var']) for p in bn_params
+                if 'running_mean' in p] or None
+
+    weights = torch.zeros(self.num_workers, dtype=self.flat.dtype)
+    for rank, (X_shard, y_shard) in enumerate(zip(X.tensor_split(self.num_workers),
+                                                  y.tensor_split(self.num_workers))):
+      if X_shard.shape[0] > 0:
+        weights[rank] = X_shard.shape[0] / N
+        self.tasks[rank].put((X_shard, y_shard, bn_stats))
+
+    loss = 0.0
+    new_stats = [[] for _ in bn_params]
+    for _ in range(int((weights > 0).sum())):
+      rank, shard_loss, stats = self.results.get()
+      if shard_loss is None:
+        raise RuntimeError('DataParallel worker %d failed:\n%s' % (rank, stats))
+      loss += weights[rank].item() * shard_loss
+      for i, (mean, var) in enumerate(stats):
+        new_stats[i].append((weights[rank], mean, var))
+
+    torch.mv(self.grad_buffer.t(), weights, out=self.flat_grad)
+    for bn_param, stats in zip(bn_params, new_stats):
+      bn_param['running_mean'] = sum(w * mean for w, mean, _ in stats)
+      bn_param['running_var'] = sum(w * var for w, _, var in stats)
+    return torch.tensor(loss, dtype=self.flat.dtype), {'flat': self.flat_grad}
+
+  def close(self):
+    """
+    Stops and joins the worker processes.
+    """
+    for tasks in self.tasks:
+      tasks.put(None)
+    for worker in self.workers:
+      worker.join()
+    self.workers = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
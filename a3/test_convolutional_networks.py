@@ -0,0 +1,320 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('eecs598')
+
+import convolutional_networks
+from convolutional_networks import (DeepConvNet, AmpSolver, PrefetchSolver,
+                                    adam, check_model_gradients,
+                                    CONV_ENGINES, check_conv_engine, int8_mm,
+                                    Conv_BatchNorm_ReLU_Pool, FastConv,
+                                    SpatialBatchNorm, ReLU, FastMaxPool,
+                                    ConvIm2Col, MaxPool, ThreeLayerConvNet,
+                                    InferenceServer)
+
+
+class PrefetchAmpSolver(PrefetchSolver, AmpSolver):
+  pass
+
+
+def test_amp_solver_combines_with_prefetch_solver(small_images):
+  data = small_images()
+  model = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4, 4],
+                      max_pools=[0, 1], weight_scale=1e-2,
+                      amp_dtype=torch.bfloat16)
+  solver = PrefetchAmpSolver(model, data, update_rule=adam,
+                             optim_config={'learning_rate': 1e-3},
+                             num_epochs=1, batch_size=16, verbose=False,
+                             num_workers=1, depth=2, crop_padding=0,
+                             flip=False, growth_interval=2)
+  solver.train()
+  assert solver.loader.num_batches == len(solver.loss_history)
+  assert len(solver.loss_scale_history) == len(solver.loss_history)
+  assert solver.num_skipped_steps + solver.good_steps == len(solver.loss_history)
+
+
+def test_batchnorm_deep_conv_net_passes_gradient_check(small_images):
+  data = small_images(dtype=torch.float64)
+  X, y = data['X_train'][:4], data['y_train'][:4]
+  model = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4, 4],
+                      max_pools=[0, 1], batchnorm=True, reg=0.1,
+                      weight_scale='kaiming', dtype=torch.float64)
+  errors = check_model_gradients(model, X, y)
+  assert set(errors) == set(model.params)
+  for k, e in errors.items():
+    assert e < 1e-5, k
+
+
+@pytest.mark.parametrize('engine', sorted(CONV_ENGINES))
+@pytest.mark.parametrize('stride, pad', [(1, 1), (1, 0), (2, 0), (2, 1)])
+def test_conv_engine_matches_reference(engine, stride, pad):
+  # W = 10 leaves a remainder at stride 2, so the last input column is
+  # never read by a window
+  kwargs = dict(N=2, C=3, H=7, W=10, F=4, filter_size=3, stride=stride,
+                pad=pad)
+  if engine == 'winograd' and stride != 1:
+    with pytest.raises(ValueError):
+      check_conv_engine(engine, **kwargs)
+    return
+  errors = check_conv_engine(engine, **kwargs)
+  for k, e in errors.items():
+    assert e < 1e-10, k
+
+
+def test_fft_engine_rejects_amp_dtype():
+  with pytest.raises(ValueError):
+    DeepConvNet(input_dims=(3, 8, 8), num_filters=[4], max_pools=[0],
+                conv_engines='fft', amp_dtype=torch.bfloat16)
+
+
+# (M, K, N) below and above the alignment rules of the int8 GEMM kernel
+@pytest.mark.parametrize('shape', [(8, 12, 5), (16, 8, 8), (17, 16, 8),
+                                   (64, 72, 24)])
+def test_int8_mm_matches_int32_gemm(shape):
+  M, K, N = shape
+  torch.manual_seed(0)
+  a = torch.randint(-128, 128, (M, K), dtype=torch.int8)
+  b = torch.randint(-128, 128, (K, N), dtype=torch.int8)
+  expected = torch.mm(a.to(torch.int32), b.to(torch.int32))
+  out = int8_mm(a, b)
+  assert out.dtype == torch.int32
+  assert torch.equal(out, expected)
+
+
+def test_sandwich_cache_packs_relu_mask_and_matches_separate_layers():
+  torch.manual_seed(0)
+  x = torch.randn(2, 3, 6, 8, dtype=torch.float64)
+  w = torch.randn(4, 3, 3, 3, dtype=torch.float64)
+  b = torch.randn(4, dtype=torch.float64)
+  gamma = torch.rand(4, dtype=torch.float64) + 0.5
+  beta = torch.randn(4, dtype=torch.float64)
+  conv_param = {'stride': 1, 'pad': 1}
+  pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+  a, conv_cache = FastConv.forward(x, w, b, conv_param)
+  an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, {'mode': 'train'})
+  s, relu_cache = ReLU.forward(an)
+  expected, pool_cache = FastMaxPool.forward(s, pool_param)
+  dout = torch.randn_like(expected)
+  ds = FastMaxPool.backward(dout, pool_cache)
+  da, dgamma, dbeta = SpatialBatchNorm.backward(ReLU.backward(ds, relu_cache),
+                                                bn_cache)
+  expected_grads = FastConv.backward(da, conv_cache) + (dgamma, dbeta)
+
+  out, cache = Conv_BatchNorm_ReLU_Pool.forward(
+    x, w, b, gamma, beta, conv_param, {'mode': 'train'}, pool_param)
+  assert cache.relu_mask.dtype == torch.uint8
+  assert cache.relu_mask.numel() == (a.numel() + 7) // 8
+  assert torch.allclose(out, expected)
+  grads = Conv_BatchNorm_ReLU_Pool.backward(dout.clone(), cache)
+  for g, e in zip(grads, expected_grads):
+    assert torch.allclose(g, e)
+
+
+def test_sharded_checkpoint_round_trip_restores_configuration(tmp_path,
+                                                              small_images):
+  data = small_images()
+  X, y = data['X_train'][:16], data['y_train'][:16]
+  model = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4, 4],
+                      max_pools=[0, 1], batchnorm=True, weight_scale=1e-1,
+                      conv_engines='im2col', channels_last=True)
+  for bn_param in model.bn_params:
+    bn_param['cache_dtype'] = torch.float16
+  model.loss(X, y)  # fill the running statistics
+  model.save_sharded(str(tmp_path / 'ckpt'), shard_bytes=256)
+
+  loaded = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4, 4],
+                       max_pools=[0, 1])
+  loaded.load_sharded(str(tmp_path / 'ckpt'), torch.float, 'cpu')
+  assert loaded.conv_engines == model.conv_engines
+  assert loaded.channels_last
+  assert loaded.batchnorm
+  assert all(p['cache_dtype'] == torch.float16 for p in loaded.bn_params)
+  assert loaded.params['W1'].is_contiguous(memory_format=torch.channels_last)
+  for k, v in model.params.items():
+    assert torch.equal(loaded.params[k], v), k
+  assert torch.equal(loaded.loss(X), model.loss(X))
+
+  amp = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4], max_pools=[0],
+                    amp_dtype=torch.bfloat16)
+  amp.save_sharded(str(tmp_path / 'amp'))
+  loaded.load_sharded(str(tmp_path / 'amp'), torch.float, 'cpu')
+  assert loaded.amp_dtype == torch.bfloat16
+
+
+@pytest.mark.parametrize('stride, pad', [(1, 1), (2, 0)])
+def test_im2col_channels_last_matches_fast_conv(stride, pad):
+  torch.manual_seed(0)
+  x = torch.randn(2, 3, 7, 10, dtype=torch.float64)
+  w = torch.randn(4, 3, 3, 3, dtype=torch.float64)
+  b = torch.randn(4, dtype=torch.float64)
+  conv_param = {'stride': stride, 'pad': pad}
+  expected, fast_cache = FastConv.forward(x, w, b, conv_param)
+  dout = torch.randn_like(expected)
+  expected_grads = FastConv.backward(dout, fast_cache)
+
+  cl = torch.channels_last
+  out, cache = ConvIm2Col.forward(x.contiguous(memory_format=cl),
+                                  w.contiguous(memory_format=cl), b, conv_param)
+  assert out.is_contiguous(memory_format=cl)
+  assert torch.allclose(out, expected)
+  grads = ConvIm2Col.backward(dout.contiguous(memory_format=cl), cache)
+  for g, e in zip(grads, expected_grads):
+    assert torch.allclose(g, e)
+
+
+@pytest.mark.parametrize('channels_last', [False, True])
+@pytest.mark.parametrize('pool, stride', [(2, 2), (3, 2)])
+def test_max_pool_matches_torch(pool, stride, channels_last):
+  torch.manual_seed(0)
+  x = torch.randn(2, 3, 7, 9, dtype=torch.float64)
+  if channels_last:
+    x = x.contiguous(memory_format=torch.channels_last)
+  x_ref = x.detach().clone().requires_grad_()
+  expected = torch.nn.functional.max_pool2d(x_ref, pool, stride=stride)
+  dout = torch.randn_like(expected)
+  expected.backward(dout)
+
+  pool_param = {'pool_height': pool, 'pool_width': pool, 'stride': stride}
+  out, cache = MaxPool.forward(x, pool_param)
+  assert torch.equal(out, expected.detach())
+  # overlapping windows (3, 2) make backward accumulate onto shared maxima
+  dx = MaxPool.backward(dout, cache)
+  assert torch.allclose(dx, x_ref.grad)
+
+
+def _trained_batchnorm_net(data, **kwargs):
+  model = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4, 4],
+                      max_pools=[0, 1], batchnorm=True, weight_scale='kaiming',
+                      dtype=torch.float64, **kwargs)
+  for _ in range(3):  # move the running statistics away from their defaults
+    model.loss(data['X_train'][:32], data['y_train'][:32])
+  return model
+
+
+def test_fold_batchnorm_matches_test_time_scores(small_images):
+  data = small_images(dtype=torch.float64)
+  model = _trained_batchnorm_net(data)
+  X = data['X_val'][:16]
+  folded = model.fold_batchnorm(X_check=X)
+  assert not folded.batchnorm
+  assert not any(k.startswith(('gamma', 'beta')) for k in folded.params)
+  assert torch.allclose(folded.loss(X), model.loss(X))
+  for k, v in folded.params.items():
+    assert v.data_ptr() != model.params[k].data_ptr(), k
+
+
+def test_fold_batchnorm_raises_when_scores_differ(small_images, monkeypatch):
+  data = small_images(dtype=torch.float64)
+  model = _trained_batchnorm_net(data)
+  forward = convolutional_networks.Conv_ReLU_Pool.forward
+
+  def shifted_forward(*args):
+    out, cache = forward(*args)
+    return out + 1, cache
+
+  # only the folded graph runs Conv_ReLU_Pool, so its scores drift
+  monkeypatch.setattr(convolutional_networks.Conv_ReLU_Pool, 'forward',
+                      staticmethod(shifted_forward))
+  with pytest.raises(RuntimeError):
+    model.fold_batchnorm(X_check=data['X_val'][:16])
+
+
+def test_fold_batchnorm_needs_running_statistics():
+  model = DeepConvNet(input_dims=(3, 8, 8), num_filters=[4], max_pools=[0],
+                      batchnorm=True)
+  for bn_param in model.bn_params:
+    bn_param.pop('running_mean', None)
+  with pytest.raises(ValueError):
+    model.fold_batchnorm()
+
+
+def test_checkpointing_matches_full_backward_in_deep_conv_net(small_images):
+  data = small_images(dtype=torch.float64)
+  X, y = data['X_train'][:8], data['y_train'][:8]
+  kwargs = dict(input_dims=(3, 8, 8), num_filters=[4, 4, 4], max_pools=[0, 2],
+                batchnorm=True, reg=0.1, weight_scale='kaiming',
+                dtype=torch.float64)
+  torch.manual_seed(0)
+  model = DeepConvNet(**kwargs)
+  expected_loss, expected_grads = model.loss(X, y)
+
+  torch.manual_seed(0)
+  checkpointed = DeepConvNet(checkpoint_every=2, **kwargs)
+  loss, grads = checkpointed.loss(X, y)
+  assert torch.allclose(torch.as_tensor(loss), torch.as_tensor(expected_loss))
+  for k, g in expected_grads.items():
+    assert torch.allclose(grads[k], g), k
+  # recomputing a layer must not update its running statistics again
+  for bn_param, expected in zip(checkpointed.bn_params, model.bn_params):
+    assert torch.allclose(bn_param['running_mean'], expected['running_mean'])
+    assert torch.allclose(bn_param['running_var'], expected['running_var'])
+
+
+def test_inference_server_matches_loss_for_every_bucket(small_images):
+  data = small_images()
+  torch.manual_seed(0)
+  model = ThreeLayerConvNet(input_dims=(3, 8, 8), num_filters=4,
+                            filter_size=3, hidden_dim=10, weight_scale=1e-1,
+                            dtype=torch.float64)
+  server = InferenceServer(model, buckets=(1, 4, 8))
+  # the inputs are float32 and get cast into the float64 bucket buffers
+  X = data['X_val']
+  for n in (1, 3, 4, 5, 8, 19):
+    expected = model.loss(X[:n])
+    assert torch.allclose(server.predict(X[:n]), expected), n
+    assert torch.equal(server.classify(X[:n]), expected.argmax(dim=1)), n
+
+  # steady state reuses the buffers of a bucket
+  _, buffers = server.slots[4]
+  scores = buffers['scores']
+  server.predict(X[:2])
+  assert buffers['scores'] is scores
+
+
+def test_prune_channels_matches_model_with_zeroed_channels(small_images):
+  data = small_images(dtype=torch.float64)
+  model = _trained_batchnorm_net(data)
+  model.params['gamma1'] = torch.tensor([0.5, -2.0, 0.1, 1.5],
+                                        dtype=torch.float64)
+  model.params['gamma2'] = torch.tensor([1.0, 0.2, -0.3, -3.0],
+                                        dtype=torch.float64)
+  pruned = model.prune_channels(amount=0.5, criterion='gamma')
+
+  # a channel whose filter, bias, gamma and beta are zero outputs zeros, so
+  # removing it does not change the scores
+  kept = {1: [1, 3], 2: [0, 3]}
+  zeroed = copy.copy(model)
+  zeroed.params = {k: v.clone() for k, v in model.params.items()}
+  for i, keep in kept.items():
+    dropped = [c for c in range(4) if c not in keep]
+    for name in ('W', 'b', 'gamma', 'beta'):
+      zeroed.params[f'{name}{i}'][dropped] = 0
+    assert pruned.params[f'W{i}'].shape[0] == 2
+    assert torch.equal(pruned.params[f'gamma{i}'],
+                       model.params[f'gamma{i}'][keep])
+    assert torch.equal(pruned.bn_params[i-1]['running_mean'],
+                       model.bn_params[i-1]['running_mean'][keep])
+  assert pruned.params['W2'].shape[1] == 2
+  assert pruned.params['W3'].shape[0] == model.params['W3'].shape[0] // 2
+
+  X = data['X_val'][:16]
+  assert torch.allclose(pruned.loss(X), zeroed.loss(X))
+  # the pruned copy does not share storage with the model
+  for k, v in pruned.params.items():
+    assert v.data_ptr() != model.params[k].data_ptr(), k
+
+
+def test_prune_channels_l1_keeps_the_largest_filters():
+  torch.manual_seed(0)
+  model = DeepConvNet(input_dims=(3, 8, 8), num_filters=[8], max_pools=[0],
+                      weight_scale=1e-1, dtype=torch.float64)
+  pruned = model.prune_channels(amount=0.25)
+  norms = model.params['W1'].abs().sum(dim=(1, 2, 3))
+  keep = norms.topk(6).indices.sort().values
+  assert torch.equal(pruned.params['W1'], model.params['W1'][keep])
+  assert torch.equal(pruned.params['b1'], model.params['b1'][keep])
+  with pytest.raises(ValueError):
+    model.prune_channels(criterion='gamma')
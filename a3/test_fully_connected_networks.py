@@ -0,0 +1,124 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('eecs598')
+
+from eecs598 import Solver
+from fully_connected_networks import (FullyConnectedNet, FlatParams,
+                                      DataParallel, PrefetchSolver,
+                                      sgd_momentum, check_model_gradients,
+                                      _relative_error)
+
+
+@pytest.mark.parametrize('wrapper', [FlatParams, DataParallel])
+def test_solver_leaves_best_params_in_wrapped_model(wrapper, small_data):
+  data = small_data()
+  model = FullyConnectedNet([20], input_dim=48, weight_scale=1e-1,
+                            dtype=torch.float64)
+  wrapped = wrapper(model)
+  try:
+    solver = Solver(wrapped, data, update_rule=sgd_momentum,
+                    optim_config={'learning_rate': 0.5},
+                    num_epochs=5, batch_size=50, verbose=False)
+    solver.train()
+  finally:
+    if wrapper is DataParallel:
+      wrapped.close()
+
+  best = solver.best_params['flat']
+  assert wrapped.params['flat'] is wrapped.flat
+  assert torch.equal(wrapped.flat, best)
+  offset = 0
+  for k in wrapped.keys:
+    p = model.params[k]
+    assert p.data_ptr() == wrapped.flat[offset:].data_ptr()
+    offset += p.numel()
+  val_acc = solver.check_accuracy(data['X_val'], data['y_val'])
+  assert val_acc == solver.best_val_acc
+
+
+def test_prefetch_solver_can_train_twice(small_data):
+  data = small_data()
+  model = FullyConnectedNet([20], input_dim=48, weight_scale=1e-1,
+                            dtype=torch.float64)
+  solver = PrefetchSolver(model, data, update_rule=sgd_momentum,
+                          optim_config={'learning_rate': 0.5},
+                          num_epochs=1, batch_size=50, verbose=False,
+                          num_workers=1, depth=2, crop_padding=0, flip=False)
+  solver.train()
+  first = len(solver.loss_history)
+  solver.train()
+  assert len(solver.loss_history) == 2 * first
+  assert not solver.loader.workers
+  with pytest.raises(RuntimeError):
+    solver.loader.next_batch()
+
+
+def test_relative_error_keeps_small_gradients_relative():
+  small = torch.tensor([1e-6, -2e-6], dtype=torch.float64)
+  assert _relative_error(small, 2 * small) > 0.1
+  noise = torch.tensor([3e-10, -1e-10], dtype=torch.float64)
+  assert _relative_error(noise, torch.zeros(2, dtype=torch.float64)) < 1e-9
+
+
+def test_check_model_gradients_with_dropout_needs_a_seed(small_data):
+  data = small_data()
+  X, y = data['X_train'][:8], data['y_train'][:8]
+  model = FullyConnectedNet([10, 10], input_dim=48, dropout=0.5, reg=0.1,
+                            dtype=torch.float64)
+  with pytest.raises(ValueError):
+    check_model_gradients(model, X, y)
+
+  model = FullyConnectedNet([10, 10], input_dim=48, dropout=0.5, reg=0.1,
+                            seed=0, dtype=torch.float64)
+  for k, e in check_model_gradients(model, X, y).items():
+    assert e < 1e-5, k
+
+
+@pytest.mark.parametrize('checkpoint_every', [1, 2, 'sqrt'])
+def test_checkpointing_matches_full_backward_with_dropout(checkpoint_every,
+                                                         small_data):
+  data = small_data()
+  X, y = data['X_train'][:32], data['y_train'][:32]
+  # no dropout seed: the checkpoints must replay the global RNG state
+  model = FullyConnectedNet([10, 10, 10, 10], input_dim=48, dropout=0.5,
+                            reg=0.1, dtype=torch.float64)
+  torch.manual_seed(0)
+  expected_loss, expected_grads = model.loss(X, y)
+
+  model.checkpoint_every = checkpoint_every
+  torch.manual_seed(0)
+  loss, grads = model.loss(X, y)
+  assert loss == expected_loss
+  for k, g in expected_grads.items():
+    assert torch.allclose(grads[k], g), k
+
+
+def test_sharded_checkpoint_round_trip(tmp_path, small_data):
+  data = small_data()
+  X = data['X_val'][:16]
+  model = FullyConnectedNet([20, 10], input_dim=48, dropout=0.25, reg=0.1,
+                            seed=3, dtype=torch.float32)
+  expected = {k: v.clone() for k, v in model.params.items()}
+  thread = model.save_sharded(str(tmp_path), shard_bytes=1024,
+                              background=True)
+  # the checkpoint is a snapshot taken before the writer thread starts
+  for v in model.params.values():
+    v.zero_()
+  thread.join()
+  assert len(list(tmp_path.glob('shard-*.pt'))) > 1
+
+  loaded = FullyConnectedNet([5], input_dim=48)
+  loaded.load_sharded(str(tmp_path), torch.float64, 'cpu')
+  assert loaded.num_layers == 3
+  assert loaded.reg == 0.1
+  assert loaded.use_dropout
+  assert loaded.dropout_param['seed'] == 3
+  assert set(loaded.params) == set(expected)
+  for k, v in expected.items():
+    assert loaded.params[k].dtype == torch.float64
+    assert torch.equal(loaded.params[k], v.double()), k
+
+  model.params = {k: v.double() for k, v in expected.items()}
+  model.dtype = torch.float64
+  assert torch.allclose(loaded.loss(X), model.loss(X))